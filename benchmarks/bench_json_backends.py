@@ -0,0 +1,48 @@
+# Compares the JSON backends (and the previous json.dump path) on large generated bundles.
+#
+#   python benchmarks/bench_json_backends.py [report.xml]
+import importlib, json, os, sys, tempfile, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import foundationtofhir
+from generate_report import writeFoundationReport
+
+def timeBackend(bundleResource, path, serializer, number):
+    def run():
+        with open(path, 'wb') as outfile:
+            foundationtofhir.dumpFoundationBundle(bundleResource, outfile, serializer)
+    return timeit.timeit(run, number=number) / number
+
+def timeJsonDump(bundleResource, path, number):
+    def run():
+        with open(path, 'w') as outfile:
+            json.dump(bundleResource, outfile)
+    return timeit.timeit(run, number=number) / number
+
+def main():
+    directory = tempfile.mkdtemp()
+    if len(sys.argv) > 1:
+        report = sys.argv[1]
+    else:
+        report = os.path.join(directory, 'large-report.xml')
+        writeFoundationReport(report, genes=500, shortVariants=20000)
+    bundleResource = foundationtofhir.convert_file(report)
+    path = os.path.join(directory, 'bundle.json')
+    number = 3
+
+    baseline = timeJsonDump(bundleResource, path, number)
+    print("%-22s %8.1f ms %8.1f MB" % ("json.dump (previous)", baseline * 1000, os.path.getsize(path) / 1e6))
+    for backend in foundationtofhir.foundationJsonBackends:
+        try:
+            importlib.import_module(backend)
+        except ImportError:
+            print("%-22s not installed" % backend)
+            continue
+        for pretty in [False, True]:
+            serializer = foundationtofhir.foundationJsonSerializer(backend, pretty)
+            seconds = timeBackend(bundleResource, path, serializer, number)
+            name = backend + (" pretty" if pretty else " compact")
+            print("%-22s %8.1f ms %8.1f MB %6.1fx" % (name, seconds * 1000, os.path.getsize(path) / 1e6, baseline / seconds))
+
+if __name__ == '__main__':
+    main()
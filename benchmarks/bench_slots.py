@@ -0,0 +1,45 @@
+# Reports the per-object memory of the __slots__ wrapper classes against the same classes with a per-instance
+# __dict__, as they were before.
+#
+#   python benchmarks/bench_slots.py
+import os, sys, tracemalloc
+from xml.etree import ElementTree as elementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import foundationtofhir
+
+# the same class, without __slots__
+def withDict(cls):
+    namespace = {}
+    for name, value in cls.__dict__.items():
+        if name != '__slots__' and name not in cls.__slots__:
+            namespace[name] = value
+    return type(cls.__name__ + 'WithDict', (), namespace)
+
+def bytesPerObject(constructor, n):
+    tracemalloc.start()
+    objects = [constructor() for i in range(n)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size / n
+
+def main():
+    n = 50000
+    element = elementTree.Element('short-variant')
+    classes = [
+        (foundationtofhir.foundationFhirObservation, ()),
+        (foundationtofhir.foundationFhirSequence, ()),
+        (foundationtofhir.foundationFhirSpecimen, ()),
+        (foundationtofhir.foundationFhirPatient, ()),
+        (foundationtofhir.foundationStreamElement, (element,))
+    ]
+    print("%-32s %12s %12s %10s" % ("class", "__dict__", "__slots__", "saved"))
+    for cls, args in classes:
+        dictClass = withDict(cls)
+        before = bytesPerObject(lambda: dictClass(*args), n)
+        after = bytesPerObject(lambda: cls(*args), n)
+        print("%-32s %10.0f B %10.0f B %8.0f B" % (cls.__name__, before, after, before - after))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# Times every stage of a conversion on synthetic reports of increasing size and appends the results to a JSON lines
+# file, so runs on different commits can be compared. Each run is compared with the previous one in that file.
+#
+#   python benchmarks/bench_stages.py [--sizes small,medium,large,exome] [--repeat 3] [--results bench_stages.jsonl]
+import argparse, gc, json, os, platform, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import foundationtofhir
+from generate_report import writeFoundationReport
+
+# keyword arguments of writeFoundationReport for each size
+reportSizes = {
+    'small': dict(genes=5, therapies=5, trials=5, shortVariants=50, copyNumberAlterations=5, rearrangements=2,
+                  pdfBytes=200000),
+    'medium': dict(genes=20, therapies=10, trials=10, shortVariants=500, copyNumberAlterations=20, rearrangements=10,
+                   pdfBytes=1000000),
+    'large': dict(genes=50, therapies=20, trials=30, shortVariants=5000, copyNumberAlterations=100, rearrangements=30,
+                  pdfBytes=4000000),
+    'exome': dict(genes=100, therapies=30, trials=50, shortVariants=50000, copyNumberAlterations=500,
+                  rearrangements=100, pdfBytes=8000000)
+}
+
+stages = ['parse', 'report resources', 'genomic observations', 'variant report', 'link diagnostic report',
+          'provenance', 'bundle assembly', 'serialization']
+
+# one conversion, split into the same stages as createFoundationFhirBundle and convertFoundationFile
+def timeStages(path, outputFile, serializer):
+    seconds = {}
+    clock = time.perf_counter
+    start = clock()
+    DOM = foundationtofhir.parseFoundationXml(path, spoolPDF=True)
+    seconds['parse'] = clock() - start
+
+    start = clock()
+    report = foundationtofhir.createFoundationReportResources(DOM)
+    seconds['report resources'] = clock() - start
+
+    start = clock()
+    observationArr = foundationtofhir.createFoundationGenomicObservations(report, DOM)
+    seconds['genomic observations'] = clock() - start
+
+    start = clock()
+    sequenceArr = []
+    variantReportObservations = []
+    foundationtofhir.addFoundationVariantReportResources(report, variantReportObservations, sequenceArr, DOM)
+    observationArr = observationArr + variantReportObservations
+    seconds['variant report'] = clock() - start
+
+    start = clock()
+    foundationtofhir.linkFoundationDiagnosticReport(report, observationArr)
+    foundationtofhir.diagnosticReportAddContainedArr(report.diagnosticReport.diagnosticReportResource, observationArr,
+                                                     report.specimen)
+    seconds['link diagnostic report'] = clock() - start
+
+    start = clock()
+    provenance = foundationtofhir.createFoundationProvenance(report, observationArr, DOM)
+    seconds['provenance'] = clock() - start
+
+    start = clock()
+    bundle = foundationtofhir.assembleFoundationFhirBundle(report, observationArr, sequenceArr, provenance)
+    seconds['bundle assembly'] = clock() - start
+
+    start = clock()
+    with open(outputFile, 'wb') as outfile:
+        foundationtofhir.dumpFoundationBundle(bundle.bundleResource, outfile, serializer)
+    seconds['serialization'] = clock() - start
+    return seconds, len(bundle.bundleResource['entry'])
+
+def currentCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def loadPreviousRun(results):
+    if not os.path.exists(results):
+        return None, {}
+    with open(results) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if len(records) == 0:
+        return None, {}
+    run = records[-1]['run']
+    return records[-1], dict(((record['size'], record['stage']), record['seconds']) for record in records
+                             if record['run'] == run)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time each conversion stage on synthetic FoundationOne reports.")
+    parser.add_argument('--sizes', default='small,medium,large', help="comma separated, from " + ", ".join(reportSizes))
+    parser.add_argument('--repeat', type=int, default=3, help="conversions per size; the fastest time of each stage is kept")
+    parser.add_argument('--results', default='bench_stages.jsonl', help="JSON lines file the results are appended to")
+    parser.add_argument('--json-backend', choices=foundationtofhir.foundationJsonBackends, default=None)
+    parser.add_argument('--no-record', action='store_true', help="only print the results")
+    args = parser.parse_args(argv)
+
+    serializer = foundationtofhir.foundationJsonSerializer(args.json_backend)
+    previous, previousSeconds = loadPreviousRun(args.results)
+    run = time.strftime('%Y-%m-%dT%H:%M:%S')
+    commit = currentCommit()
+    directory = tempfile.mkdtemp()
+    records = []
+    if previous is not None:
+        print("comparing with run %s (commit %s)" % (previous['run'], previous['commit']))
+    for size in args.sizes.split(','):
+        path = writeFoundationReport(os.path.join(directory, size + '.xml'), **reportSizes[size])
+        outputFile = os.path.join(directory, size + '.json')
+        best = {}
+        for _ in range(args.repeat):
+            seconds, entries = timeStages(path, outputFile, serializer)
+            for stage in stages:
+                best[stage] = min(best.get(stage, seconds[stage]), seconds[stage])
+            gc.collect()
+        print("%s: %.1f MB in, %.1f MB out, %d entries" % (size, os.path.getsize(path) / 1e6,
+                                                           os.path.getsize(outputFile) / 1e6, entries))
+        for stage in stages + ['total']:
+            seconds = sum(best.values()) if stage == 'total' else best[stage]
+            line = "  %-24s %9.2f ms" % (stage, seconds * 1000)
+            if (size, stage) in previousSeconds and seconds > 0:
+                line += "  %6.2fx speedup vs previous" % (previousSeconds[(size, stage)] / seconds)
+            print(line)
+            records.append({
+                'run': run,
+                'commit': commit,
+                'python': platform.python_version(),
+                'jsonBackend': serializer.backend,
+                'size': size,
+                'inputBytes': os.path.getsize(path),
+                'entries': entries,
+                'stage': stage,
+                'seconds': seconds
+            })
+    if not args.no_record:
+        with open(args.results, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        print("results appended to " + args.results)
+
+if __name__ == '__main__':
+    main()
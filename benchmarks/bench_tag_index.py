@@ -0,0 +1,65 @@
+# Compares whole-document getElementsByTagName scans (what the builders used to do on every read) with the
+# single-pass tag index on a large synthetic FoundationOne report.
+#
+#   python benchmarks/bench_tag_index.py [report.xml]
+import os, sys, tempfile, timeit
+from xml.dom import minidom as domParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import foundationtofhir
+from generate_report import writeFoundationReport
+
+# every whole-document text lookup made while converting one report
+textLookups = [
+    'ServerTime', 'ServerTime', 'MedFacilID', 'MedFacilID', 'MedFacilName', 'MedFacilName', 'OrderingMDId',
+    'OrderingMD', 'MRN', 'MRN', 'FirstName', 'LastName', 'Gender', 'DOB', 'Pathologist', 'ReportId', 'Version',
+    'TestType', 'TestType', 'CollDate', 'CollDate', 'CollDate', 'CollDate', 'SubmittedDiagnosis', 'SampleId',
+    'SpecSite', 'SpecSite', 'SpecFormat', 'ReceivedDate', 'OpName', 'Text'
+]
+# every whole-document node list lookup made while converting one report
+nodeLookups = [
+    'Summaries', 'Genes', 'Genes', 'ApplicationSetting', 'ApplicationSetting', 'variant-report', 'ReportPDF',
+    'ReportPDF', 'sample', 'sample', 'sample', 'short-variant', 'copy-number-alteration', 'rearrangement', 'Trial'
+]
+
+def scanLookups(DOM):
+    for tagName in textLookups:
+        DOM.getElementsByTagName(tagName)[0].childNodes[0].nodeValue
+    for tagName in nodeLookups:
+        DOM.getElementsByTagName(tagName)
+
+def indexLookups(DOM):
+    index = foundationtofhir.buildFoundationTagIndex(DOM)
+    for tagName in textLookups:
+        index.getFirstText(tagName)
+    for tagName in nodeLookups:
+        index.getElementsByTagName(tagName)
+
+def streamLookups(path):
+    index = foundationtofhir.parseFoundationXml(path)
+    for tagName in textLookups:
+        index.getFirstText(tagName)
+    for tagName in nodeLookups:
+        index.getElementsByTagName(tagName)
+
+def main():
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'large-report.xml')
+        writeFoundationReport(path, genes=200, shortVariants=5000)
+    print("report: %s (%.1f MB)" % (path, os.path.getsize(path) / 1e6))
+    DOM = domParser.parse(path)
+    number = 5
+    scan = timeit.timeit(lambda: scanLookups(DOM), number=number) / number
+    indexed = timeit.timeit(lambda: indexLookups(DOM), number=number) / number
+    print("repeated getElementsByTagName scans: %8.1f ms" % (scan * 1000))
+    print("single-pass index + lookups:         %8.1f ms" % (indexed * 1000))
+    print("speedup:                             %8.1fx" % (scan / indexed))
+    parse = timeit.timeit(lambda: scanLookups(domParser.parse(path)), number=1)
+    stream = timeit.timeit(lambda: streamLookups(path), number=1)
+    print("minidom parse + scans:               %8.1f ms" % (parse * 1000))
+    print("streaming parse with index:          %8.1f ms" % (stream * 1000))
+
+if __name__ == '__main__':
+    main()
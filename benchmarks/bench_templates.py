@@ -0,0 +1,51 @@
+# Compares building the Observation skeleton from a nested literal on every call (what
+# foundationFhirObservation.__init__ used to do) with instantiating the shared template.
+#
+#   python benchmarks/bench_templates.py
+import os, sys, timeit, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import foundationtofhir
+
+def literalObservation():
+    return {
+        'resourceType': "Observation",
+        'text': {
+            'status': "generated",
+            'div': ""
+        },
+        'status': "final",
+        'category': [{
+            'coding': [{
+                'system': "http://hl7.org/fhir/observation-category",
+                'code': "laboratory"
+            }],
+            'text': "Laboratory result generated by Foundation Medicine"
+        }],
+        'extension': [],
+        'performer': [{
+            'reference': "Organization/FM",
+            'display': "Foundation Medicine"
+        }]
+    }
+
+def templateObservation():
+    return foundationtofhir.observationTemplate.instantiate()
+
+def bytesPerObservation(constructor, n):
+    tracemalloc.start()
+    observations = [constructor() for i in range(n)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del observations
+    return size / n
+
+def main():
+    n = 100000
+    for name, constructor in [("nested literal", literalObservation), ("template", templateObservation)]:
+        seconds = min(timeit.repeat(constructor, number=n, repeat=5))
+        print("%-15s %6.0f ns/observation %6.0f bytes/observation" % (name, seconds / n * 1e9,
+                                                                      bytesPerObservation(constructor, n)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Uploads converted synthetic reports to a local stand-in FHIR server, so the uploader's connection reuse, retries
+# and latency can be measured without a network. The server answers every POST with 201 after --server-delay, and
+# with 503 for a --failure-rate share of requests.
+#
+#   python benchmarks/bench_upload.py [--bundles 50] [--concurrency 4] [--failure-rate 0.1] [--server-delay 0.01]
+import argparse, os, random, shutil, sys, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import foundationtofhir
+from generate_report import writeFoundationReport
+
+class standInFhirServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, failureRate=0.0, seed=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), standInFhirHandler)
+        self.delay = delay
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.failures = 0
+        self.bytes = 0
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        ThreadingHTTPServer.process_request(self, request, client_address)
+
+class standInFhirHandler(BaseHTTPRequestHandler):
+    # keep-alive, like a real FHIR server
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        size = int(self.headers.get('Content-Length', 0))
+        remaining = size
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 1048576)))
+        time.sleep(server.delay)
+        with server.lock:
+            server.requests += 1
+            server.bytes += size
+            failed = server.random.random() < server.failureRate
+            if failed:
+                server.failures += 1
+            number = server.requests
+        if failed:
+            body = b'{"resourceType": "OperationOutcome"}'
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+        else:
+            body = b'{"resourceType": "Bundle"}'
+            self.send_response(201)
+            self.send_header('Location', 'http://127.0.0.1/fhir/Bundle/%d/_history/1' % number)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upload synthetic bundles to a local stand-in FHIR server.")
+    parser.add_argument('--bundles', type=int, default=50)
+    parser.add_argument('--short-variants', type=int, default=500, help="short variants per report")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--max-in-flight', type=int, default=None)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument('--server-delay', type=float, default=0.0, help="seconds the server takes per request")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = writeFoundationReport(os.path.join(directory, 'report.xml'), shortVariants=args.short_variants)
+        bundle = foundationtofhir.convertFoundationFile(path)
+        files = []
+        for i in range(args.bundles):
+            files.append(os.path.join(directory, 'bundle%d.json' % i))
+            shutil.copyfile(bundle, files[-1])
+
+        server = standInFhirServer(args.server_delay, args.failure_rate)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/fhir' % server.server_address[1]
+            results = foundationtofhir.uploadFoundationBundles(files, url, args.concurrency, args.max_in_flight,
+                                                               args.retries, backoff=0.01)
+        finally:
+            server.shutdown()
+            server.server_close()
+        print("server: %d connection(s), %d request(s), %d answered with 503, %.1f MB received" %
+              (server.connections, server.requests, server.failures, server.bytes / 1e6))
+        return 0 if all(result['error'] is None for result in results) else 1
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+# Writes a synthetic FoundationOne results report with the same layout, namespaces and attributes as the real ones,
+# but made-up content, so the converter can be measured without PHI. Every count is tunable and the output only
+# depends on the seed.
+#
+#   python benchmarks/generate_report.py report.xml --genes 50 --short-variants 20000 --pdf-bytes 2000000
+import argparse, base64, random
+from xml.sax.saxutils import quoteattr
+
+# cds-effects of every kind the converter parses, each with a matching functional-effect
+cdsEffects = [
+    ('%dA>G', 'missense'), ('%dC>T', 'nonsense'), ('%d_%dinsT', 'frameshift'), ('%d_%ddelCA', 'frameshift'),
+    ('%d_%ddel15', 'nonframeshift'), ('%ddupC', 'frameshift'), ('%d_%ddelinsTT', 'missense'), ('%d-1G>A', 'splice')
+]
+
+def cdsEffect(rnd, i):
+    pattern, functionalEffect = cdsEffects[i % len(cdsEffects)]
+    position = rnd.randint(10, 5000)
+    if pattern.count('%d') == 2:
+        return pattern % (position, position + 1), functionalEffect
+    return pattern % position, functionalEffect
+
+def writeFoundationReport(path, genes=20, therapies=10, trials=10, shortVariants=500, copyNumberAlterations=20,
+                          rearrangements=10, pdfBytes=200000, references=50, seed=0):
+    rnd = random.Random(seed)
+    geneNames = ['GENE%d' % i for i in range(genes)]
+    # a therapy keeps the same effect everywhere it is suggested, like in real reports
+    therapyEffects = {}
+    for i in range(therapies):
+        therapyEffects['Therapy%d' % i] = 'Sensitizing' if i % 3 != 2 else 'Resistant'
+    referenceIds = [str(1000 + i) for i in range(max(references, 1))]
+
+    with open(path, 'w', encoding='utf-8') as f:
+        w = f.write
+        w('<?xml version="1.0" encoding="UTF-8"?>\n')
+        w('<rr:ResultsReport xmlns:rr="http://foundationmedicine.com/compbio/resultsreport" '
+          'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+        w('<rr:ResultsPayload>\n<FinalReport xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" StagingId="%d">\n' % seed)
+        w('<Application><ApplicationSettings><ApplicationSetting><Name>Statement</Name>'
+          '<Value>Synthetic report generated for benchmarking.</Value></ApplicationSetting></ApplicationSettings></Application>\n')
+        w('<DemographicCorrectionDate/><ReportId>ORD-%d</ReportId><SampleName>SMP-%d</SampleName><Version>1</Version>\n' % (seed, seed))
+        w('<Sample><FM_Id>ORD-%d</FM_Id><SampleId>SMP-%d</SampleId><BlockId>B1</BlockId><TRFNumber>TRF%d</TRFNumber>'
+          '<TestType>FoundationOne</TestType><SpecFormat>Slide Deck</SpecFormat><ReceivedDate>2017-01-03</ReceivedDate>'
+          '</Sample>\n' % (seed, seed, seed))
+        w('<PMI><ReportId>ORD-%d</ReportId><MRN>%d</MRN><FullName>Doe, Jane</FullName><FirstName>Jane</FirstName>'
+          '<LastName>Doe</LastName><SubmittedDiagnosis>Lung adenocarcinoma</SubmittedDiagnosis><Gender>Female</Gender>'
+          '<DOB>1950-01-01</DOB><OrderingMD>Smith, John</OrderingMD><OrderingMDId>99</OrderingMDId>'
+          '<Pathologist>Alan Jones</Pathologist><CopiedPhysician1/><MedFacilName>General Hospital</MedFacilName>'
+          '<MedFacilID>555</MedFacilID><SpecSite>Lung</SpecSite><CollDate>2017-01-01</CollDate>'
+          '<ReceivedDate>2017-01-03</ReceivedDate><CountryOfOrigin>US</CountryOfOrigin></PMI>\n' % (seed, 10000 + seed))
+        w('<PertinentNegatives><PertinentNegative><Gene>KRAS</Gene></PertinentNegative></PertinentNegatives>\n')
+
+        geneBlocks = []
+        seenTherapies = set()
+        for i, gene in enumerate(geneNames):
+            alteration = 'V%dE' % (600 + i) if i % 2 == 0 else 'amplification'
+            block = ['<Gene><Name>%s</Name><Include>true</Include><Alterations><Alteration><Name>%s</Name>'
+                     '<Relevance>Indicated</Relevance><Include>true</Include><AlterationProperties><AlterationProperty '
+                     'isEquivocal="false" isSubclonal="false" name="%s"/></AlterationProperties>'
+                     '<Interpretation>%s %s is a synthetic alteration.</Interpretation><ClinicalTrialNote/><Therapies>'
+                     % (gene, alteration, alteration, gene, alteration)]
+            for therapy in rnd.sample(sorted(therapyEffects), min(2, therapies)):
+                seenTherapies.add(therapy)
+                block.append('<Therapy><FDAApproved>true</FDAApproved><Name>%s</Name><GenericName>%s</GenericName>'
+                             '<Effect>%s</Effect><Include>true</Include><Rationale>%s may be relevant for %s.</Rationale>'
+                             '<ReferenceLinks><ReferenceLink referenceId="%s"/></ReferenceLinks></Therapy>'
+                             % (therapy, therapy.lower(), therapyEffects[therapy], therapy, gene, rnd.choice(referenceIds)))
+            block.append('</Therapies><ReferenceLinks><ReferenceLink referenceId="%s"/><ReferenceLink referenceId="%s"/>'
+                         '</ReferenceLinks></Alteration></Alterations></Gene>' % (rnd.choice(referenceIds), rnd.choice(referenceIds)))
+            geneBlocks.append(''.join(block))
+
+        trialBlocks = []
+        titles = set()
+        for i in range(trials):
+            # every third trial repeats an earlier one for another gene, which the converter links instead of duplicating
+            title = 'Synthetic Trial %d' % (i - 1 if i % 3 == 2 else i)
+            titles.add(title)
+            trialBlocks.append('<Trial><Gene>%s</Gene><Alteration>amplification</Alteration><Title>%s</Title>'
+                               '<StudyPhase>Phase 2</StudyPhase><Target>EGFR</Target><Locations>Boston, MA</Locations>'
+                               '<NCTID>NCT%08d</NCTID><Note>Synthetic trial note.</Note><Include>true</Include></Trial>'
+                               % (geneNames[i % genes] if genes else 'GENE0', title, i))
+
+        sensitizing = len([therapy for therapy in seenTherapies if therapyEffects[therapy] == 'Sensitizing'])
+        w('<PriorTests/>\n<Genes>%s</Genes>\n' % ''.join(geneBlocks))
+        w('<Summaries alterationCount="%d" clinicalTrialCount="%d" resistiveCount="%d" sensitizingCount="%d"/>\n'
+          % (genes, len(titles), len(seenTherapies) - sensitizing, sensitizing))
+        w('<VariantProperties><VariantProperty geneName="GENE0" isVUS="true" variantName="V600E"/></VariantProperties>\n')
+        w('<Trials>%s</Trials>\n' % ''.join(trialBlocks))
+        w('<References>%s</References>\n' % ''.join(
+            '<Reference><ReferenceId>%s</ReferenceId><FullCitation>Author A, et al. Synthetic citation %s. '
+            'J Synth (2017) pmid:%s</FullCitation><Include>true</Include></Reference>' % (r, r, r) for r in referenceIds))
+        w('<Signatures><Signature><ServerTime>2017-01-10 12:00:00</ServerTime><OpName>Jeffrey S. Ross</OpName>'
+          '<Text>Jeffrey S. Ross, M.D., Medical Director | Shakti Ramkissoon, M.D.</Text></Signature></Signatures>\n')
+        w('<AAC><Amendmends/></AAC>\n</FinalReport>\n')
+
+        w('<variant-report xmlns="http://foundationmedicine.com/compbio/variant-report-external" disease="Lung" '
+          'disease-ontology="Lung adenocarcinoma" gender="female" pathology-diagnosis="Lung adenocarcinoma" '
+          'purity-assessment="40" specimen="SMP-%d" study="FoundationOne" test-request="ORD-%d" '
+          'test-type="FoundationOne" tissue-of-origin="Lung">\n' % (seed, seed))
+        w('<samples><sample bait-set="T7" mean-exon-depth="600.0" name="SMP-%d" nucleic-acid-type="DNA"/></samples>\n' % seed)
+        w('<quality-control status="Pass"/>\n<short-variants>\n')
+        for i in range(shortVariants):
+            effect, functionalEffect = cdsEffect(rnd, i)
+            w('<short-variant allele-fraction="0.%02d" cds-effect=%s depth="%d" equivocal="false" functional-effect="%s" '
+              'gene="SV%d" percent-reads="%d.0" position="chr%d:%d" protein-effect="P%dL" status="known" '
+              'strand="+" transcript="NM_%06d"><dna-evidence sample="SMP-%d"/></short-variant>\n'
+              % (rnd.randint(1, 99), quoteattr(effect), rnd.randint(100, 900), functionalEffect, i, rnd.randint(1, 99),
+                 i % 22 + 1, rnd.randint(10000, 100000000), i, i, seed))
+        w('</short-variants>\n<copy-number-alterations>\n')
+        for i in range(copyNumberAlterations):
+            start = rnd.randint(10000, 100000000)
+            w('<copy-number-alteration copy-number="%d" equivocal="false" gene="CN%d" number-of-exons="12 of 12" '
+              'position="chr%d:%d-%d" ratio="%.2f" status="known" type="amplification">'
+              '<dna-evidence sample="SMP-%d"/></copy-number-alteration>\n'
+              % (rnd.randint(4, 40), i, i % 22 + 1, start, start + rnd.randint(1000, 500000), rnd.uniform(1.5, 6), seed))
+        w('</copy-number-alterations>\n<rearrangements>\n')
+        for i in range(rearrangements):
+            start1 = rnd.randint(10000, 100000000)
+            start2 = rnd.randint(10000, 100000000)
+            w('<rearrangement allele-fraction="0.1" description="fusion" equivocal="false" in-frame="Yes" '
+              'other-gene="RO%d" pos1="chr%d:%d-%d" pos2="chr%d:%d-%d" status="known" supporting-read-pairs="%d" '
+              'targeted-gene="RT%d" type="fusion"><dna-evidence sample="SMP-%d"/></rearrangement>\n'
+              % (i, i % 22 + 1, start1, start1 + rnd.randint(10, 5000), (i + 5) % 22 + 1, start2,
+                 start2 + rnd.randint(10, 5000), rnd.randint(5, 200), i, seed))
+        w('</rearrangements>\n<biomarkers><microsatellite-instability status="MSS"/>'
+          '<tumor-mutation-burden score="4.0" status="low" unit="mutations-per-megabase"/></biomarkers>\n')
+        w('<non-human-content/>\n</variant-report>\n</rr:ResultsPayload>\n')
+
+        w('<ReportPDF>')
+        # written in pieces so multi-megabyte PDFs do not need to be held as one string
+        remaining = pdfBytes
+        header = b'%PDF-1.4\n'
+        while remaining > 0:
+            size = min(remaining, 3 * 65536)
+            chunk = (header + bytes(rnd.getrandbits(8) for _ in range(size)))[:size]
+            header = b''
+            w(base64.b64encode(chunk).decode('ascii'))
+            remaining -= size
+        w('</ReportPDF>\n</rr:ResultsReport>\n')
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic FoundationOne XML report.")
+    parser.add_argument('output')
+    parser.add_argument('--genes', type=int, default=20)
+    parser.add_argument('--therapies', type=int, default=10)
+    parser.add_argument('--trials', type=int, default=10)
+    parser.add_argument('--short-variants', type=int, default=500)
+    parser.add_argument('--copy-number-alterations', type=int, default=20)
+    parser.add_argument('--rearrangements', type=int, default=10)
+    parser.add_argument('--pdf-bytes', type=int, default=200000)
+    parser.add_argument('--references', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    writeFoundationReport(args.output, args.genes, args.therapies, args.trials, args.short_variants,
+                          args.copy_number_alterations, args.rearrangements, args.pdf_bytes, args.references, args.seed)
+
+if __name__ == '__main__':
+    main()
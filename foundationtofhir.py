@@ -1,9 +1,321 @@
-import copy, json, os
-from xml.dom import minidom as domParser
+import collections, functools, io, os, time
+# everything else is imported where it is used, to keep importing this module cheap for services that embed it
+
+# subtrees none of the builders below ever read. The streaming parser never builds them
+foundationUnusedTags = frozenset([
+    'References',
+    'PertinentNegatives',
+    'VariantProperties',
+    'AAC',
+    'dna-evidence',
+    'rna-evidence',
+    'biomarkers',
+    'non-human-content',
+    'quality-control'
+])
+
+# the classes below expose the small part of the minidom API the builders use (getElementsByTagName,
+# getAttribute, childNodes[0].nodeValue and NodeList.length) on top of xml.etree elements
+class foundationNodeList(list):
+    __slots__ = ()
+
+    @property
+    def length(self):
+        return len(self)
+
+class foundationStreamText:
+    __slots__ = ('nodeValue',)
+
+    def __init__(self, value):
+        self.nodeValue = value
+
+class foundationStreamElement:
+    __slots__ = ('element', 'tagName')
+    # like minidom, an element node has no value of its own
+    nodeValue = None
+
+    def __init__(self, element):
+        self.element = element
+        self.tagName = element.tag
+
+    @property
+    def childNodes(self):
+        if self.element.text is None:
+            return foundationNodeList()
+        return foundationNodeList([foundationStreamText(self.element.text)])
+
+    def getAttribute(self, attribute):
+        return self.element.get(attribute, '')
+
+    def getElementsByTagName(self, tagName):
+        return foundationNodeList([foundationStreamElement(element) for element in self.element.iter(tagName)
+                                   if element is not self.element])
+
+# per-document index built in a single walk. Maps every tag name to its nodes in document order and keeps
+# the text of the first node of each tag, so the builders never rescan the whole document.
+# It is passed to the builders in place of the DOM
+class foundationTagIndex:
+    def __init__(self):
+        self.documentElement = None
+        self.nodes = {}
+        self.firstText = {}
+
+    def addNode(self, tagName, node):
+        if tagName in self.nodes:
+            self.nodes[tagName].append(node)
+        else:
+            self.nodes[tagName] = foundationNodeList([node])
+
+    def getElementsByTagName(self, tagName):
+        if tagName in self.nodes:
+            return self.nodes[tagName]
+        return foundationNodeList()
+
+    # an element that is missing or empty (<MedFacilID/>) has no text
+    def getFirstText(self, tagName, default=''):
+        return self.firstText.get(tagName, default)
+
+# holds already encoded JSON in a temporary file instead of in memory. dumpFoundationBundle copies it into the
+# output, chunk by chunk, in place of the object
+class foundationSpooledJson:
+    def __init__(self):
+        import tempfile, uuid
+        self.spool = tempfile.TemporaryFile()
+        self.length = 0
+        # stands in for the spooled value in the encoded JSON until it is spliced back in
+        self.marker = b'"foundation-spooled-' + uuid.uuid4().hex.encode('ascii') + b'"'
+
+    def write(self, data):
+        self.spool.write(data)
+        self.length = self.length + len(data)
+
+    def readChunks(self, chunkSize=65536):
+        self.spool.seek(0)
+        chunk = self.spool.read(chunkSize)
+        while chunk:
+            yield chunk
+            chunk = self.spool.read(chunkSize)
+
+    def writeJsonTo(self, outfile, chunkSize=65536):
+        for chunk in self.readChunks(chunkSize):
+            outfile.write(chunk)
+
+    def close(self):
+        self.spool.close()
+
+# holds a large text payload (the base64 ReportPDF) so the whole payload never exists as a str. It is written
+# out as a JSON string
+class foundationSpooledText(foundationSpooledJson):
+    def write(self, text):
+        foundationSpooledJson.write(self, text.encode('utf-8'))
+
+    def writeJsonTo(self, outfile, chunkSize=65536):
+        import codecs
+        from json import encoder as jsonEncoder
+        # a chunk can end in the middle of a multi-byte character
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        outfile.write(b'"')
+        for chunk in self.readChunks(chunkSize):
+            outfile.write(jsonEncoder.encode_basestring_ascii(decoder.decode(chunk))[1:-1].encode('ascii'))
+        outfile.write(b'"')
+
+# expat target for the streaming backend. Builds a trimmed xml.etree tree and the tag index in the same pass,
+# never builds subtrees no builder reads, and optionally spools ReportPDF straight to a temporary file. The trimmed
+# tree is not freed section by section: the builders look elements up through the index, so all of it is kept
+# until the conversion is done. Spooling is what keeps the largest part of a report, the PDF, out of memory
+class foundationStreamTarget:
+    def __init__(self, spoolPDF):
+        from xml.etree import ElementTree as elementTree
+        self.builder = elementTree.TreeBuilder()
+        self.index = foundationTagIndex()
+        self.spoolPDF = spoolPDF
+        self.spooling = False
+        # > 0 while inside a subtree that is being skipped
+        self.unusedDepth = 0
+        # only text directly after a start tag is kept, text after a closing tag is never read
+        self.keepText = False
+
+    def start(self, tag, attrib):
+        # drop namespaces so tag names match the unprefixed names minidom reports (e.g. variant-report)
+        tag = tag.rpartition('}')[2]
+        self.keepText = False
+        self.spooling = False
+        if self.unusedDepth > 0 or tag in foundationUnusedTags:
+            self.unusedDepth = self.unusedDepth + 1
+            return
+        element = self.builder.start(tag, attrib)
+        # indexing on start keeps document order, same as minidom's getElementsByTagName
+        self.index.addNode(tag, foundationStreamElement(element))
+        if self.index.documentElement is None:
+            self.index.documentElement = foundationStreamElement(element)
+        if tag == 'ReportPDF' and self.spoolPDF and tag not in self.index.firstText:
+            self.index.firstText[tag] = foundationSpooledText()
+            self.spooling = True
+        else:
+            self.keepText = True
+
+    def data(self, text):
+        if self.spooling:
+            self.index.firstText['ReportPDF'].write(text)
+        elif self.keepText:
+            self.builder.data(text)
+
+    def end(self, tag):
+        self.keepText = False
+        self.spooling = False
+        if self.unusedDepth > 0:
+            self.unusedDepth = self.unusedDepth - 1
+            return
+        self.builder.end(tag.rpartition('}')[2])
+
+    def close(self):
+        return self.builder.close()
+
+def parseFoundationXmlStream(f, spoolPDF=False, chunkSize=65536):
+    from xml.etree import ElementTree as elementTree
+    target = foundationStreamTarget(spoolPDF)
+    parser = elementTree.XMLParser(target=target)
+    if hasattr(f, 'read'):
+        infile = f
+    else:
+        infile = open(f, 'rb')
+    try:
+        chunk = infile.read(chunkSize)
+        while chunk:
+            parser.feed(chunk)
+            chunk = infile.read(chunkSize)
+    finally:
+        if infile is not f:
+            infile.close()
+    parser.close()
+    index = target.index
+    for tagName in index.nodes:
+        if tagName in index.firstText:
+            continue
+        text = index.nodes[tagName][0].element.text
+        if text is not None:
+            index.firstText[tagName] = text
+    return index
+
+def buildFoundationTagIndex(DOM):
+    index = foundationTagIndex()
+    index.documentElement = DOM.documentElement
+    stack = [DOM.documentElement]
+    while len(stack) > 0:
+        node = stack.pop()
+        index.addNode(node.tagName, node)
+        # reversed so children are popped, and indexed, in document order
+        for child in reversed(node.childNodes):
+            if child.nodeType == child.ELEMENT_NODE:
+                stack.append(child)
+    for tagName in index.nodes:
+        childNodes = index.nodes[tagName][0].childNodes
+        if len(childNodes) > 0 and childNodes[0].nodeValue is not None:
+            index.firstText[tagName] = childNodes[0].nodeValue
+    return index
+
+# spoolPDF defaults to spooling when f is a path, so the PDF of a report read from disk is never held as a str.
+# Bundles built from a spooled index have to be written with dumpFoundationBundle
+def parseFoundationXml(f, backend='stream', spoolPDF=None):
+    if spoolPDF is None:
+        spoolPDF = not hasattr(f, 'read')
+    if backend == 'minidom':
+        from xml.dom import minidom as domParser
+        return buildFoundationTagIndex(domParser.parse(f))
+    return parseFoundationXmlStream(f, spoolPDF)
+
+# JSON encoders in order of preference. orjson and msgspec are optional and only used when installed
+foundationJsonBackends = ['orjson', 'msgspec', 'json']
+
+# encodes straight to UTF-8 bytes, compact (no whitespace at all) or pretty (indented by 2)
+class foundationJsonSerializer:
+    def __init__(self, backend=None, pretty=False):
+        import importlib
+        if backend is None:
+            for candidate in foundationJsonBackends:
+                try:
+                    importlib.import_module(candidate)
+                    backend = candidate
+                    break
+                except ImportError:
+                    continue
+        if backend not in foundationJsonBackends:
+            raise ValueError("Unknown JSON backend: " + str(backend))
+        self.backend = backend
+        self.pretty = pretty
+        if backend == 'msgspec':
+            self.module = importlib.import_module('msgspec.json')
+        else:
+            self.module = importlib.import_module(backend)
+
+    # default is called for objects the backend can not encode and returns something it can
+    def encode(self, o, default=None):
+        if self.backend == 'orjson':
+            if self.pretty:
+                return self.module.dumps(o, default=default, option=self.module.OPT_INDENT_2)
+            return self.module.dumps(o, default=default)
+        if self.backend == 'msgspec':
+            encoded = self.module.encode(o, enc_hook=default)
+            if self.pretty:
+                return self.module.format(encoded, indent=2)
+            return encoded
+        if self.pretty:
+            return self.module.dumps(o, default=default, ensure_ascii=False, indent=2).encode('utf-8')
+        return self.module.dumps(o, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+foundationJsonSerializers = {}
+
+def getFoundationJsonSerializer(backend=None, pretty=False):
+    if (backend, pretty) not in foundationJsonSerializers:
+        foundationJsonSerializers[(backend, pretty)] = foundationJsonSerializer(backend, pretty)
+    return foundationJsonSerializers[(backend, pretty)]
+
+# writes the bundle as JSON to a binary file. Spooled values are copied into the output from their temporary
+# files in place of the markers they are encoded as
+def dumpFoundationBundle(bundleResource, outfile, serializer=None):
+    if serializer is None:
+        serializer = getFoundationJsonSerializer()
+    spooled = {}
+
+    def encodeSpooled(o):
+        if isinstance(o, foundationSpooledJson):
+            spooled[o.marker] = o
+            return o.marker[1:-1].decode('ascii')
+        raise TypeError("Object of type " + type(o).__name__ + " is not JSON serializable")
+
+    encoded = serializer.encode(bundleResource, encodeSpooled)
+    if len(spooled) == 0:
+        outfile.write(encoded)
+        return
+    view = memoryview(encoded)
+    position = 0
+    while True:
+        found = [(encoded.find(marker, position), marker) for marker in spooled]
+        found = [(index, marker) for index, marker in found if index >= 0]
+        if len(found) == 0:
+            break
+        index, marker = min(found)
+        outfile.write(view[position:index])
+        spooled[marker].writeJsonTo(outfile)
+        position = index + len(marker)
+    outfile.write(view[position:])
 
 def hasNumber(inputString):
     return any(char.isdigit() for char in inputString)
 
+# a resource skeleton defined once. instantiate() copies the top level and gives each mutableField a fresh empty
+# copy; every other nested value is shared by all instances, so builders must replace those fields, never edit them
+class foundationResourceTemplate:
+    def __init__(self, skeleton, mutableFields=()):
+        self.skeleton = skeleton
+        self.mutableFields = mutableFields
+
+    def instantiate(self):
+        resource = self.skeleton.copy()
+        for field in self.mutableFields:
+            resource[field] = type(self.skeleton[field])()
+        return resource
+
 def addFoundationAsPerformer(resource):
     resource['performer'] = [{
         'reference': "Organization/FM",
@@ -16,16 +328,34 @@ def addFoundationReferenceWithField(resource, field):
         'display': "Foundation Medicine"
     }]
 
+# for the elements that take a single reference, like Sequence.performer and DocumentReference.custodian
+def addFoundationSingleReferenceWithField(resource, field):
+    resource[field] = {
+        'reference': "Organization/FM",
+        'display': "Foundation Medicine"
+    }
+
 def addPatientSubjectReference(resource, patientId, patientName):
     resource['subject'] = {
         'reference': "Patient/" + patientId,
         'display': patientName
     }
 
-def addRecordedTimeFromFoundation(resource, DOM):
-    resource['recorded'] = DOM.getElementsByTagName('ServerTime')[0].childNodes[0].nodeValue.replace(' ', 'T')
+def addRecordedTimeFromFoundation(resource, DOM, field='recorded'):
+    resource[field] = DOM.getFirstText('ServerTime').replace(' ', 'T')
+
+# numeric attributes are emitted as JSON numbers. A value that is not a number is kept as it is, for --validate to
+# report, rather than failing the whole report
+def foundationNumber(value, number=int):
+    try:
+        return number(value)
+    except ValueError:
+        return value
 
 class foundationFhirOrganization:
+    __slots__ = ('organizationResource',)
+    resourceType = "Organization"
+
     def __init__(self):
         self.organizationResource = {
                 'resourceType': "Organization",
@@ -34,7 +364,6 @@ class foundationFhirOrganization:
                     'div': ""
                 }
             }
-        self.resourceType = "Organization"
 
     def getOrganizationName(self):
         return self.organizationResource['name']
@@ -42,27 +371,27 @@ class foundationFhirOrganization:
     def getOrganizationId(self):
         return self.organizationResource['id']
 
-def createFoundationMedicineOrganization(FMorganization):
-    FMorganization['id'] = "FM"
-    FMorganization['identifier'] = [{
+foundationMedicineOrganizationTemplate = foundationResourceTemplate({
+    'id': "FM",
+    'identifier': [{
         'use': "official",
         'type': {
             'text': "CLIA identification number"
         },
         'system': "https://wwwn.cdc.gov/clia/Resources/LabSearch.aspx",
         'value': "22D2027531"
-    }]
-    FMorganization['active'] = True
-    FMorganization['type'] = {
+    }],
+    'active': True,
+    'type': {
         'coding': [{
             'system': "http://hl7.org/fhir/ValueSet/organization-type",
             'code': "prov",
             'display': "Genomic healthcare provider"
         }],
         'text': "Genomic healthcare provider"
-    }
-    FMorganization['name'] = "Foundation Medicine"
-    FMorganization['telecom'] = [
+    },
+    'name': "Foundation Medicine",
+    'telecom': [
         {
             'system': "phone",
             'value': "(+1) 617-418-2200"
@@ -75,8 +404,8 @@ def createFoundationMedicineOrganization(FMorganization):
             'system': "email",
             'value': "client.services@foundationmedicine.com"
         }
-    ]
-    FMorganization['address'] = [
+    ],
+    'address': [
         {
             'line': [
                 "150 Second Street"
@@ -87,21 +416,44 @@ def createFoundationMedicineOrganization(FMorganization):
             'country': "USA"
         }
     ]
+})
+
+def createFoundationMedicineOrganization(FMorganization):
+    FMorganization.update(foundationMedicineOrganizationTemplate.instantiate())
 
+# a report without the id falls back to one of its own, so the organization neither takes Foundation Medicine's id
+# (FM) nor is merged with another report's
 def organizationAddIdFromFoundation(organizationResource, foundationTag, DOM):
-    id = DOM.getElementsByTagName(foundationTag)[0].childNodes[0].nodeValue
+    id = DOM.getFirstText(foundationTag)
+    if id == '':
+        id = DOM.getFirstText('ReportId') + '-' + foundationTag + '-'
     id = id + 'FM'
     organizationResource['id'] = id
 
+# identifier systems. Foundation Medicine assigns the facility and ordering physician ids of its reports, so they are
+# named after their element in Foundation's results report namespace. An MRN is only unique at the facility that
+# issued it, so its system names that facility
+foundationIdentifierSystem = "http://foundationmedicine.com/compbio/resultsreport/"
+
+def foundationMrnSystem(facilityId):
+    from urllib.parse import quote
+    return foundationIdentifierSystem + "MedFacilID/" + quote(facilityId, safe='') + "/MRN"
+
 def organizationAddIdentifierFromFoundation(organizationResource, DOM):
+    if DOM.getFirstText('MedFacilID') == '':
+        return
     organizationResource['identifier'] = [{
-        'value': DOM.getElementsByTagName('MedFacilID')[0].childNodes[0].nodeValue
+        'system': foundationIdentifierSystem + "MedFacilID",
+        'value': DOM.getFirstText('MedFacilID')
     }]
 
 def organizationAddNameFromFoundation(organizationResource, DOM):
-    organizationResource['name'] = DOM.getElementsByTagName('MedFacilName')[0].childNodes[0].nodeValue
+    organizationResource['name'] = DOM.getFirstText('MedFacilName')
 
 class foundationFhirPractitioner:
+    __slots__ = ('practitionerResource',)
+    resourceType = "Practitioner"
+
     def __init__(self):
         self.practitionerResource = {
             'resourceType': "Practitioner",
@@ -110,7 +462,6 @@ class foundationFhirPractitioner:
                 'div': ""
             }
         }
-        self.resourceType = "Practitioner"
 
     def getPractitionerName(self):
         return self.practitionerResource['name'][0]['text']
@@ -118,11 +469,22 @@ class foundationFhirPractitioner:
     def getPractitionerId(self):
         return self.practitionerResource['id']
 
+# like organizationAddIdFromFoundation
 def practitionerAddIdFromFoundation(practitionerResource, foundationTag, DOM):
-    id = DOM.getElementsByTagName(foundationTag)[0].childNodes[0].nodeValue
+    id = DOM.getFirstText(foundationTag)
+    if id == '':
+        id = DOM.getFirstText('ReportId') + '-' + foundationTag + '-'
     id = id + 'FM'
     practitionerResource['id'] = id
 
+def practitionerAddIdentifierFromFoundation(practitionerResource, foundationTag, DOM):
+    if DOM.getFirstText(foundationTag) == '':
+        return
+    practitionerResource['identifier'] = [{
+        'system': foundationIdentifierSystem + foundationTag,
+        'value': DOM.getFirstText(foundationTag)
+    }]
+
 def practitionerAddRoleFromFoundation(practitionerResource, foundationTag, organization):
     if (foundationTag == 'OrderingMD'):
         code = '309295000'
@@ -149,7 +511,7 @@ def practitionerAddRoleFromFoundation(practitionerResource, foundationTag, organ
     }
 
 def practitionerAddNameFromFoundation(practitionerResource, foundationTag, DOM):
-    name = DOM.getElementsByTagName(foundationTag)[0].childNodes[0].nodeValue
+    name = DOM.getFirstText(foundationTag)
     if "," in name:
         name = name.split(', ')
         practitionerResource['name'] = [{}]
@@ -169,7 +531,16 @@ def practitionerAddNameFromFoundation(practitionerResource, foundationTag, DOM):
                                                   ' ' + practitionerResource['name'][0]['family'] + ', ' + \
                                                   ', '.join(practitionerResource['name'][0]['prefix'])
 
+# the id of a practitioner the reports only name. The whole name is used, not just the last name, so two doctors who
+# share a last name get different resources
+def foundationNameId(name):
+    import re
+    return re.sub(r'[^A-Za-z0-9]+', '-', name).strip('-')
+
 class foundationFhirPatient:
+    __slots__ = ('patientResource',)
+    resourceType = "Patient"
+
     def __init__(self):
         self.patientResource = {
             'resourceType': "Patient",
@@ -179,7 +550,6 @@ class foundationFhirPatient:
             },
             'deceasedBoolean': False
         }
-        self.resourceType = "Patient"
 
     def getPatientFullName(self):
         return self.patientResource['name'][0]['text']
@@ -196,9 +566,12 @@ class foundationFhirPatient:
     def getPatientId(self):
         return self.patientResource['id']
 
+# an MRN is only unique at the facility that issued it, so the facility is part of the id
 def patientAddIdFromFoundation(patientResource, DOM):
-    id = DOM.getElementsByTagName('MRN')[0].childNodes[0].nodeValue
+    id = DOM.getFirstText('MRN')
     id = id + 'FM'
+    if DOM.getFirstText('MedFacilID') != '':
+        id = DOM.getFirstText('MedFacilID') + '-' + id
     patientResource['id'] = id
 
 def patientAddIdentifierFromFoundation(patientResource, DOM):
@@ -210,25 +583,31 @@ def patientAddIdentifierFromFoundation(patientResource, DOM):
             'code': "MR"
         }]
     }
-    patientResource['identifier'][0]['value'] = DOM.getElementsByTagName('MRN')[0].childNodes[0].nodeValue
+    # without a facility id nothing says whose MRN it is
+    if DOM.getFirstText('MedFacilID') != '':
+        patientResource['identifier'][0]['system'] = foundationMrnSystem(DOM.getFirstText('MedFacilID'))
+    patientResource['identifier'][0]['value'] = DOM.getFirstText('MRN')
     patientResource['identifier'][0]['assigner'] = {
-        'display': DOM.getElementsByTagName('MedFacilName')[0].childNodes[0].nodeValue
+        'display': DOM.getFirstText('MedFacilName')
     }
 
 def patientAddBirthDateFromFoundation(patientResource, DOM):
-    patientResource['birthDate'] = DOM.getElementsByTagName('DOB')[0].childNodes[0].nodeValue
+    patientResource['birthDate'] = DOM.getFirstText('DOB')
 
 def patientAddGenderFromFoundation(patientResource, DOM):
-    patientResource['gender'] = DOM.getElementsByTagName('Gender')[0].childNodes[0].nodeValue.lower()
+    patientResource['gender'] = DOM.getFirstText('Gender').lower()
 
 def patientAddNameFromFoundation(patientResource, DOM):
     patientResource['name'] = [{}]
     patientResource['name'][0]['use'] = "official"
-    patientResource['name'][0]['given'] = [DOM.getElementsByTagName('FirstName')[0].childNodes[0].nodeValue]
-    patientResource['name'][0]['family'] = DOM.getElementsByTagName('LastName')[0].childNodes[0].nodeValue
+    patientResource['name'][0]['given'] = [DOM.getFirstText('FirstName')]
+    patientResource['name'][0]['family'] = DOM.getFirstText('LastName')
     patientResource['name'][0]['text'] = patientResource['name'][0]['given'][0] + " " + patientResource['name'][0]['family']
 
 class foundationFhirDiagnosticReport:
+    __slots__ = ('diagnosticReportResource',)
+    resourceType = "DiagnosticReport"
+
     def __init__(self):
         self.diagnosticReportResource = {
             'resourceType': "DiagnosticReport",
@@ -241,11 +620,6 @@ class foundationFhirDiagnosticReport:
                 'text': "FoundationOne"
             }
         }
-        self.observationsInReport = 0
-        self.resourceType = "DiagnosticReport"
-
-    def getObservationsInReportCount(self):
-        return self.observationsInReport
 
     def getReportDate(self):
         return self.diagnosticReportResource['effectiveDateTime']
@@ -265,9 +639,8 @@ class foundationFhirDiagnosticReport:
     def getDiagnosticReportTestPerformed(self):
         return self.diagnosticReportResource['category']['text']
 
-def diagnosticReportAddConclusionFromFoundation(diagnosticReport, DOM):
+def diagnosticReportAddConclusionFromFoundation(diagnosticReportResource, DOM):
     summary = DOM.getElementsByTagName('Summaries')[0]
-    genesDOM = DOM.getElementsByTagName('Genes')[0]
     alterationCount = int(summary.getAttribute('alterationCount'))
     sensitizingCount = int(summary.getAttribute('sensitizingCount'))
     resistiveCount = int(summary.getAttribute('resistiveCount'))
@@ -279,23 +652,30 @@ def diagnosticReportAddConclusionFromFoundation(diagnosticReport, DOM):
     except:
         statement = ""
 
-    diagnosticReport.diagnosticReportResource['conclusion'] = "Patient results: " + str(alterationCount) + \
+    diagnosticReportResource['conclusion'] = "Patient results: " + str(alterationCount) + \
     " genomic alterations | " + str(sensitizingCount) + " therapies associated with potential clinical benefit | " + \
     str(resistiveCount) + " therapies associated with lack of response | " + str(clinicalTrialCount) + " clinical trials. " + \
     statement
-    diagnosticReport.observationsInReport = len(genesDOM.getElementsByTagName('Gene')) + sensitizingCount + resistiveCount + clinicalTrialCount
 
 def diagnosticReportAddId(diagnosticReportResource, DOM):
-    diagnosticReportResource['id'] = DOM.getElementsByTagName('ReportId')[0].childNodes[0].nodeValue + "v" + \
-    DOM.getElementsByTagName('Version')[0].childNodes[0].nodeValue
+    diagnosticReportResource['id'] = DOM.getFirstText('ReportId') + "v" + \
+    DOM.getFirstText('Version')
 
 def diagnosticReportAddCategoryFromFoundation(diagnosticReportResource, DOM):
     diagnosticReportResource['category'] = {
-        'text': DOM.getElementsByTagName('TestType')[0].childNodes[0].nodeValue + " test by Foundation Medicine"
+        'text': DOM.getFirstText('TestType') + " test by Foundation Medicine"
     }
 
+def diagnosticReportAddFoundationAsPerformer(diagnosticReportResource):
+    diagnosticReportResource['performer'] = [{
+        'actor': {
+            'reference': "Organization/FM",
+            'display': "Foundation Medicine"
+        }
+    }]
+
 def diagnosticReportAddEffectiveDateTimeFromFoundation(diagnosticReportResource, DOM):
-    diagnosticReportResource['effectiveDateTime'] = DOM.getElementsByTagName('CollDate')[0].childNodes[0].nodeValue
+    diagnosticReportResource['effectiveDateTime'] = DOM.getFirstText('CollDate')
 
 def addSpecimenReference(resource, specimenId, specimenType):
     resource['specimen'] = [{
@@ -319,30 +699,34 @@ def diagnosticReportAddContainedArr(diagnosticReportResource, observationArr, sp
         diagnosticReportResource['contained'].append(observationArr[i].observationResource)
     diagnosticReportResource['contained'].append(specimen.specimenResource)
 
+observationTemplate = foundationResourceTemplate({
+    'resourceType': "Observation",
+    'text': {
+        'status': "generated",
+        'div': ""
+    },
+    'status': "final",
+    'category': [{
+        'coding': [{
+            'system': "http://hl7.org/fhir/observation-category",
+            'code': "laboratory"
+        }],
+        'text': "Laboratory result generated by Foundation Medicine"
+    }],
+    # extension is where all of the genomic fields of the observation will be stored
+    'extension': [],
+    'performer': [{
+        'reference': "Organization/FM",
+        'display': "Foundation Medicine"
+    }]
+}, mutableFields=('extension',))
+
 class foundationFhirObservation:
+    __slots__ = ('observationResource', 'related', 'display', 'relatedReportId')
+    resourceType = "Observation"
+
     def __init__(self):
-        self.observationResource = {
-            'resourceType': "Observation",
-            'text': {
-                'status': "generated",
-                'div': ""
-            },
-            'status': "final",
-            'category': [{
-                'coding': [{
-                    'system': "http://hl7.org/fhir/observation-category",
-                    'code': "laboratory"
-                }],
-                'text': "Laboratory result generated by Foundation Medicine"
-            }],
-            # extension is where all of the genomic fields of the observation will be stored
-            'extension': [],
-            'performer': [{
-                'reference': "Organization/FM",
-                'display': "Foundation Medicine"
-            }]
-        }
-        self.resourceType = "Observation"
+        self.observationResource = observationTemplate.instantiate()
         self.related = []
         self.display = ""
         self.relatedReportId = ""
@@ -356,16 +740,6 @@ class foundationFhirObservation:
     def getDisplayString(self):
         return self.display
 
-def initObservations(observationArr, nObservations):
-    for i in range(0, nObservations, 1):
-        observationArr.append(foundationFhirObservation())
-
-def addReportIdToObservationObj(observationArr, reportId):
-    l = len(observationArr)
-    for i in range(0, l, 1):
-        observationArr[i].relatedReportId = str(reportId)
-
-
 def observationAddReferenceToSpecimen(observationResource, specimenId, specimenType):
     observationResource['specimen'] = {
         'reference': "Specimen/" + specimenId,
@@ -373,39 +747,47 @@ def observationAddReferenceToSpecimen(observationResource, specimenId, specimenT
     }
 
 
-def observationAddGeneticsInterpretation(observationArr, interpretation, tracker):
-    observationArr[tracker['value']].observationResource['extension'].append({
+def observationAddGeneticsInterpretation(observationResource, interpretation):
+    observationResource['extension'].append({
         'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsInterpretation",
         'valueCodeableConcept': {
             'text': interpretation
         }
     })
 
-def observationAddSequenceVariantTypeFromFoundation(observationArr, alteration, tracker):
-    observationArr[tracker['value']].observationResource['extension'].append({
+def observationAddSequenceVariantTypeFromFoundation(observationResource, alteration):
+    observationResource['extension'].append({
         'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsDNASequenceVariantType",
         'valueCodeableConcept': {
             'text': alteration
         }
     })
 
-def observationAddAminoAcidChangeFromFoundation(observationArr, alteration, tracker):
-    observationArr[tracker['value']].observationResource['extension'].append({
+def observationAddAminoAcidChangeFromFoundation(observationResource, alteration):
+    observationResource['extension'].append({
         'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsAminoAcidChangeName",
         'valueCodeableConcept': {
             'text': alteration
         }
     })
 
-def addRelatedArtifacts(reference, observationExtension):
-    referenceId = reference.getAttribute('referenceId')
-    url = "https://www.ncbi.nlm.nih.gov/pubmed/" + referenceId
-    observationExtension.append({
+# the same few thousand PubMed references are cited across every report, so the URL of each is built once per process
+# and batch workers keep the cache between reports. Only the immutable string is shared: every observation gets dicts
+# of its own, which callers of convert_file may edit
+@functools.lru_cache(maxsize=8192)
+def foundationRelatedArtifactUrl(referenceId):
+    return "https://www.ncbi.nlm.nih.gov/pubmed/" + referenceId
+
+def foundationRelatedArtifact(referenceId):
+    return {
         'url': "http://hl7.org/fhir/StructureDefinition/observation-relatedPubMedArtifact",
         'valueCodeableConcept': {
-            'text': url
+            'text': foundationRelatedArtifactUrl(referenceId)
         }
-    })
+    }
+
+def addRelatedArtifacts(reference, observationExtension):
+    observationExtension.append(foundationRelatedArtifact(reference.getAttribute('referenceId')))
 
 def geneGrabRelatedArtifactsReferenceId(geneDOM, observationExtension):
     nTherapyReferenceLinks = geneDOM.getElementsByTagName('Therapy').length
@@ -421,27 +803,58 @@ def therapyGrabRelatedArtifactsReferenceId(therapyDOM, observationExtension):
     for i in range(0, l, 1):
         addRelatedArtifacts(references[i], observationExtension)
 
-def extractRelatedTherapies(observationArr, geneDOM, gene, tracker, therapiesUsed, therapyDict, geneIndex):
+# links the genomic alteration, therapy and clinical trial observations of a report. observations are registered under
+# their gene name, therapy name or trial title so every lookup is a dict hit, and edges are only recorded while the
+# report is read; relate() turns them into 'related' entries in one pass once every observation has its id
+class foundationObservationLinks:
+    __slots__ = ('genes', 'therapies', 'trials', 'observations', 'edges')
+
+    def __init__(self):
+        self.genes = {}
+        self.therapies = {}
+        self.trials = {}
+        self.observations = []
+        self.edges = []
+
+    def addGene(self, gene, observation):
+        self.genes[gene] = observation
+        self.observations.append(observation)
+
+    def addTherapy(self, therapy, observation):
+        self.therapies[therapy] = observation
+        self.observations.append(observation)
+
+    def addTrial(self, title, observation):
+        self.trials[title] = observation
+        self.observations.append(observation)
+
+    def link(self, source, target, display, linkType=None):
+        self.edges.append((source, target, display, linkType))
+
+    def relate(self):
+        for source, target, display, linkType in self.edges:
+            related = {}
+            if linkType is not None:
+                related['type'] = linkType
+            related['target'] = {
+                'reference': "Observation/" + target.getObservationId(),
+                'display': display
+            }
+            source.related.append(related)
+        # FHIR has no empty arrays, and trials and therapies without references have no extensions
+        for observation in self.observations:
+            if len(observation.related) > 0:
+                observation.observationResource['related'] = observation.related
+            if len(observation.observationResource['extension']) == 0:
+                del observation.observationResource['extension']
+
+def extractRelatedTherapies(observationArr, geneDOM, gene, geneObservation, links):
     therapyDOMs = geneDOM.getElementsByTagName('Therapy')
     l = len(therapyDOMs)
-    therapyNumber = 1
     for i in range(0, l, 1):
         therapy = therapyDOMs[i].getElementsByTagName('Name')[0].childNodes[0].nodeValue
-        if(therapy in therapiesUsed):
-            observationArr[int(geneIndex['value'])].related.append({
-                'target': {
-                    'reference': "Observation/" + observationArr[therapyDict[therapy]].observationResource['id'],
-                    'display': observationArr[therapyDict[therapy]].display
-                }
-            })
-            observationArr[therapyDict[therapy]].related.append({
-                'type': "derived-from",
-                'target': {
-                    'reference': "Observation/" + observationArr[int(geneIndex['value'])].observationResource['id'],
-                    'display': "Mutation in " + gene
-                }
-            })
-        else:
+        therapyObservation = links.therapies.get(therapy)
+        if therapyObservation is None:
             if (therapyDOMs[i].getElementsByTagName('Effect')[0].childNodes[0].nodeValue.lower() == 'sensitizing'):
                 display = therapy + " is a therapy associated with potential clinical benefit"
                 string = display + ". " + "This therapy was observed as a potential treatment for the patient due to their mutation in " + \
@@ -451,42 +864,28 @@ def extractRelatedTherapies(observationArr, geneDOM, gene, tracker, therapiesUse
                 string = display + "This therapy was observed as a potential treatment for the patient due to their mutation in " + \
                 gene + ". FDA Approved: " + therapyDOMs[i].getElementsByTagName('FDAApproved')[0].childNodes[0].nodeValue
 
-            observationArr[tracker['value']].observationResource['id'] = observationArr[tracker['value']].relatedReportId + "-therapy-" + str(therapyNumber)
-            therapyNumber = therapyNumber + 1
-            observationArr[tracker['value']].observationResource['valueString'] = string
-            observationArr[tracker['value']].observationResource['comment'] = therapyDOMs[i].getElementsByTagName('Rationale')[0].childNodes[0].nodeValue
-            observationArr[tracker['value']].related = [{
-                'type': "derived-from",
-                'target': {
-                    'reference': "Observation/" + observationArr[tracker['value'] - (i + 1)].observationResource['id'],
-                    'display': "Mutation in " + gene
-                }
-            }]
-            observationArr[tracker['value'] - (i + 1)].related.append({
-                'target': {
-                    'reference': "Observation/" + observationArr[tracker['value']].observationResource['id'],
-                    'display': display
-                }
-            })
-            observationArr[tracker['value']].display = display
-            therapyDict[therapy] = int(tracker['value'])
-            therapiesUsed.append(therapy)
-            therapyGrabRelatedArtifactsReferenceId(therapyDOMs[i], observationArr[tracker['value']].observationResource['extension'])
-            tracker['value'] = tracker['value'] + 1
-
-def extractGenomicInfoInOrder(observationArr, genesDOM, genes, specimenId, specimenType, tracker):
+            therapyObservation = foundationFhirObservation()
+            therapyObservation.relatedReportId = geneObservation.relatedReportId
+            # therapies are numbered across the whole report so the same number is never handed out twice
+            therapyObservation.observationResource['id'] = therapyObservation.relatedReportId + "-therapy-" + str(len(links.therapies) + 1)
+            therapyObservation.observationResource['valueString'] = string
+            therapyObservation.observationResource['comment'] = therapyDOMs[i].getElementsByTagName('Rationale')[0].childNodes[0].nodeValue
+            therapyObservation.display = display
+            therapyGrabRelatedArtifactsReferenceId(therapyDOMs[i], therapyObservation.observationResource['extension'])
+            links.addTherapy(therapy, therapyObservation)
+            observationArr.append(therapyObservation)
+        links.link(geneObservation, therapyObservation, therapyObservation.display)
+        links.link(therapyObservation, geneObservation, "Mutation in " + gene, "derived-from")
+
+def extractGenomicInfoInOrder(observationArr, genesDOM, links, specimenId, specimenType, reportId):
     geneDOMs = genesDOM.getElementsByTagName('Gene')
-    # keep track of what index the genes are in the observation array to relate them to their suggested clinical trials
     l = len(geneDOMs)
-    # same therapy can be applied to > 1 genomic alteration
-    therapies = []
-    therapyDict = {}
     for i in range(0, l, 1):
         gene = geneDOMs[i].getElementsByTagName('Name')[0].childNodes[0].nodeValue
-        genes[gene + '-idNumber'] = str((i + 1))
-        genes[gene + '-trackerNumber'] = tracker['value']
-        observationArr[tracker['value']].observationResource['id'] = observationArr[tracker['value']].relatedReportId + "-gene-alt-" + str((i + 1))
-        observationArr[tracker['value']].observationResource['extension'].append({
+        observation = foundationFhirObservation()
+        observation.relatedReportId = reportId
+        observation.observationResource['id'] = reportId + "-gene-alt-" + str((i + 1))
+        observation.observationResource['extension'].append({
             'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsGene",
             'valueCodeableConcept': {
                 'coding': [{
@@ -499,44 +898,27 @@ def extractGenomicInfoInOrder(observationArr, genesDOM, genes, specimenId, speci
         alterationDOM = geneDOMs[i].getElementsByTagName('Alteration')
         alteration = alterationDOM[0].getElementsByTagName('Name')[0].childNodes[0].nodeValue
         if (hasNumber(alteration) is True):
-            observationAddAminoAcidChangeFromFoundation(observationArr, alteration, tracker)
+            observationAddAminoAcidChangeFromFoundation(observation.observationResource, alteration)
         else:
-            observationAddSequenceVariantTypeFromFoundation(observationArr, alteration, tracker)
-        observationAddGeneticsInterpretation(observationArr, alterationDOM[0].getElementsByTagName('Interpretation')[0].childNodes[0].nodeValue, tracker)
-        observationAddReferenceToSpecimen(observationArr[tracker['value']].observationResource, specimenId, specimenType)
-        observationArr[tracker['value']].observationResource['related'] = []
-        observationArr[tracker['value']].display = 'A genomic alteration in ' + gene
-        geneGrabRelatedArtifactsReferenceId(geneDOMs[i], observationArr[tracker['value']].observationResource['extension'])
-        geneIndex = copy.deepcopy(tracker)
-        tracker['value'] = tracker['value'] + 1
+            observationAddSequenceVariantTypeFromFoundation(observation.observationResource, alteration)
+        observationAddGeneticsInterpretation(observation.observationResource, alterationDOM[0].getElementsByTagName('Interpretation')[0].childNodes[0].nodeValue)
+        observationAddReferenceToSpecimen(observation.observationResource, specimenId, specimenType)
+        observation.display = 'A genomic alteration in ' + gene
+        geneGrabRelatedArtifactsReferenceId(geneDOMs[i], observation.observationResource['extension'])
+        # the gene is registered before its therapies so clinical trials can find it by name later
+        links.addGene(gene, observation)
+        observationArr.append(observation)
         # TODO: think about if we also want to pass in the alteration with the gene, instead of just the gene (for display of reference)
-        extractRelatedTherapies(observationArr, geneDOMs[i], gene, tracker, therapies, therapyDict, geneIndex)
+        extractRelatedTherapies(observationArr, geneDOMs[i], gene, observation, links)
 
-def extractRelatedClinicalTrials(observationArr, trialsDOM, genes, tracker):
-    usedTrials = []
-    trialsDict = {}
+def extractRelatedClinicalTrials(observationArr, trialsDOM, links, reportId):
     trialDOMs = trialsDOM.getElementsByTagName('Trial')
-    trialNumber = 1
     l = len(trialDOMs)
     for i in range(0, l, 1):
         title = trialDOMs[i].getElementsByTagName('Title')[0].childNodes[0].nodeValue
         relatedGene = trialDOMs[i].getElementsByTagName('Gene')[0].childNodes[0].nodeValue
-        if(title in usedTrials):
-            observationArr[genes[relatedGene + "-trackerNumber"]].related.append({
-                'target': {
-                    'reference': "Observation/" + observationArr[trialsDict[title]].observationResource['id'],
-                    'display': "A clinical trial suggested as a result of the genomic alteration"
-                }
-            })
-            observationArr[trialsDict[title]].related.append({
-                'type': "derived-from",
-                'target': {
-                    'reference': "Observation/" + observationArr[trialsDict[title]].relatedReportId + "-gene-alt-" +
-                                 genes[relatedGene + "-idNumber"],
-                    'display': "Mutation in " + relatedGene
-                }
-            })
-        else:
+        trialObservation = links.trials.get(title)
+        if trialObservation is None:
             display = "A clinical trial option suggested as a result of the genomic alterations found in patient"
             string = display + ". The title of the trial is " + title + \
             ". This is a " + trialDOMs[i].getElementsByTagName('StudyPhase')[0].childNodes[0].nodeValue + " clinical trial study. " + \
@@ -544,35 +926,27 @@ def extractRelatedClinicalTrials(observationArr, trialsDOM, genes, tracker):
             ". The locations this clinical trial is available in are: " + \
             trialDOMs[i].getElementsByTagName('Locations')[0].childNodes[0].nodeValue + ". The NCT ID for this trial is: " + \
             trialDOMs[i].getElementsByTagName('NCTID')[0].childNodes[0].nodeValue
-            observationArr[tracker['value']].observationResource['id'] = observationArr[tracker['value']].relatedReportId + "-trial-" + str(trialNumber)
-            trialNumber = trialNumber + 1
-            observationArr[tracker['value']].observationResource['valueString'] = string
-            observationArr[tracker['value']].observationResource['comment'] = trialDOMs[i].getElementsByTagName('Note')[0].childNodes[0].nodeValue
-            observationArr[tracker['value']].related = [{
-            'type': "derived-from",
-            'target': {
-                'reference': "Observation/" + observationArr[tracker['value']].relatedReportId + "-gene-alt-" + genes[relatedGene + "-idNumber"],
-                'display': "Mutation in " + relatedGene
-            }
-            }]
-            observationArr[genes[relatedGene + "-trackerNumber"]].related.append({
-            'target': {
-                'reference': "Observation/" + observationArr[tracker['value']].observationResource['id'],
-                'display': "A clinical trial suggested as a result of the genomic alteration"
-            }
-            })
-            observationArr[tracker['value']].display = display
-            trialsDict[title] = int(tracker['value'])
-            usedTrials.append(title)
-            tracker['value'] = tracker['value'] + 1
-
-
-def observationAddGenomicInfoFromFoundation(observationArr, specimenId, specimenType, DOM):
+            trialObservation = foundationFhirObservation()
+            trialObservation.relatedReportId = reportId
+            trialObservation.observationResource['id'] = reportId + "-trial-" + str(len(links.trials) + 1)
+            trialObservation.observationResource['valueString'] = string
+            trialObservation.observationResource['comment'] = trialDOMs[i].getElementsByTagName('Note')[0].childNodes[0].nodeValue
+            trialObservation.display = display
+            links.addTrial(title, trialObservation)
+            observationArr.append(trialObservation)
+        geneObservation = links.genes.get(relatedGene)
+        # a trial can name a gene that has no alteration in the report; it is kept, but left unlinked
+        if geneObservation is not None:
+            links.link(geneObservation, trialObservation, "A clinical trial suggested as a result of the genomic alteration")
+            links.link(trialObservation, geneObservation, "Mutation in " + relatedGene, "derived-from")
+
+
+def observationAddGenomicInfoFromFoundation(observationArr, specimenId, specimenType, reportId, DOM):
     genesDOM = DOM.getElementsByTagName('Genes')[0]
-    trackerObj = {'value': 0}
-    genes = {}
-    extractGenomicInfoInOrder(observationArr, genesDOM, genes, specimenId, specimenType, trackerObj)
-    extractRelatedClinicalTrials(observationArr, DOM, genes, trackerObj)
+    links = foundationObservationLinks()
+    extractGenomicInfoInOrder(observationArr, genesDOM, links, specimenId, specimenType, reportId)
+    extractRelatedClinicalTrials(observationArr, DOM, links, reportId)
+    links.relate()
 
 def addPatientSubjectReferenceToObservations(observationArr, patientId, patientName):
     l = len(observationArr)
@@ -591,35 +965,34 @@ def singleObservationAddDateTimeFromFoundation(observationResource, date):
     observationResource['effectiveDateTime'] = date
 
 
-def relateObservations(observationArr):
-    l = len(observationArr)
-    for i in range(0, l, 1):
-        observationArr[i].observationResource['related'] = observationArr[i].related
+conditionTemplate = foundationResourceTemplate({
+    'resourceType': "Condition",
+    'text': {
+        'status': "generated",
+        'div': ""
+    },
+    'verificationStatus': "confirmed",
+    'category': [{
+        'coding': [{
+            'system': "http://hl7.org/fhir/condition-category",
+            'code': "encounter-diagnosis"
+        }]
+    }],
+    'severity': {
+        'coding': [{
+            'system': "http://snomed.info/sct",
+            'code': "24484000",
+            'display': "Severe"
+        }]
+    }
+})
 
 class foundationFhirCondition():
+    __slots__ = ('conditionResource',)
+    resourceType = "Condition"
+
     def __init__(self):
-        self.conditionResource = {
-            'resourceType': "Condition",
-            'text': {
-                'status': "generated",
-                'div': ""
-            },
-            'verificationStatus': "confirmed",
-            'category': [{
-                'coding': [{
-                    'system': "http://hl7.org/fhir/condition-category",
-                    'code': "encounter-diagnosis"
-                }]
-            }],
-            'severity': {
-                'coding': [{
-                    'system': "http://snomed.info/sct",
-                    'code': "24484000",
-                    'display': "Severe"
-                }]
-            }
-        }
-        self.resourceType = "Condition"
+        self.conditionResource = conditionTemplate.instantiate()
 
     def getCondition(self):
         return self.conditionResource['code']['text']
@@ -644,7 +1017,7 @@ def conditionAddId(conditionResource, patientId):
 
 def conditionAddCodeFromFoundation(conditionResource, DOM):
     conditionResource['code'] = {
-        'text': DOM.getElementsByTagName('SubmittedDiagnosis')[0].childNodes[0].nodeValue
+        'text': DOM.getFirstText('SubmittedDiagnosis')
     }
 
 def conditionAddBodySiteFromFoundation(conditionResource, DOM):
@@ -656,11 +1029,14 @@ def conditionAddEvidenceDetailReference(conditionResource, diagnosticReportId, D
     conditionResource['evidence'] = [{}]
     conditionResource['evidence'][0]['detail'] = [{
         'reference': "DiagnosticReport/" + diagnosticReportId,
-        'display': "A " + DOM.getElementsByTagName('TestType')[0].childNodes[0].nodeValue + " test performed on " +
-                 DOM.getElementsByTagName('CollDate')[0].childNodes[0].nodeValue + " by Foundation Medicine"
+        'display': "A " + DOM.getFirstText('TestType') + " test performed on " +
+                 DOM.getFirstText('CollDate') + " by Foundation Medicine"
     }]
 
 class foundationFhirDocumentReference:
+    __slots__ = ('documentReferenceResource',)
+    resourceType = "DocumentReference"
+
     def __init__(self):
         self.documentReferenceResource = {
             'resourceType': "DocumentReference",
@@ -675,10 +1051,72 @@ def documentReferenceAddBase64EncodingOfPDFFromFoundation(documentReferenceResou
 		documentReferenceResource['content'] = [{
 			'attachment': {
 				'contentType': "base64",
-				'data': DOM.getElementsByTagName('ReportPDF')[0].nodeValue
+				'data': DOM.getFirstText('ReportPDF')
 			}
 		}]
 
+# the text as UTF-8 byte chunks, whether it is spooled or a str
+def readTextChunks(text, chunkSize=65536):
+    if isinstance(text, foundationSpooledText):
+        return text.readChunks(chunkSize)
+    return (text[i:i + chunkSize].encode('utf-8') for i in range(0, len(text), chunkSize))
+
+def decodeBase64Chunks(chunks):
+    import base64
+    pending = b''
+    for chunk in chunks:
+        pending = pending + b''.join(chunk.split())
+        # only whole 4 character groups can be decoded on their own
+        usable = len(pending) - len(pending) % 4
+        if usable > 0:
+            yield base64.b64decode(pending[:usable])
+            pending = pending[usable:]
+    if len(pending) > 0:
+        yield base64.b64decode(pending)
+
+# writes the decoded PDF once into a content-addressed directory (<sha256[:2]>/<sha256>.pdf) and returns the
+# attachment that points at it. Amended versions of a report usually carry the same PDF and share one blob
+def storeFoundationPDF(pdf, blobDirectory):
+    import base64, hashlib, threading
+    sha256 = hashlib.sha256()
+    # DSTU3 defines Attachment.hash as the base64 SHA-1 of the data
+    sha1 = hashlib.sha1()
+    size = 0
+    os.makedirs(blobDirectory, exist_ok=True)
+    # like the bundles, not mkstemp, which would leave the blob readable by its owner only. Its final name is only
+    # known once it is hashed, so the temporary name is unique per process and thread instead
+    tempPath = os.path.join(blobDirectory, '.%d.%d.pdf.tmp' % (os.getpid(), threading.get_ident()))
+    try:
+        with open(tempPath, 'wb') as blob:
+            for data in decodeBase64Chunks(readTextChunks(pdf)):
+                sha256.update(data)
+                sha1.update(data)
+                size = size + len(data)
+                blob.write(data)
+        digest = sha256.hexdigest()
+        blobPath = os.path.join(blobDirectory, digest[:2], digest + '.pdf')
+        if os.path.exists(blobPath):
+            os.remove(tempPath)
+        else:
+            os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+            os.replace(tempPath, blobPath)
+    except:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+    return {
+        'contentType': "application/pdf",
+        'url': "file://" + os.path.abspath(blobPath),
+        'size': size,
+        'hash': base64.b64encode(sha1.digest()).decode('ascii')
+    }
+
+def documentReferenceAddPDFAttachmentFromFoundation(documentReferenceResource, DOM, blobDirectory):
+    if (len(DOM.getElementsByTagName('ReportPDF')) > 0):
+        documentReferenceResource['content'] = [{
+            'attachment': storeFoundationPDF(DOM.getFirstText('ReportPDF'), blobDirectory)
+        }]
+
 def documentReferenceAddClinicalContextFromFoundation(documentReferenceResource, patient, diagnosticReport):
     documentReferenceResource['context'] = {
         'period': {
@@ -698,13 +1136,15 @@ def documentReferenceAddClinicalContextFromFoundation(documentReferenceResource,
     }
 
 class foundationFhirProcedureRequest:
+    __slots__ = ('procedureRequestResource',)
+    resourceType = "ProcedureRequest"
+
     def __init__(self):
         self.procedureRequestResource = {
             'resourceType': "ProcedureRequest",
             'status': "completed",
             'intent': "order"
         }
-        self.resourceType = "ProcedureRequest"
 
     def getProcedureRequestId(self):
         return self.procedureRequestResource['id']
@@ -739,13 +1179,15 @@ def procedureRequestAddreasonReference(procedureRequestResource, conditionId, co
     }]
 
 class foundationFhirSpecimen:
+    __slots__ = ('specimenResource',)
+    resourceType = "Specimen"
+
     def __init__(self):
         self.specimenResource = {
             'resourceType': "Specimen",
             'status': "available",
             'collection': {}
         }
-        self.resourceType = "Specimen"
 
     def getSpecimenType(self):
         return self.specimenResource['type']['text']
@@ -763,7 +1205,7 @@ class foundationFhirSpecimen:
         return self.specimenResource['collection']['collector']['display']
 
 def specimenAddId(specimenResource, DOM):
-    specimenResource['id'] = DOM.getElementsByTagName('SampleId')[0].childNodes[0].nodeValue
+    specimenResource['id'] = DOM.getFirstText('SampleId')
 
 # pathologist doesn't have actual ID
 def specimenAddPathologistAsCollector(specimenResource, pathologistID, pathologistName):
@@ -780,15 +1222,14 @@ def specimenAddNoteFromFoundation(specimenResource, DOM):
         statement = ""
     specimenResource['note'] = [{
         'authorString': "Foundation Medicine",
-        'time': DOM.getElementsByTagName('CollDate')[0].childNodes[0].nodeValue,
+        'time': DOM.getFirstText('CollDate'),
         'text': statement
     }]
 
 def specimenAddCollectionInfoFromFoundation(specimenResource, DOM):
-    specimenResource['collection']['collectedDateTime'] = DOM.getElementsByTagName('CollDate')[0].childNodes[0].nodeValue
+    specimenResource['collection']['collectedDateTime'] = DOM.getFirstText('CollDate')
     specimenResource['collection']['bodySite'] = {
-        'coding': [],
-        'text': DOM.getElementsByTagName('SpecSite')[0].childNodes[0].nodeValue
+        'text': DOM.getFirstText('SpecSite')
     }
 
 def specimenAddRequestReference(specimenResource, resourceID, resourceText):
@@ -798,21 +1239,22 @@ def specimenAddRequestReference(specimenResource, resourceID, resourceText):
     }]
 
 def specimenAddReceivedTimeFromFoundation(specimenResource, DOM):
-    specimenResource['receivedTime'] = DOM.getElementsByTagName('ReceivedDate')[0].childNodes[0].nodeValue
+    specimenResource['receivedTime'] = DOM.getFirstText('ReceivedDate')
 
 def specimenAddTypeFromFoundation(specimenResource, DOM):
     specimenResource['type'] = {
-        'coding': [],
-        'text': DOM.getElementsByTagName('SpecFormat')[0].childNodes[0].nodeValue + " from " +
-              DOM.getElementsByTagName('SpecSite')[0].childNodes[0].nodeValue
+        'text': DOM.getFirstText('SpecFormat') + " from " +
+              DOM.getFirstText('SpecSite')
     }
 
 class foundationFhirSequence:
+    __slots__ = ('sequenceResource',)
+    resourceType = "Sequence"
+
     def __init__(self):
         self.sequenceResource = {
             'resourceType': "Sequence"
         }
-        self.resourceType = "Sequence"
 
     def getSequenceId(self):
         return self.sequenceResource['id']
@@ -821,11 +1263,10 @@ def sequenceAddTypeFromFoundation(sequenceResource, nucleicAcidType):
     sequenceResource['type'] = nucleicAcidType
 
 
-def sequenceAddRefSeqChromosome(sequenceResource, element):
-    sequenceResource['referenceSeq'] = {
-        'chromosome': {
-            'text': element.getAttribute('position').split(':')[0]
-        }
+def sequenceAddPatientReference(sequenceResource, patientId, patientName):
+    sequenceResource['patient'] = {
+        'reference': "Patient/" + patientId,
+        'display': patientName
     }
 
 def sequenceAddReferenceToSpecimen(sequenceResource, specimenId, specimenType):
@@ -834,14 +1275,6 @@ def sequenceAddReferenceToSpecimen(sequenceResource, specimenId, specimenType):
         'display': specimenType
     }
 
-def variantReportAddGeneNameFromFoundation(observationResource, element):
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsGene",
-        'valueCodeableConcept': {
-            'text': element.getAttribute('gene')
-        }
-    })
-
 def variantReportAddReferenceToSequence(observationResource, sequenceId):
     observationResource['extension'].append({
         'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsSequence",
@@ -851,243 +1284,53 @@ def variantReportAddReferenceToSequence(observationResource, sequenceId):
         }
     })
 
-def variantReportAddSequenceVariantType(observationResource, element):
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsDNASequenceVariantType",
-        'valueCodeableConcept': {
-            'text': element.getAttribute('type')
-        }
-    })
-
-def sequenceAddShortVariantId(sequenceResource, reportId, variantNumber):
-    sequenceResource['id'] = reportId + "-short-variant-" + str(variantNumber) + "-seq"
-
-def sequenceShortVariantAddVariantFromFoundation(sequenceResource, shortVariant, observationId):
-    position = shortVariant.getAttribute('position').split(':')[1]
-    variant = shortVariant.getAttribute('cds-effect')
-    if('>' in variant):
-        variant = ''.join([i for i in variant if not i.isdigit() and not i.islower()]).split('>')
-    elif ('<' in variant):
-        variant = ''.join([i for i in variant if not i.isdigit() and not i.islower()]).split('<')
-    elif ('ins' in variant):
-        variant = [''.join([i for i in variant if not i.isdigit() and not i.islower()]).split('_')[1], '_']
-    elif ('del' in variant):
-        variant = ['_', ''.join([i for i in variant if not i.isdigit() and not i.islower()]).split('_')[1]]
-
-    sequenceResource['variant'] = [{
-        'start': position,
-        'end': position,
-        'observedAllele': variant[0],
-        'referenceAllele': variant[1],
-        'variantPointer': {
-            'reference': "Observation/" + observationId,
-            'display': "Genetic observation that contains information on this variant"
-        }
-    }]
-
-
-def sequenceShortVariantAddCoverageFromFoundation(sequenceResource, shortVariant):
-    sequenceResource['readCoverage'] = shortVariant.getAttribute('depth')
-
-def addShortVariantId(observationResource, reportId, variantNumber):
-    observationResource['id'] = reportId + "-short-variant-" + str(variantNumber)
-
-def addShortVariantAminoAcidTypeFromFoundation(observationResource, shortVariant):
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsAminoAcidChangeType",
-        'valueCodeableConcept': {
-            'text': shortVariant.getAttribute('functional-effect')
-        }
-    })
-
-def addShortVariantDnaSequenceVariantName(observationResource, shortVariant):
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsDNASequenceVariantName",
-        'valueCodeableConcept': {
-            'text': shortVariant.getAttribute('cds-effect')
-        }
-    })
-
-def addShortVariantDnaSequenceVariantType(observationResource, shortVariant):
-    variant = shortVariant.getAttribute('cds-effect')
-    if ('>' in variant or '<' in variant):
-        type = "substitution"
-
-    elif ('del' in variant):
-        type = "deletion"
-
-    elif ('ins' in variant):
-        type = "insertion"
-
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsDNASequenceVariantType",
-             'valueCodeableConcept': {
-            'text': type
-        }
-    })
-
-
-def addShortVariantAminoAcidChangeFromFoundation(observationResource, shortVariant):
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsAminoAcidChange",
-        'valueCodeableConcept': {
-            'text': shortVariant.getAttribute('protein-effect')
-        }
-    })
-
-def addShortVariantAlleleFrequencyFromFoundation(observationResource, shortVariant):
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsAllelicFrequency",
-        'valueDecimal': shortVariant.getAttribute('allele-fraction')
-    })
-
-# Not part of DSTU3
-def addShortVariantTranscriptIdFromFoundation(observationResource, shortVariant):
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsTranscriptReferenceSequenceId",
-        'valueCodeableConcept': {
-            'text': shortVariant.getAttribute('transcript')
-        }
-    })
-
-def observationAndSequenceAddShortVariantInfo(observationArr, sequenceArr, shortVariant, nucleicAcidType, date, specimen, patient, reportId, variantNumber):
-    observation = foundationFhirObservation()
-    addShortVariantId(observation.observationResource, reportId, variantNumber)
-
-    sequence = foundationFhirSequence()
-    sequenceAddShortVariantId(sequence.sequenceResource, reportId, variantNumber)
-    sequenceShortVariantAddCoverageFromFoundation(sequence.sequenceResource, shortVariant)
-    sequenceAddRefSeqChromosome(sequence.sequenceResource, shortVariant)
-    sequenceShortVariantAddVariantFromFoundation(sequence.sequenceResource, shortVariant, observation.getObservationId())
-    sequenceAddReferenceToSpecimen(sequence.sequenceResource, specimen.getSpecimenId(), specimen.getSpecimenType())
-    sequenceAddTypeFromFoundation(sequence.sequenceResource, nucleicAcidType)
-    addPatientSubjectReference(sequence.sequenceResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(sequence.sequenceResource)
-    sequenceArr.append(sequence)
-
-
-    addShortVariantTranscriptIdFromFoundation(observation.observationResource, shortVariant)
-    addShortVariantAlleleFrequencyFromFoundation(observation.observationResource, shortVariant)
-    variantReportAddGeneNameFromFoundation(observation.observationResource, shortVariant)
-    addShortVariantAminoAcidChangeFromFoundation(observation.observationResource, shortVariant)
-    addShortVariantAminoAcidTypeFromFoundation(observation.observationResource, shortVariant)
-    addShortVariantDnaSequenceVariantName(observation.observationResource, shortVariant)
-    addShortVariantDnaSequenceVariantType(observation.observationResource, shortVariant)
-    variantReportAddReferenceToSequence(observation.observationResource, sequence.getSequenceId())
-    singleObservationAddDateTimeFromFoundation(observation.observationResource, date)
-    observationAddReferenceToSpecimen(observation.observationResource, specimen.getSpecimenId(), specimen.getSpecimenType())
-    addPatientSubjectReference(observation.observationResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(observation.observationResource)
-    observationArr.append(observation)
-
-def addVariantReportShortVariantSequencesAndObservations(observationArr, sequenceArr, diagnosticReport, specimen, patient, DOM):
-    shortVariants = DOM.getElementsByTagName('short-variant')
-    date = diagnosticReport.getReportDate()
-    reportId = diagnosticReport.getDiagnosticReportId()
-    nucleicAcidType = DOM.getElementsByTagName('sample')[0].getAttribute('nucleic-acid-type').lower()
-    l = len(shortVariants)
-    for i in range(0, l, 1):
-        observationAndSequenceAddShortVariantInfo(observationArr, sequenceArr, shortVariants[i], nucleicAcidType, date, specimen, patient, reportId, i+1)
-
-def sequenceAddCopyNumberAlterationId(sequenceResource, reportId, variantNumber):
-    sequenceResource['id'] = reportId + "-copy-number-alt-" + str(variantNumber) + "-seq"
-
-def addCopyNumberAlterationId(observationResource, reportId, variantNumber):
-    observationResource['id'] = reportId + "-copy-number-alt-" + str(variantNumber)
-
-def addCopyNumberAlterationEventFromFoundation(observationResource, copyNumberAlt):
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsCopyNumberEvent",
-        'valueCodeableConcept': {
-            'text': "Copy number: " + copyNumberAlt.getAttribute('copy-number')
-        }
-    })
-
-def sequenceCopyNumberAlterationAddStructureVariantFromFoundation(sequenceResource, copyNumberAlt):
-    position = copyNumberAlt.getAttribute('position').split(':')[1].split('-')
-    sequenceResource['structureVariant'] = [{
-        'precisionOfBoundaries': copyNumberAlt.getAttribute('status') + " structural variant",
-        'reportedaCGHRatio': copyNumberAlt.getAttribute('ratio'),
-        'length': int(position[1]) - int(position[0]),
-        'outer': {
-            'start': position[0],
-            'end': position[1]
-        },
-        'inner': {
-            'start': position[0],
-            'end': position[1]
-        }
-    }]
-
-def observationAndSequenceAddCopyNumberAlterationInfo(observationArr, sequenceArr, copyNumberAlt, nucleicAcidType, date, specimen, patient, reportId, variantNumber):
-    sequence = foundationFhirSequence()
-    sequenceAddCopyNumberAlterationId(sequence.sequenceResource, reportId, variantNumber)
-    sequenceCopyNumberAlterationAddStructureVariantFromFoundation(sequence.sequenceResource, copyNumberAlt)
-    sequenceAddReferenceToSpecimen(sequence.sequenceResource, specimen.getSpecimenId(), specimen.getSpecimenType())
-    sequenceAddTypeFromFoundation(sequence.sequenceResource, nucleicAcidType)
-    sequenceAddRefSeqChromosome(sequence.sequenceResource, copyNumberAlt)
-    addPatientSubjectReference(sequence.sequenceResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(sequence.sequenceResource)
-    sequenceArr.append(sequence)
-
-    observation = foundationFhirObservation()
-    addCopyNumberAlterationId(observation.observationResource, reportId, variantNumber)
-    variantReportAddGeneNameFromFoundation(observation.observationResource, copyNumberAlt)
-    variantReportAddReferenceToSequence(observation.observationResource, sequence.getSequenceId())
-    addCopyNumberAlterationEventFromFoundation(observation.observationResource, copyNumberAlt)
-    variantReportAddSequenceVariantType(observation.observationResource, copyNumberAlt)
-    singleObservationAddDateTimeFromFoundation(observation.observationResource, date)
-    observationAddReferenceToSpecimen(observation.observationResource, specimen.getSpecimenId(), specimen.getSpecimenType())
-    addPatientSubjectReference(observation.observationResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(observation.observationResource)
-    observationArr.append(observation)
-
-def addVariantReportCopyNumberAlterationSequencesAndObservations(observationArr, sequenceArr, diagnosticReport, specimen, patient, DOM):
-    copyNumberAlterations = DOM.getElementsByTagName('copy-number-alteration')
-    date = diagnosticReport.getReportDate()
-    reportId = diagnosticReport.getDiagnosticReportId()
-    nucleicAcidType = DOM.getElementsByTagName('sample')[0].getAttribute('nucleic-acid-type').lower()
-    l = len(copyNumberAlterations)
-    for i in range(0, l, 1):
-        observationAndSequenceAddCopyNumberAlterationInfo(observationArr, sequenceArr, copyNumberAlterations[i], nucleicAcidType, date, specimen, patient, reportId, i+1)
-
-def addRearrangementId(observationResource, reportId, variantNumber, ext):
-    observationResource['id'] = reportId + "-rearrangement-" + ext + "-" + str(variantNumber)
-
-def sequenceRearrangementAddStructureVariantFromFoundation(sequenceResource, rearrangement, attribute):
-    position = rearrangement.getAttribute(attribute).split(':')[1].split('-')
-    sequenceResource['structureVariant'] = [{
-        'precisionOfBoundaries': rearrangement.getAttribute('status') + " structural variant. There are " +
-                               rearrangement.getAttribute('supporting-read-pairs') + " supporting read pairs.",
-        'length': int(position[1]) - int(position[0]),
-        'outer': {
-            'start': position[0],
-            'end': position[1]
-        },
-        'inner': {
-            'start': position[0],
-            'end': position[1]
-        }
-    }]
-
-def addRearrangementGeneNameFromFoundation(observationResource, element, attribute):
-    observationResource['extension'].append({
-        'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsGene",
-        'valueCodeableConcept': {
-            'text': element.getAttribute(attribute)
-        }
-    })
-
-def sequenceAddRearrangementId(sequenceResource, reportId, variantNumber, ext):
-    sequenceResource['id'] = reportId + "-rearrangement-" + ext + "-" + str(variantNumber) + "-seq"
-
-def sequenceRearrangementAddRefSeqChromosome(sequenceResource, element, attribute):
-    sequenceResource['referenceSeq'] = {
-        'chromosome': {
-            'text': element.getAttribute(attribute).split(':')[0]
-        }
-    }
-
+# HGVS c. notation as used in cds-effect: a position or range (intronic and UTR positions such as 344-1 or *12 included) followed by
+# a substitution (123A>G), deletion (77_78delCA, 2235_2249del15), insertion (45_46insT), deletion-insertion
+# (1234_1236delinsTT), duplication (5266dupC) or inversion (100_102inv)
+foundationCdsEffectPattern = (
+    r'^(?:c\.)?(?P<start>[-*]?\d+(?:[-+]\d+)?)(?:_(?P<end>[-*]?\d+(?:[-+]\d+)?))?'
+    r'(?:(?P<reference>[ACGTN]+)>(?P<substituted>[ACGTN]+)'
+    r'|delins(?P<replacement>[ACGTN]+|\d+)'
+    r'|del(?P<deleted>[ACGTN]+|\d+)?'
+    r'|ins(?P<inserted>[ACGTN]+|\d+)'
+    r'|(?P<duplication>dup)(?P<duplicated>[ACGTN]+|\d+)?'
+    r'|(?P<inversion>inv)(?:[ACGTN]+|\d+)?)$'
+)
+
+# compiled on first use, so importing the module does not pull in re
+@functools.lru_cache(maxsize=None)
+def compileFoundationCdsEffectPattern():
+    import re
+    return re.compile(foundationCdsEffectPattern)
+
+foundationCdsEffect = collections.namedtuple('foundationCdsEffect', ['type', 'start', 'end', 'referenceAllele', 'observedAllele'])
+
+# the same cds-effects recur across reports, so each string is parsed once per process. '_' stands for an empty
+# allele and an allele that is not spelled out (del15, delinsTT's deleted bases) is left empty. anything that is not HGVS c. notation has
+# type "unknown" and empty alleles
+@functools.lru_cache(maxsize=65536)
+def parseFoundationCdsEffect(cdsEffect):
+    match = compileFoundationCdsEffectPattern().match(cdsEffect)
+    if match is None:
+        return foundationCdsEffect("unknown", '', '', '', '')
+    start = match.group('start')
+    end = match.group('end') or start
+    if match.group('substituted') is not None:
+        return foundationCdsEffect("substitution", start, end, match.group('reference'), match.group('substituted'))
+    if match.group('replacement') is not None:
+        return foundationCdsEffect("deletion-insertion", start, end, '', foundationCdsEffectAllele(match.group('replacement')))
+    if match.group('inserted') is not None:
+        return foundationCdsEffect("insertion", start, end, '_', foundationCdsEffectAllele(match.group('inserted')))
+    if match.group('duplication') is not None:
+        return foundationCdsEffect("duplication", start, end, '_', foundationCdsEffectAllele(match.group('duplicated')))
+    if match.group('inversion') is not None:
+        return foundationCdsEffect("inversion", start, end, '', '')
+    return foundationCdsEffect("deletion", start, end, foundationCdsEffectAllele(match.group('deleted')), '_')
+
+def foundationCdsEffectAllele(allele):
+    if allele is None or allele.isdigit():
+        return ''
+    return allele
 
 def relateRearrangementObservations(observation1, observation2):
     observation1.observationResource['related'] = [{
@@ -1105,65 +1348,269 @@ def relateRearrangementObservations(observation1, observation2):
         }
     }]
 
+# the variant-report stages read every attribute they need into one list per attribute up front, parse positions a
+# whole column at a time and then build the Observation/Sequence pairs row by row from those columns
+foundationShortVariantAttributes = ('position', 'cds-effect', 'depth', 'allele-fraction', 'gene', 'protein-effect',
+                                    'functional-effect', 'transcript')
+foundationCopyNumberAlterationAttributes = ('position', 'copy-number', 'ratio', 'status', 'gene', 'type')
+foundationRearrangementAttributes = ('pos1', 'pos2', 'status', 'supporting-read-pairs', 'targeted-gene', 'other-gene', 'type')
+
+def foundationVariantColumns(elements, attributes):
+    columns = {}
+    for attribute in attributes:
+        columns[attribute] = [element.getAttribute(attribute) for element in elements]
+    return columns
+
+# 'chr7:55242465-55242480' -> 'chr7', '55242465-55242480'
+def foundationPositionColumns(positions):
+    chromosomes = []
+    spans = []
+    for position in positions:
+        chromosome, _, span = position.partition(':')
+        chromosomes.append(chromosome)
+        spans.append(span)
+    return chromosomes, spans
+
+# '55242465-55242480' -> 55242465, 55242480, 15
+def foundationSpanColumns(spans):
+    starts = []
+    ends = []
+    for span in spans:
+        span = span.split('-')
+        starts.append(int(span[0]))
+        ends.append(int(span[1]))
+    return starts, ends, [ends[i] - starts[i] for i in range(0, len(spans), 1)]
 
-def observationAndSequenceAddRearrangementInfo(observationArr, sequenceArr, rearrangement, nucleicAcidType, date, specimen, patient, reportId, variantNumber):
-    sequence1 = foundationFhirSequence()
-    sequenceAddRearrangementId(sequence1.sequenceResource, reportId, variantNumber, 'targeted-gene')
-    sequenceRearrangementAddStructureVariantFromFoundation(sequence1.sequenceResource, rearrangement, 'pos1')
-    sequenceAddReferenceToSpecimen(sequence1.sequenceResource, specimen.getSpecimenId(), specimen.getSpecimenType())
-    sequenceAddTypeFromFoundation(sequence1.sequenceResource, nucleicAcidType)
-    sequenceRearrangementAddRefSeqChromosome(sequence1.sequenceResource, rearrangement, 'pos1')
-    addPatientSubjectReference(sequence1.sequenceResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(sequence1.sequenceResource)
-    sequenceArr.append(sequence1)
-
-    observation1 = foundationFhirObservation()
-    addRearrangementId(observation1.observationResource, reportId, variantNumber, 'targeted-gene')
-    addRearrangementGeneNameFromFoundation(observation1.observationResource, rearrangement, 'targeted-gene')
-    variantReportAddReferenceToSequence(observation1.observationResource, sequence1.getSequenceId())
-    variantReportAddSequenceVariantType(observation1.observationResource, rearrangement)
-    singleObservationAddDateTimeFromFoundation(observation1.observationResource, date)
-    observationAddReferenceToSpecimen(observation1.observationResource, specimen.getSpecimenId(), specimen.getSpecimenType())
-    addPatientSubjectReference(observation1.observationResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(observation1.observationResource)
-
-    sequence2 = foundationFhirSequence()
-    sequenceAddRearrangementId(sequence2.sequenceResource, reportId, variantNumber, 'other-gene')
-    sequenceRearrangementAddStructureVariantFromFoundation(sequence2.sequenceResource, rearrangement, 'pos2')
-    sequenceAddReferenceToSpecimen(sequence2.sequenceResource, specimen.getSpecimenId(), specimen.getSpecimenType())
-    sequenceAddTypeFromFoundation(sequence2.sequenceResource, nucleicAcidType)
-    sequenceRearrangementAddRefSeqChromosome(sequence2.sequenceResource, rearrangement, 'pos2')
-    addPatientSubjectReference(sequence2.sequenceResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(sequence2.sequenceResource)
-    sequenceArr.append(sequence2)
-
-
-    observation2 = foundationFhirObservation()
-    addRearrangementId(observation2.observationResource, reportId, variantNumber, 'other-gene')
-    addRearrangementGeneNameFromFoundation(observation2.observationResource, rearrangement, 'other-gene')
-    variantReportAddReferenceToSequence(observation2.observationResource, sequence2.getSequenceId())
-    variantReportAddSequenceVariantType(observation2.observationResource, rearrangement)
-    singleObservationAddDateTimeFromFoundation(observation2.observationResource, date)
-    observationAddReferenceToSpecimen(observation2.observationResource, specimen.getSpecimenId(), specimen.getSpecimenType())
-    addPatientSubjectReference(observation2.observationResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(observation2.observationResource)
-
-    relateRearrangementObservations(observation1, observation2)
-    observationArr.append(observation1)
-    observationArr.append(observation2)
+def addVariantReportShortVariantSequencesAndObservations(observationArr, sequenceArr, diagnosticReport, specimen, patient, DOM):
+    columns = foundationVariantColumns(DOM.getElementsByTagName('short-variant'), foundationShortVariantAttributes)
+    chromosomes, positions = foundationPositionColumns(columns['position'])
+    date = diagnosticReport.getReportDate()
+    reportId = diagnosticReport.getDiagnosticReportId()
+    nucleicAcidType = DOM.getElementsByTagName('sample')[0].getAttribute('nucleic-acid-type').lower()
+    specimenId = specimen.getSpecimenId()
+    specimenType = specimen.getSpecimenType()
+    patientId = patient.getPatientId()
+    patientName = patient.getPatientFullName()
+    l = len(positions)
+    for i in range(0, l, 1):
+        observation = foundationFhirObservation()
+        observationId = reportId + "-short-variant-" + str(i + 1)
+        cdsEffect = columns['cds-effect'][i]
+        variant = parseFoundationCdsEffect(cdsEffect)
+        position = foundationNumber(positions[i])
+
+        sequence = foundationFhirSequence()
+        sequence.sequenceResource.update({
+            'id': observationId + "-seq",
+            'readCoverage': foundationNumber(columns['depth'][i]),
+            'referenceSeq': {
+                'chromosome': {
+                    'text': chromosomes[i]
+                }
+            },
+            'variant': [{
+                'start': position,
+                'end': position,
+                'observedAllele': variant.observedAllele,
+                'referenceAllele': variant.referenceAllele,
+                'variantPointer': {
+                    'reference': "Observation/" + observationId,
+                    'display': "Genetic observation that contains information on this variant"
+                }
+            }]
+        })
+        sequenceAddReferenceToSpecimen(sequence.sequenceResource, specimenId, specimenType)
+        sequenceAddTypeFromFoundation(sequence.sequenceResource, nucleicAcidType)
+        sequenceAddPatientReference(sequence.sequenceResource, patientId, patientName)
+        addFoundationSingleReferenceWithField(sequence.sequenceResource, 'performer')
+        sequenceArr.append(sequence)
+
+        observationResource = observation.observationResource
+        observationResource['id'] = observationId
+        # the transcript extension is not part of DSTU3
+        observationResource['extension'] = [{
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsTranscriptReferenceSequenceId",
+            'valueCodeableConcept': {
+                'text': columns['transcript'][i]
+            }
+        }, {
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsAllelicFrequency",
+            'valueDecimal': foundationNumber(columns['allele-fraction'][i], float)
+        }, {
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsGene",
+            'valueCodeableConcept': {
+                'text': columns['gene'][i]
+            }
+        }, {
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsAminoAcidChange",
+            'valueCodeableConcept': {
+                'text': columns['protein-effect'][i]
+            }
+        }, {
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsAminoAcidChangeType",
+            'valueCodeableConcept': {
+                'text': columns['functional-effect'][i]
+            }
+        }, {
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsDNASequenceVariantName",
+            'valueCodeableConcept': {
+                'text': cdsEffect
+            }
+        }, {
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsDNASequenceVariantType",
+            'valueCodeableConcept': {
+                'text': variant.type
+            }
+        }]
+        variantReportAddReferenceToSequence(observationResource, sequence.getSequenceId())
+        singleObservationAddDateTimeFromFoundation(observationResource, date)
+        observationAddReferenceToSpecimen(observationResource, specimenId, specimenType)
+        addPatientSubjectReference(observationResource, patientId, patientName)
+        observationArr.append(observation)
+
+def addVariantReportCopyNumberAlterationSequencesAndObservations(observationArr, sequenceArr, diagnosticReport, specimen, patient, DOM):
+    columns = foundationVariantColumns(DOM.getElementsByTagName('copy-number-alteration'), foundationCopyNumberAlterationAttributes)
+    chromosomes, spans = foundationPositionColumns(columns['position'])
+    starts, ends, lengths = foundationSpanColumns(spans)
+    date = diagnosticReport.getReportDate()
+    reportId = diagnosticReport.getDiagnosticReportId()
+    nucleicAcidType = DOM.getElementsByTagName('sample')[0].getAttribute('nucleic-acid-type').lower()
+    specimenId = specimen.getSpecimenId()
+    specimenType = specimen.getSpecimenType()
+    patientId = patient.getPatientId()
+    patientName = patient.getPatientFullName()
+    l = len(spans)
+    for i in range(0, l, 1):
+        observationId = reportId + "-copy-number-alt-" + str(i + 1)
+        sequence = foundationFhirSequence()
+        sequence.sequenceResource['id'] = observationId + "-seq"
+        sequence.sequenceResource['structureVariant'] = [{
+            'precisionOfBoundaries': columns['status'][i] + " structural variant",
+            'reportedaCGHRatio': foundationNumber(columns['ratio'][i], float),
+            'length': lengths[i],
+            'outer': {
+                'start': starts[i],
+                'end': ends[i]
+            },
+            'inner': {
+                'start': starts[i],
+                'end': ends[i]
+            }
+        }]
+        sequenceAddReferenceToSpecimen(sequence.sequenceResource, specimenId, specimenType)
+        sequenceAddTypeFromFoundation(sequence.sequenceResource, nucleicAcidType)
+        sequence.sequenceResource['referenceSeq'] = {
+            'chromosome': {
+                'text': chromosomes[i]
+            }
+        }
+        sequenceAddPatientReference(sequence.sequenceResource, patientId, patientName)
+        addFoundationSingleReferenceWithField(sequence.sequenceResource, 'performer')
+        sequenceArr.append(sequence)
+
+        observation = foundationFhirObservation()
+        observationResource = observation.observationResource
+        observationResource['id'] = observationId
+        observationResource['extension'] = [{
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsGene",
+            'valueCodeableConcept': {
+                'text': columns['gene'][i]
+            }
+        }]
+        variantReportAddReferenceToSequence(observationResource, sequence.getSequenceId())
+        observationResource['extension'].append({
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsCopyNumberEvent",
+            'valueCodeableConcept': {
+                'text': "Copy number: " + columns['copy-number'][i]
+            }
+        })
+        observationResource['extension'].append({
+            'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsDNASequenceVariantType",
+            'valueCodeableConcept': {
+                'text': columns['type'][i]
+            }
+        })
+        singleObservationAddDateTimeFromFoundation(observationResource, date)
+        observationAddReferenceToSpecimen(observationResource, specimenId, specimenType)
+        addPatientSubjectReference(observationResource, patientId, patientName)
+        observationArr.append(observation)
 
 def addVariantReportRearrangementSequencesAndObservations(observationArr, sequenceArr, diagnosticReport, specimen, patient, DOM):
-    rearrangements = DOM.getElementsByTagName('rearrangement')
+    columns = foundationVariantColumns(DOM.getElementsByTagName('rearrangement'), foundationRearrangementAttributes)
     date = diagnosticReport.getReportDate()
     reportId = diagnosticReport.getDiagnosticReportId()
     # might need to account for more than 1 sample
     nucleicAcidType = DOM.getElementsByTagName('sample')[0].getAttribute('nucleic-acid-type').lower()
-    l = rearrangements.length
+    specimenId = specimen.getSpecimenId()
+    specimenType = specimen.getSpecimenType()
+    patientId = patient.getPatientId()
+    patientName = patient.getPatientFullName()
+    # the targeted gene sits at pos1 and the other gene at pos2
+    sides = []
+    for ext, attribute in (('targeted-gene', 'pos1'), ('other-gene', 'pos2')):
+        chromosomes, spans = foundationPositionColumns(columns[attribute])
+        sides.append((ext, chromosomes) + foundationSpanColumns(spans))
+    l = len(columns['type'])
     for i in range(0, l, 1):
-        observationAndSequenceAddRearrangementInfo(observationArr, sequenceArr, rearrangements[i], nucleicAcidType, date, specimen, patient, reportId, i+1)
+        precisionOfBoundaries = columns['status'][i] + " structural variant. There are " + \
+                                columns['supporting-read-pairs'][i] + " supporting read pairs."
+        observations = []
+        for ext, chromosomes, starts, ends, lengths in sides:
+            sequence = foundationFhirSequence()
+            sequence.sequenceResource['id'] = reportId + "-rearrangement-" + ext + "-" + str(i + 1) + "-seq"
+            sequence.sequenceResource['structureVariant'] = [{
+                'precisionOfBoundaries': precisionOfBoundaries,
+                'length': lengths[i],
+                'outer': {
+                    'start': starts[i],
+                    'end': ends[i]
+                },
+                'inner': {
+                    'start': starts[i],
+                    'end': ends[i]
+                }
+            }]
+            sequenceAddReferenceToSpecimen(sequence.sequenceResource, specimenId, specimenType)
+            sequenceAddTypeFromFoundation(sequence.sequenceResource, nucleicAcidType)
+            sequence.sequenceResource['referenceSeq'] = {
+                'chromosome': {
+                    'text': chromosomes[i]
+                }
+            }
+            sequenceAddPatientReference(sequence.sequenceResource, patientId, patientName)
+            addFoundationSingleReferenceWithField(sequence.sequenceResource, 'performer')
+            sequenceArr.append(sequence)
+
+            observation = foundationFhirObservation()
+            observationResource = observation.observationResource
+            observationResource['id'] = reportId + "-rearrangement-" + ext + "-" + str(i + 1)
+            observationResource['extension'] = [{
+                'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsGene",
+                'valueCodeableConcept': {
+                    'text': columns[ext][i]
+                }
+            }]
+            variantReportAddReferenceToSequence(observationResource, sequence.getSequenceId())
+            observationResource['extension'].append({
+                'url': "http://hl7.org/fhir/StructureDefinition/observation-geneticsDNASequenceVariantType",
+                'valueCodeableConcept': {
+                    'text': columns['type'][i]
+                }
+            })
+            singleObservationAddDateTimeFromFoundation(observationResource, date)
+            observationAddReferenceToSpecimen(observationResource, specimenId, specimenType)
+            addPatientSubjectReference(observationResource, patientId, patientName)
+            observations.append(observation)
+        relateRearrangementObservations(observations[0], observations[1])
+        # observationArr may be a foundationStreamedResources, which only supports append
+        observationArr.append(observations[0])
+        observationArr.append(observations[1])
 
 # Only use if want to self define practitioner resources for employees... see commented out in provenanceAddSignaturesFromFoundation() function
 class foundationPractitionerAsserters:
+    __slots__ = ('practitioners', 'numberOfPractitioners')
+    resourceType = "Practitioner"
+
     def __init__(self):
         self.practitioners = {
             'Jo-Anne Vergilio': {
@@ -1203,11 +1650,13 @@ class foundationPractitionerAsserters:
                 'gender': "male"
             }
         }
-        self.resourceType = "Practitioner"
         self.numberOfPractitioners = 3
 
 
 class foundationFhirProvenance:
+    __slots__ = ('provenanceResource', 'signers')
+    resourceType = "Provenance"
+
     def __init__(self):
         self.provenanceResource = {
             'resourceType': "Provenance",
@@ -1217,7 +1666,8 @@ class foundationFhirProvenance:
                 'display': "legally authenticated"
             }
         }
-        self.resourceType = "Provenance"
+        # Practitioner resources of the doctors who signed the report
+        self.signers = []
 
     def getProvenanceId(self):
         return self.provenanceResource['id']
@@ -1245,10 +1695,11 @@ def provenanceAddTargetResources(provenanceResource, diagnosticReportId, diagnos
             'display': observationArr[i].getDisplayString()
         })
 
+# returns the Practitioner resources of the signers
 def provenanceAddSignaturesFromFoundation(provenanceResource, foundationPractitionerAsserters, recordedTime, DOM):
     names = []
-    names.append(DOM.getElementsByTagName('OpName')[0].childNodes[0].nodeValue.strip())
-    namesFromText = DOM.getElementsByTagName('Text')[0].childNodes[0].nodeValue.split('|')
+    names.append(DOM.getFirstText('OpName').strip())
+    namesFromText = DOM.getFirstText('Text').split('|')
     l = len(namesFromText)
     for i in range(0, l, 1):
         name = namesFromText[i].split(',')[0].strip()
@@ -1257,6 +1708,7 @@ def provenanceAddSignaturesFromFoundation(provenanceResource, foundationPractiti
         else:
             names.append(name)
     provenanceResource['signature'] = []
+    signers = []
     l = len(names)
     for i in range(0, l, 1):
         nameArr = names[i].split(' ')
@@ -1264,16 +1716,17 @@ def provenanceAddSignaturesFromFoundation(provenanceResource, foundationPractiti
         nameArr.pop()
         practitionerAsserterResource = {
             'resourceType': "Practitioner",
-            'id': lastName + "-FM",
+            'id': foundationNameId(names[i]) + "-FM",
             'name': [{
                 'use': "official",
-                'text': name[i],
+                'text': names[i],
                 'family': lastName,
                 'given': nameArr,
                 'prefix': ["M.D."]
             }]
         }
         # practitionerAsserterResource = foundationPractitionerAsserters.practitioners[names[i]]
+        signers.append(practitionerAsserterResource)
         provenanceResource['signature'].append({
             'type': [{
                 'system': "http://hl7.org/fhir/ValueSet/signature-type",
@@ -1290,6 +1743,7 @@ def provenanceAddSignaturesFromFoundation(provenanceResource, foundationPractiti
                 'display': "Foundation Medicine"
             }
         })
+    return signers
 
 def getPractitionerNamesAndIdsFromSignatures(signatures):
     practitioners = []
@@ -1306,11 +1760,13 @@ def provenanceAddAgentFromFoundation(provenanceResource, practitionerIdsAndNames
     l = len(practitionerIdsAndNames)
     for i in range(0, l, 1):
         provenanceResource['agent'].append({
-            'role': {
-                'system': "http://hl7.org/fhir/ValueSet/provenance-agent-role",
-                'code': "attester",
-                'display': "Foundation Medicine Medical Doctor that signed off on the report."
-            },
+            'role': [{
+                'coding': [{
+                    'system': "http://hl7.org/fhir/ValueSet/provenance-agent-role",
+                    'code': "attester",
+                    'display': "Foundation Medicine Medical Doctor that signed off on the report."
+                }]
+            }],
             'whoReference': {
                 'reference': practitionerIdsAndNames[i]['id'],
                 'display': practitionerIdsAndNames[i]['name']
@@ -1323,19 +1779,30 @@ def provenanceAddAgentFromFoundation(provenanceResource, practitionerIdsAndNames
 
 
 class foundationToFhirBundle:
-    def __init__(self):
+    __slots__ = ('bundleResource', 'transaction')
+
+    # transaction is a foundationTransactionEntries for transaction and batch bundles
+    def __init__(self, transaction=None):
         self.bundleResource = {
             'resourceType': "Bundle",
-            'type': "Collection",
+            'type': "Collection" if transaction is None else transaction.bundleType,
             'entry': []
         }
+        self.transaction = transaction
 
     def addEntry(self, resource):
+        if self.transaction is not None:
+            self.bundleResource['entry'].append(self.transaction.entry(resource))
+            return
         self.bundleResource['entry'].append({
             'resource': resource
         })
 
     def addObservationEntries(self, observationArr):
+        if self.transaction is not None:
+            for observation in observationArr:
+                self.bundleResource['entry'].append(self.transaction.entry(observation.observationResource))
+            return
         l = len(observationArr)
         for i in range(0, l, 1):
             self.bundleResource['entry'].append({
@@ -1343,6 +1810,10 @@ class foundationToFhirBundle:
             })
 
     def addSequenceEntries(self, sequenceArr):
+        if self.transaction is not None:
+            for sequence in sequenceArr:
+                self.bundleResource['entry'].append(self.transaction.entry(sequence.sequenceResource))
+            return
         l = len(sequenceArr)
         for i in range(0, l, 1):
             self.bundleResource['entry'].append({
@@ -1352,11 +1823,929 @@ class foundationToFhirBundle:
 def addBundleIdFromFoundation(bundleResource, reportId):
     bundleResource['id'] = "FoundationMedicine-" + reportId
 
-########################################################################################################################
-files = [f for f in os.listdir('.') if f.endswith('.xml')]
-for f in files:
-    DOM = domParser.parse(f)
+foundationBundleTypes = ['collection', 'transaction', 'batch']
+
+# every report carries its own copy of these; in a transaction they are only created when the server does not
+# have them yet
+foundationSharedResourceTypes = frozenset(['Organization', 'Practitioner', 'Patient'])
+
+# the search that finds a shared resource an earlier report already created, or None when it has no identifier with a
+# system. A bare value could match another facility's patient or another kind of identifier, so such a resource is
+# written to its own id instead. The patient has to match the birth date as well
+def foundationIfNoneExist(resource):
+    from urllib.parse import quote
+    if resource['resourceType'] not in foundationSharedResourceTypes or len(resource.get('identifier') or []) == 0:
+        return None
+    identifier = resource['identifier'][0]
+    if not identifier.get('value') or not identifier.get('system'):
+        return None
+    query = "identifier=" + quote(identifier['system'] + "|" + identifier['value'], safe=':/|')
+    if resource['resourceType'] == 'Patient' and resource.get('birthDate'):
+        query = query + "&birthdate=" + quote(resource['birthDate'])
+    return query
+
+# turns resources into transaction or batch entries.
+# transaction: every entry gets a urn:uuid fullUrl and every "Type/id" reference is rewritten to the fullUrl of
+# that entry, so the server can link resources it assigns ids to. Shared resources with an identifier system are
+# conditional creates (ifNoneExist); everything else is a PUT to its own id, so sending a report again updates it
+# instead of duplicating it.
+# batch: entries may not refer to each other, so every entry is a PUT to its own id and references are left alone.
+# fullUrls are uuid5s of the bundle id and the reference, so converting a report twice gives the same bundle and a
+# reference can be rewritten before the entry it points at is written (which --stream-bundle needs). Only references
+# to registered resources and to observations and sequences, which are always entries of the same bundle, are
+# rewritten; anything else (the signing practitioners) is left pointing at the server.
+# Resources share dicts with each other (templates, related artifacts), so rewriting copies every dict it changes
+# and the ones above it instead of changing them in place
+class foundationTransactionEntries:
+    __slots__ = ('bundleType', 'namespace', 'fullUrls', 'resources')
+
+    def __init__(self, bundleId, bundleType='transaction'):
+        import uuid
+        if bundleType not in ('transaction', 'batch'):
+            raise ValueError("Not a transaction or batch bundle type: " + bundleType)
+        self.bundleType = bundleType
+        self.namespace = uuid.uuid5(uuid.NAMESPACE_URL, bundleId)
+        self.fullUrls = {}
+        # id() of every resource rewritten so far -> (resource, rewritten resource). Observations are both entries and
+        # contained in the DiagnosticReport, and are only walked once
+        self.resources = {}
+
+    def register(self, resource):
+        self.fullUrl(resource['resourceType'] + "/" + resource['id'])
+
+    # a resource the shared-resources bundle creates instead of this one. References to it become conditional
+    # references when it is created by identifier, and otherwise keep pointing at its id
+    def registerShared(self, resource):
+        ifNoneExist = foundationIfNoneExist(resource)
+        if ifNoneExist is not None:
+            self.fullUrls[resource['resourceType'] + "/" + resource['id']] = resource['resourceType'] + "?" + ifNoneExist
+
+    def fullUrl(self, reference):
+        import uuid
+        fullUrl = self.fullUrls.get(reference)
+        if fullUrl is None:
+            fullUrl = "urn:uuid:" + str(uuid.uuid5(self.namespace, reference))
+            self.fullUrls[reference] = fullUrl
+        return fullUrl
+
+    # returns value itself when nothing in it changed
+    def rewrite(self, value):
+        if type(value) is dict:
+            if 'resourceType' in value:
+                done = self.resources.get(id(value))
+                if done is not None:
+                    return done[1]
+            rewritten = None
+            for key, item in value.items():
+                if key == 'reference' and type(item) is str:
+                    fullUrl = self.fullUrls.get(item)
+                    if fullUrl is None:
+                        if not item.startswith(('Observation/', 'Sequence/')):
+                            continue
+                        fullUrl = self.fullUrl(item)
+                    changed = fullUrl
+                elif type(item) is dict or type(item) is list:
+                    changed = self.rewrite(item)
+                    if changed is item:
+                        continue
+                else:
+                    continue
+                if rewritten is None:
+                    rewritten = dict(value)
+                rewritten[key] = changed
+            if rewritten is None:
+                rewritten = value
+            if 'resourceType' in value:
+                self.resources[id(value)] = (value, rewritten)
+            return rewritten
+        rewritten = None
+        for i, item in enumerate(value):
+            if type(item) is dict or type(item) is list:
+                changed = self.rewrite(item)
+                if changed is not item:
+                    if rewritten is None:
+                        rewritten = list(value)
+                    rewritten[i] = changed
+        return value if rewritten is None else rewritten
+
+    def entry(self, resource):
+        reference = resource['resourceType'] + "/" + resource['id']
+        if self.bundleType == 'batch':
+            return {
+                'resource': resource,
+                'request': {
+                    'method': "PUT",
+                    'url': reference
+                }
+            }
+        resource = self.rewrite(resource)
+        ifNoneExist = foundationIfNoneExist(resource)
+        if ifNoneExist is None:
+            request = {
+                'method': "PUT",
+                'url': reference
+            }
+        else:
+            # the server ignores the id on create and assigns its own
+            request = {
+                'method': "POST",
+                'url': resource['resourceType'],
+                'ifNoneExist': ifNoneExist
+            }
+        return {
+            'fullUrl': self.fullUrl(reference),
+            'resource': resource,
+            'request': request
+        }
+
+# the resources a report has in common with other reports: Foundation Medicine, the ordering facility and
+# physician, the patient and their pathologist, and (once the provenance is built) the doctors who signed it
+def getFoundationSharedResources(report, provenance=None):
+    resources = [
+        report.FoundationMedicine.organizationResource,
+        report.organization.organizationResource,
+        report.orderingPhysician.practitionerResource,
+        report.patient.patientResource,
+        report.pathologist.practitionerResource
+    ]
+    if provenance is not None:
+        resources.extend(provenance.signers)
+    return resources
+
+# --shared-resources. Collects the shared resources of a batch keyed by their deterministic "Type/id", so each is
+# written once into a shared-resources bundle and the report bundles only refer to it. The ids carry what tells two
+# people apart (the facility of an MRN, the whole name of a doctor), so a resource seen again with different content
+# is the same one changed (an amended patient name). It replaces the earlier one, and the change is recorded in
+# conflicts as (key, earlier source, source) so the run can list it
+class foundationSharedResourceRegistry:
+    __slots__ = ('resources', 'sources', 'added', 'replaced', 'conflicts')
+    bundleId = "FoundationMedicine-shared-resources"
+
+    def __init__(self):
+        self.resources = {}
+        # key -> the report (or shared-resources file) the resource came from
+        self.sources = {}
+        self.added = 0
+        self.replaced = 0
+        self.conflicts = []
+
+    def add(self, resource, source=None):
+        key = resource['resourceType'] + "/" + resource['id']
+        previous = self.resources.get(key)
+        if previous is None:
+            self.added = self.added + 1
+        elif previous == resource:
+            return
+        else:
+            self.replaced = self.replaced + 1
+            self.conflicts.append((key, self.sources.get(key), source))
+        self.resources[key] = resource
+        self.sources[key] = source
+
+    def merge(self, resources, source=None):
+        for resource in resources:
+            self.add(resource, source)
+
+    # the bundle an earlier run wrote, which the reports skipped as unchanged still refer to. A bundle of another
+    # type is not merged, its references would not fit
+    def load(self, path, bundleType='collection'):
+        import json
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as infile:
+            bundle = json.load(infile)
+        if bundle.get('type') != ("Collection" if bundleType == 'collection' else bundleType):
+            return
+        # references in a transaction point at fullUrls; they are turned back into "Type/id" by rewriting with the
+        # fullUrls mapped the other way round
+        original = foundationTransactionEntries(self.bundleId)
+        for entry in bundle['entry']:
+            if 'fullUrl' in entry:
+                original.fullUrls[entry['fullUrl']] = entry['resource']['resourceType'] + "/" + entry['resource']['id']
+        for entry in bundle['entry']:
+            resource = original.rewrite(entry['resource'])
+            self.resources[resource['resourceType'] + "/" + resource['id']] = resource
+            self.sources[resource['resourceType'] + "/" + resource['id']] = path
+
+    def createBundle(self, bundleType='collection'):
+        transaction = None
+        if bundleType != 'collection':
+            transaction = foundationTransactionEntries(self.bundleId, bundleType)
+            for key in self.resources:
+                transaction.register(self.resources[key])
+        bundle = foundationToFhirBundle(transaction)
+        for key in sorted(self.resources):
+            bundle.addEntry(self.resources[key])
+        bundle.bundleResource['id'] = self.bundleId
+        return bundle
+
+    def write(self, path, bundleType='collection', serializer=None):
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tempFile = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tempFile, 'wb') as outfile:
+                dumpFoundationBundle(self.createBundle(bundleType).bundleResource, outfile, serializer)
+            os.replace(tempFile, path)
+        except:
+            if os.path.exists(tempFile):
+                os.remove(tempFile)
+            raise
+
+# the transaction entries of a report, with the resources every report has registered up front, so references to
+# them are rewritten even in entries written before them. With shared, the resources shared with other reports are
+# left to the shared-resources bundle
+def createFoundationTransactionEntries(report, bundleType, shared=False):
+    transaction = foundationTransactionEntries("FoundationMedicine-" + report.diagnosticReport.getDiagnosticReportId(),
+                                               bundleType)
+    for resource in getFoundationSharedResources(report):
+        if shared:
+            transaction.registerShared(resource)
+        else:
+            transaction.register(resource)
+    transaction.register(report.diagnosticReport.diagnosticReportResource)
+    transaction.register(report.condition.conditionResource)
+    transaction.register(report.documentReference.documentReferenceResource)
+    transaction.register(report.procedureRequest.procedureRequestResource)
+    transaction.register(report.specimen.specimenResource)
+    return transaction
+
+# indents everything written through it by one more level. JSON strings never hold a raw newline, so every newline
+# in encoded JSON starts an indented line
+class foundationIndentedFile:
+    def __init__(self, outfile, indent):
+        self.outfile = outfile
+        self.newline = b'\n' + indent
+
+    def write(self, data):
+        self.outfile.write(bytes(data).replace(b'\n', self.newline))
+
+# writes a collection bundle entry by entry instead of holding it in memory. The JSON is the same as
+# dumpFoundationBundle on a foundationToFhirBundle with the same entries, compact or pretty: a pretty serializer's
+# entries are encoded on their own and written two levels deeper, inside the bundle's entry list
+class foundationStreamingBundleWriter:
+    def __init__(self, outfile, bundleId, serializer=None, metrics=None, transaction=None, references=None,
+                 validator=None):
+        if serializer is None:
+            serializer = getFoundationJsonSerializer()
+        self.outfile = outfile
+        self.bundleId = bundleId
+        self.serializer = serializer
+        self.metrics = metrics
+        self.transaction = transaction
+        self.references = references
+        self.validator = validator
+        self.entries = 0
+        self.pretty = serializer.pretty
+        bundleType = "Collection" if transaction is None else transaction.bundleType
+        if self.pretty:
+            self.entryFile = foundationIndentedFile(outfile, b'    ')
+            outfile.write(b'{\n  "resourceType": "Bundle",\n  "type": ' + serializer.encode(bundleType) +
+                          b',\n  "entry": [')
+        else:
+            self.entryFile = outfile
+            outfile.write(b'{"resourceType":"Bundle","type":' + serializer.encode(bundleType) + b',"entry":[')
+
+    def startEntry(self):
+        if self.entries > 0:
+            self.outfile.write(b',')
+        if self.pretty:
+            self.outfile.write(b'\n    ')
+
+    def addEntry(self, resource):
+        if self.metrics is not None:
+            self.metrics.countReferences(resource)
+        self.startEntry()
+        if self.transaction is None:
+            entry = {'resource': resource}
+        else:
+            entry = self.transaction.entry(resource)
+        if self.references is not None:
+            self.references.addEntry(entry)
+        if self.validator is not None:
+            self.validator.addEntry(entry)
+        dumpFoundationBundle(entry, self.entryFile, self.serializer)
+        self.entries = self.entries + 1
+
+    # entry is the transaction entry the resource was encoded from, if any; its other fields are written around it
+    def addEncodedEntry(self, encodedResource, entry=None):
+        self.startEntry()
+        if self.pretty:
+            if entry is None:
+                entry = {'resource': None}
+            fields = []
+            for key in entry:
+                if key == 'resource':
+                    value = encodedResource
+                else:
+                    value = self.serializer.encode(entry[key])
+                fields.append(b'  ' + self.serializer.encode(key) + b': ' + value.replace(b'\n', b'\n  '))
+            self.entryFile.write(b'{\n' + b',\n'.join(fields) + b'\n}')
+        elif entry is None:
+            self.outfile.write(b'{"resource":' + encodedResource + b'}')
+        else:
+            fields = []
+            for key in entry:
+                if key == 'resource':
+                    fields.append(b'"resource":' + encodedResource)
+                else:
+                    fields.append(self.serializer.encode(key) + b':' + self.serializer.encode(entry[key]))
+            self.outfile.write(b'{' + b','.join(fields) + b'}')
+        self.entries = self.entries + 1
+
+    def close(self):
+        if self.pretty:
+            self.outfile.write(b'\n  ],\n  "id": ' + self.serializer.encode("FoundationMedicine-" + self.bundleId) +
+                               b'\n}')
+        else:
+            self.outfile.write(b'],"id":' + self.serializer.encode("FoundationMedicine-" + self.bundleId) + b'}')
+
+# stands in for the observation and sequence lists the builders append to when the bundle is streamed. Every
+# appended resource is written out straight away. Observations are also spooled into DiagnosticReport.contained,
+# and only their id and display are kept, which is all DiagnosticReport.result and Provenance.target need
+class foundationStreamedResources:
+    def __init__(self, writer, contained=None):
+        self.writer = writer
+        self.contained = contained
+        self.written = []
+        self.count = 0
+
+    def append(self, resourceObject):
+        self.count = self.count + 1
+        if isinstance(resourceObject, foundationFhirObservation):
+            resource = resourceObject.observationResource
+        else:
+            resource = resourceObject.sequenceResource
+        if self.writer.metrics is not None:
+            self.writer.metrics.countReferences(resource)
+        entry = None
+        if self.writer.transaction is not None:
+            # the contained copy gets the rewritten references as well, like in a built bundle
+            entry = self.writer.transaction.entry(resource)
+            resource = entry['resource']
+        if self.writer.references is not None:
+            self.writer.references.addEntry(entry or {'resource': resource})
+        if self.writer.validator is not None:
+            self.writer.validator.addEntry(entry or {'resource': resource})
+        encodedResource = self.writer.serializer.encode(resource)
+        if isinstance(resourceObject, foundationFhirObservation):
+            if self.contained is not None:
+                self.addContained(encodedResource)
+            resourceObject.observationResource = {'id': resourceObject.getObservationId()}
+            self.written.append(resourceObject)
+        self.writer.addEncodedEntry(encodedResource, entry)
+
+    # pretty contained resources are items of resource.contained in an entry, three levels deep
+    def addContained(self, encodedResource):
+        if self.contained.length > 0:
+            self.contained.write(b',')
+        else:
+            self.contained.write(b'[')
+        if self.writer.pretty:
+            self.contained.write(b'\n      ' + encodedResource.replace(b'\n', b'\n      '))
+        else:
+            self.contained.write(encodedResource)
+
+    def closeContained(self):
+        if self.writer.pretty:
+            self.contained.write(b'\n    ]')
+        else:
+            self.contained.write(b']')
+
+# opt-in per-report instrumentation. The pipeline functions take metrics=None and only call mark() and count() when
+# one is given, so a conversion without metrics pays one None check per stage. mark(stage) adds the time since the
+# previous mark (or since the object was created) to that stage
+class foundationConversionMetrics:
+    __slots__ = ('stages', 'counts', 'lastMark')
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.lastMark = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self.lastMark
+        self.lastMark = now
+
+    def count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    # references between resources. contained copies are skipped, so a streamed and a built bundle count the same
+    def countReferences(self, resource):
+        references = 0
+        stack = [resource]
+        while len(stack) > 0:
+            value = stack.pop()
+            if isinstance(value, dict):
+                if 'reference' in value:
+                    references = references + 1
+                for key in value:
+                    if key != 'contained':
+                        stack.append(value[key])
+            elif isinstance(value, list):
+                stack.extend(value)
+        self.count('references', references)
+
+    def toDict(self):
+        return {'stages': self.stages, 'counts': self.counts}
+
+# the (file, line) sites of the profile's own bookkeeping (the sites it lists, self.memory and the stage times),
+# which are not part of the conversion. They are skipped in the per-line statistics: a tracemalloc.Filter per line
+# would be matched against every trace of every snapshot and double the time the profile takes
+@functools.lru_cache(maxsize=None)
+def foundationMemoryProfileSites():
+    import dis
+    sites = set()
+    for method in (foundationConversionMetrics.mark, foundationMemoryProfile.mark):
+        for offset, lineno in dis.findlinestarts(method.__code__):
+            sites.add((method.__code__.co_filename, lineno))
+    return frozenset(sites)
+
+# --memory-profile. Traces allocations while one report is converted; at every stage boundary it records the memory
+# still held, the peak reached during the stage and the source lines that allocated the most since the previous
+# boundary. Snapshots are slow, so the time of a stage does not include taking them
+class foundationMemoryProfile(foundationConversionMetrics):
+    __slots__ = ('memory', 'snapshot', 'topSites')
+
+    def __init__(self, topSites=5):
+        import tracemalloc
+        # found before tracing starts, so importing dis is not the first stage's top site
+        foundationMemoryProfileSites()
+        tracemalloc.start()
+        self.memory = {}
+        self.topSites = topSites
+        self.snapshot = self.takeSnapshot()
+        foundationConversionMetrics.__init__(self)
+
+    def takeSnapshot(self):
+        import tracemalloc
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, '<unknown>')
+        ))
+
+    def mark(self, stage):
+        import tracemalloc
+        foundationConversionMetrics.mark(self, stage)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        snapshot = self.takeSnapshot()
+        sites = []
+        ownSites = foundationMemoryProfileSites()
+        for statistic in snapshot.compare_to(self.snapshot, 'lineno'):
+            if len(sites) == self.topSites:
+                break
+            frame = statistic.traceback[0]
+            if (frame.filename, frame.lineno) in ownSites:
+                continue
+            sites.append({
+                'site': os.path.basename(frame.filename) + ":" + str(frame.lineno),
+                'bytes': statistic.size_diff,
+                'blocks': statistic.count_diff
+            })
+        self.memory[stage] = {'current': current, 'peak': peak, 'top': sites}
+        self.snapshot = snapshot
+        self.lastMark = time.perf_counter()
+
+    def stop(self):
+        import tracemalloc
+        tracemalloc.stop()
+        self.snapshot = None
+
+    def toDict(self):
+        metrics = foundationConversionMetrics.toDict(self)
+        metrics['memory'] = self.memory
+        return metrics
+
+# --check-references. Indexes the id and fullUrl of every entry and collects every reference as the entries go by,
+# and resolves the references against the index once the bundle is complete, so checking is one pass over the
+# resources even when the bundle is streamed and never held in memory. Like countReferences it does not walk
+# contained resources, which are copies of entries. Absolute URLs point outside the bundle and are not checked
+class foundationReferenceIndex:
+    __slots__ = ('targets', 'references')
+
+    def __init__(self):
+        self.targets = set()
+        # (resource, reference) pairs
+        self.references = []
+
+    # entry is a bundle entry, {'resource': resource} for a collection bundle
+    def addEntry(self, entry):
+        resource = entry['resource']
+        source = resource['resourceType'] + "/" + resource['id']
+        self.targets.add(source)
+        if 'fullUrl' in entry:
+            self.targets.add(entry['fullUrl'])
+        contained = resource.get('contained')
+        if isinstance(contained, list):
+            for containedResource in contained:
+                self.targets.add(source + "#" + containedResource['id'])
+        references = self.references
+        stack = [resource]
+        while len(stack) > 0:
+            value = stack.pop()
+            if type(value) is dict:
+                reference = value.get('reference')
+                if type(reference) is str:
+                    references.append((source, reference))
+                for key, item in value.items():
+                    if (type(item) is dict or type(item) is list) and key != 'contained':
+                        stack.append(item)
+            else:
+                for item in value:
+                    if type(item) is dict or type(item) is list:
+                        stack.append(item)
+
+    # a resource of the shared-resources bundle, referred to by id or, in a transaction, conditionally
+    def addShared(self, resource):
+        self.targets.add(resource['resourceType'] + "/" + resource['id'])
+        ifNoneExist = foundationIfNoneExist(resource)
+        if ifNoneExist is not None:
+            self.targets.add(resource['resourceType'] + "?" + ifNoneExist)
+
+    # the (resource, reference) pairs whose target is not in the bundle
+    def dangling(self):
+        dangling = []
+        for source, reference in self.references:
+            if reference.startswith('#'):
+                if source + reference not in self.targets:
+                    dangling.append((source, reference))
+            elif reference not in self.targets and not reference.startswith(('http://', 'https://')):
+                dangling.append((source, reference))
+        return dangling
+
+# --validate. A compact rule set for the DSTU3 resource types this module emits. Every type maps its elements to
+# "[cardinality] type [code|code...]": no cardinality is 0..1, '1' is 1..1, '*' 0..* and '+' 1..*, and a code may list
+# the codes it allows. name[x] elements take one of the '|' separated types (effective[x]: 'dateTime|Period' allows
+# effectiveDateTime or effectivePeriod). Backbone elements are types of their own, named Resource.element. Elements
+# that DSTU3 requires but FoundationOne reports have no data for (Observation.code, ProcedureRequest.code,
+# DocumentReference.type, Sequence.coordinateSystem and the referenceSeq window) are kept optional
+foundationValidatedResourceTypes = ('Observation', 'Sequence', 'Specimen', 'DiagnosticReport', 'Provenance',
+                                    'ProcedureRequest', 'DocumentReference', 'Condition')
+
+foundationValidationRules = {
+    'Coding': {'system': 'uri', 'version': 'string', 'code': 'code', 'display': 'string', 'userSelected': 'boolean'},
+    'CodeableConcept': {'coding': '* Coding', 'text': 'string'},
+    'Reference': {'reference': 'string', 'identifier': 'Identifier', 'display': 'string'},
+    'Identifier': {'use': 'code usual|official|temp|secondary', 'type': 'CodeableConcept', 'system': 'uri',
+                   'value': 'string', 'period': 'Period', 'assigner': 'Reference'},
+    'Period': {'start': 'dateTime', 'end': 'dateTime'},
+    'Quantity': {'value': 'decimal', 'comparator': 'code <|<=|>=|>', 'unit': 'string', 'system': 'uri', 'code': 'code'},
+    'Range': {'low': 'Quantity', 'high': 'Quantity'},
+    'Ratio': {'numerator': 'Quantity', 'denominator': 'Quantity'},
+    'Narrative': {'status': '1 code generated|extensions|additional|empty', 'div': '1 xhtml'},
+    'Annotation': {'author[x]': 'Reference|string', 'time': 'dateTime', 'text': '1 string'},
+    'Attachment': {'contentType': 'code', 'language': 'code', 'data': 'base64Binary', 'url': 'uri',
+                   'size': 'unsignedInt', 'hash': 'base64Binary', 'title': 'string', 'creation': 'dateTime'},
+    'Signature': {'type': '+ Coding', 'when': '1 instant', 'who[x]': '1 uri|Reference', 'onBehalfOf[x]': 'uri|Reference',
+                  'contentType': 'code', 'blob': 'base64Binary'},
+    'Meta': {'versionId': 'id', 'lastUpdated': 'instant', 'profile': '* uri', 'security': '* Coding', 'tag': '* Coding'},
+    'Extension': {'url': '1 uri', 'value[x]': 'boolean|integer|decimal|string|uri|code|date|dateTime|instant|Coding|'
+                                             'CodeableConcept|Reference|Identifier|Period|Quantity|Range|Ratio|Attachment'},
+
+    'Observation': {
+        'identifier': '* Identifier', 'basedOn': '* Reference',
+        'status': '1 code registered|preliminary|final|amended|corrected|cancelled|entered-in-error|unknown',
+        'category': '* CodeableConcept', 'code': 'CodeableConcept', 'subject': 'Reference', 'context': 'Reference',
+        'effective[x]': 'dateTime|Period', 'issued': 'instant', 'performer': '* Reference',
+        'value[x]': 'Quantity|CodeableConcept|string|boolean|Range|Ratio|time|dateTime|Period|Attachment',
+        'dataAbsentReason': 'CodeableConcept', 'interpretation': 'CodeableConcept', 'comment': 'string',
+        'bodySite': 'CodeableConcept', 'method': 'CodeableConcept', 'specimen': 'Reference', 'device': 'Reference',
+        'referenceRange': '* Observation.referenceRange', 'related': '* Observation.related',
+        'component': '* Observation.component'
+    },
+    'Observation.referenceRange': {'low': 'Quantity', 'high': 'Quantity', 'type': 'CodeableConcept',
+                                   'appliesTo': '* CodeableConcept', 'age': 'Range', 'text': 'string'},
+    'Observation.related': {'type': 'code has-member|derived-from|sequel-to|replaces|qualified-by|interfered-by',
+                            'target': '1 Reference'},
+    'Observation.component': {
+        'code': '1 CodeableConcept',
+        'value[x]': 'Quantity|CodeableConcept|string|Range|Ratio|time|dateTime|Period|Attachment',
+        'dataAbsentReason': 'CodeableConcept', 'interpretation': 'CodeableConcept',
+        'referenceRange': '* Observation.referenceRange'
+    },
+
+    'Sequence': {
+        'identifier': '* Identifier', 'type': 'code aa|dna|rna', 'coordinateSystem': 'integer', 'patient': 'Reference',
+        'specimen': 'Reference', 'device': 'Reference', 'performer': 'Reference', 'quantity': 'Quantity',
+        'referenceSeq': 'Sequence.referenceSeq', 'variant': '* Sequence.variant', 'observedSeq': 'string',
+        'quality': '* Sequence.quality', 'readCoverage': 'integer', 'repository': '* Sequence.repository',
+        'pointer': '* Reference',
+        # not part of DSTU3
+        'structureVariant': '* Sequence.structureVariant'
+    },
+    'Sequence.referenceSeq': {'chromosome': 'CodeableConcept', 'genomeBuild': 'string',
+                              'referenceSeqId': 'CodeableConcept', 'referenceSeqPointer': 'Reference',
+                              'referenceSeqString': 'string', 'strand': 'integer', 'windowStart': 'integer',
+                              'windowEnd': 'integer'},
+    'Sequence.variant': {'start': 'integer', 'end': 'integer', 'observedAllele': 'string', 'referenceAllele': 'string',
+                         'cigar': 'string', 'variantPointer': 'Reference'},
+    'Sequence.quality': {'type': '1 code indel|snp|unknown', 'standardSequence': 'CodeableConcept', 'start': 'integer',
+                         'end': 'integer', 'score': 'Quantity', 'method': 'CodeableConcept', 'truthTP': 'decimal',
+                         'queryTP': 'decimal', 'truthFN': 'decimal', 'queryFP': 'decimal', 'gtFP': 'decimal',
+                         'precision': 'decimal', 'recall': 'decimal', 'fScore': 'decimal'},
+    'Sequence.repository': {'type': '1 code directlink|openapi|login|oauth|other', 'url': 'uri', 'name': 'string',
+                            'datasetId': 'string', 'variantsetId': 'string', 'readsetId': 'string'},
+    'Sequence.structureVariant': {'precisionOfBoundaries': 'string', 'reportedaCGHRatio': 'decimal', 'length': 'integer',
+                                  'outer': 'Sequence.structureVariant.span', 'inner': 'Sequence.structureVariant.span'},
+    'Sequence.structureVariant.span': {'start': 'integer', 'end': 'integer'},
+
+    'Specimen': {
+        'identifier': '* Identifier', 'accessionIdentifier': 'Identifier',
+        'status': 'code available|unavailable|unsatisfactory|entered-in-error', 'type': 'CodeableConcept',
+        'subject': '1 Reference', 'receivedTime': 'dateTime', 'parent': '* Reference', 'request': '* Reference',
+        'collection': 'Specimen.collection', 'processing': '* Specimen.processing',
+        'container': '* Specimen.container', 'note': '* Annotation'
+    },
+    'Specimen.collection': {'collector': 'Reference', 'collected[x]': 'dateTime|Period', 'quantity': 'Quantity',
+                            'method': 'CodeableConcept', 'bodySite': 'CodeableConcept'},
+    'Specimen.processing': {'description': 'string', 'procedure': 'CodeableConcept', 'additive': '* Reference',
+                            'time[x]': 'dateTime|Period'},
+    'Specimen.container': {'identifier': '* Identifier', 'description': 'string', 'type': 'CodeableConcept',
+                           'capacity': 'Quantity', 'specimenQuantity': 'Quantity',
+                           'additive[x]': 'CodeableConcept|Reference'},
+
+    'DiagnosticReport': {
+        'identifier': '* Identifier', 'basedOn': '* Reference',
+        'status': '1 code registered|partial|preliminary|final|amended|corrected|appended|cancelled|entered-in-error|'
+                  'unknown',
+        'category': 'CodeableConcept', 'code': '1 CodeableConcept', 'subject': 'Reference', 'context': 'Reference',
+        'effective[x]': 'dateTime|Period', 'issued': 'instant', 'performer': '* DiagnosticReport.performer',
+        'specimen': '* Reference', 'result': '* Reference', 'imagingStudy': '* Reference',
+        'image': '* DiagnosticReport.image', 'conclusion': 'string', 'codedDiagnosis': '* CodeableConcept',
+        'presentedForm': '* Attachment'
+    },
+    'DiagnosticReport.performer': {'role': 'CodeableConcept', 'actor': '1 Reference'},
+    'DiagnosticReport.image': {'comment': 'string', 'link': '1 Reference'},
+
+    'Provenance': {
+        'target': '+ Reference', 'period': 'Period', 'recorded': '1 instant', 'policy': '* uri', 'location': 'Reference',
+        'reason': '* Coding', 'activity': 'Coding', 'agent': '+ Provenance.agent', 'entity': '* Provenance.entity',
+        'signature': '* Signature'
+    },
+    'Provenance.agent': {'role': '* CodeableConcept', 'who[x]': '1 uri|Reference', 'onBehalfOf[x]': 'uri|Reference',
+                         'relatedAgentType': 'CodeableConcept'},
+    'Provenance.entity': {'role': '1 code derivation|revision|quotation|source|removal',
+                          'what[x]': '1 uri|Reference|Identifier', 'agent': '* Provenance.agent'},
+
+    'ProcedureRequest': {
+        'identifier': '* Identifier', 'definition': '* Reference', 'basedOn': '* Reference', 'replaces': '* Reference',
+        'requisition': 'Identifier', 'status': '1 code draft|active|suspended|completed|entered-in-error|cancelled|unknown',
+        'intent': '1 code proposal|plan|order|original-order|reflex-order|filler-order|instance-order|option',
+        'priority': 'code routine|urgent|asap|stat', 'doNotPerform': 'boolean', 'category': '* CodeableConcept',
+        'code': 'CodeableConcept', 'subject': '1 Reference', 'context': 'Reference', 'occurrence[x]': 'dateTime|Period',
+        'asNeeded[x]': 'boolean|CodeableConcept', 'authoredOn': 'dateTime', 'requester': 'ProcedureRequest.requester',
+        'performerType': 'CodeableConcept', 'performer': 'Reference', 'reasonCode': '* CodeableConcept',
+        'reasonReference': '* Reference', 'supportingInfo': '* Reference', 'specimen': '* Reference',
+        'bodySite': '* CodeableConcept', 'note': '* Annotation', 'relevantHistory': '* Reference'
+    },
+    'ProcedureRequest.requester': {'agent': '1 Reference', 'onBehalfOf': 'Reference'},
+
+    'DocumentReference': {
+        'masterIdentifier': 'Identifier', 'identifier': '* Identifier',
+        'status': '1 code current|superseded|entered-in-error',
+        'docStatus': 'code preliminary|final|appended|amended|entered-in-error', 'type': 'CodeableConcept',
+        'class': 'CodeableConcept', 'subject': 'Reference', 'created': 'dateTime', 'indexed': '1 instant',
+        'author': '* Reference', 'authenticator': 'Reference', 'custodian': 'Reference',
+        'relatesTo': '* DocumentReference.relatesTo', 'description': 'string', 'securityLabel': '* CodeableConcept',
+        'content': '+ DocumentReference.content', 'context': 'DocumentReference.context'
+    },
+    'DocumentReference.relatesTo': {'code': '1 code replaces|transforms|signs|appends', 'target': '1 Reference'},
+    'DocumentReference.content': {'attachment': '1 Attachment', 'format': 'Coding'},
+    'DocumentReference.context': {'encounter': 'Reference', 'event': '* CodeableConcept', 'period': 'Period',
+                                  'facilityType': 'CodeableConcept', 'practiceSetting': 'CodeableConcept',
+                                  'sourcePatientInfo': 'Reference', 'related': '* DocumentReference.context.related'},
+    'DocumentReference.context.related': {'identifier': 'Identifier', 'ref': 'Reference'},
+
+    'Condition': {
+        'identifier': '* Identifier', 'clinicalStatus': 'code active|recurrence|inactive|remission|resolved',
+        'verificationStatus': 'code provisional|differential|confirmed|refuted|entered-in-error|unknown',
+        'category': '* CodeableConcept', 'severity': 'CodeableConcept', 'code': 'CodeableConcept',
+        'bodySite': '* CodeableConcept', 'subject': '1 Reference', 'context': 'Reference',
+        'onset[x]': 'dateTime|Quantity|Period|Range|string', 'abatement[x]': 'dateTime|Quantity|boolean|Period|Range|string',
+        'assertedDate': 'dateTime', 'asserter': 'Reference', 'stage': 'Condition.stage',
+        'evidence': '* Condition.evidence', 'note': '* Annotation'
+    },
+    'Condition.stage': {'summary': 'CodeableConcept', 'assessment': '* Reference'},
+    'Condition.evidence': {'code': '* CodeableConcept', 'detail': '* Reference'}
+}
+
+# what every resource and every other element may have on top of its own elements
+foundationValidationResourceElements = {'resourceType': '1 string', 'id': 'id', 'meta': 'Meta', 'implicitRules': 'uri',
+                                        'language': 'code', 'text': 'Narrative', 'contained': '* Resource',
+                                        'extension': '* Extension', 'modifierExtension': '* Extension'}
+foundationValidationElementElements = {'id': 'string', 'extension': '* Extension'}
+foundationValidationPlainTypes = {'string': str, 'uri': str, 'xhtml': str, 'boolean': bool}
+
+# a value in an error message, shortened so a wrongly placed PDF does not end up in the output
+def foundationValidationValue(value):
+    text = repr(value)
+    if len(text) > 40:
+        text = text[:37] + "..."
+    return text
+
+# compiles foundationValidationRules into one checker per type, on first use. A checker takes a value and returns
+# None when it is valid, or else its problems as ['.element[0].element: problem', ...]. Paths are only built for
+# values that have problems, so checking a valid bundle allocates next to nothing. The 'Resource' checker picks the
+# checker from the resourceType and passes resources without rules (Organization, Practitioner, Patient)
+@functools.lru_cache(maxsize=None)
+def compileFoundationValidationRules():
+    import re
+    # DSTU3 wants a time zone on every time with hours, which FoundationOne's ServerTime does not carry, so it is
+    # optional here
+    timeZone = r'(Z|[+-]((0[0-9]|1[0-3]):[0-5][0-9]|14:00))?'
+    timeOfDay = r'([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]+)?'
+    day = r'(0[1-9]|[12][0-9]|3[01])'
+    month = r'(0[1-9]|1[0-2])'
+    patterns = {
+        'date': re.compile(r'-?[0-9]{4}(-' + month + '(-' + day + ')?)?').fullmatch,
+        'dateTime': re.compile(r'-?[0-9]{4}(-' + month + '(-' + day + '(T' + timeOfDay + timeZone + ')?)?)?').fullmatch,
+        'instant': re.compile(r'[0-9]{4}-' + month + '-' + day + 'T' + timeOfDay + timeZone).fullmatch,
+        'time': re.compile(timeOfDay).fullmatch,
+        'code': re.compile(r'[^\s]+( [^\s]+)*').fullmatch,
+        'id': re.compile(r'[A-Za-z0-9\-.]{1,64}').fullmatch
+    }
+    tests = {
+        'boolean': lambda value: type(value) is bool,
+        'integer': lambda value: type(value) is int,
+        'unsignedInt': lambda value: type(value) is int and value >= 0,
+        'decimal': lambda value: type(value) is int or type(value) is float,
+        'string': lambda value: type(value) is str,
+        'uri': lambda value: type(value) is str,
+        'xhtml': lambda value: type(value) is str,
+        # an inlined PDF is still spooled when a streamed bundle is checked
+        'base64Binary': lambda value: type(value) is str or isinstance(value, foundationSpooledText)
+    }
+    for name in patterns:
+        tests[name] = lambda value, match=patterns[name]: type(value) is str and match(value) is not None
+
+    def compilePrimitive(name, codes):
+        test = tests[name]
+        if codes is not None:
+            codes = frozenset(codes)
+            def check(value):
+                if type(value) is str and value in codes:
+                    return None
+                return [": %s is not one of %s" % (foundationValidationValue(value), '|'.join(sorted(codes)))]
+        else:
+            def check(value):
+                if test(value):
+                    return None
+                return [": %s is not a valid %s" % (foundationValidationValue(value), name)]
+        return check
+
+    # element -> [plain, many, type, choice]. plain is the Python type of a string, uri, xhtml or boolean that is not
+    # part of a choice, which the loop below checks inline as those are most of the values. The types of the other
+    # elements are replaced by their checkers once every type is compiled
+    def compileStructure(name, rules):
+        elements = {}
+        required = []
+        for element, rule in rules.items():
+            rule = rule.split()
+            cardinality = rule.pop(0) if rule[0] in ('1', '*', '+') else None
+            many = cardinality in ('*', '+')
+            if element.endswith('[x]'):
+                choice = element[:-3]
+                names = [choice + typeName[0].upper() + typeName[1:] for typeName in rule[0].split('|')]
+                for typeName, choiceName in zip(rule[0].split('|'), names):
+                    elements[choiceName] = [None, many, (typeName, None), choice]
+                if cardinality in ('1', '+'):
+                    required.append((element, tuple(names)))
+            else:
+                plain = None
+                if not many and len(rule) == 1:
+                    plain = foundationValidationPlainTypes.get(rule[0])
+                elements[element] = [plain, many, (rule[0], rule[1].split('|') if len(rule) > 1 else None), None]
+                if cardinality in ('1', '+'):
+                    required.append((element, (element,)))
+
+        def check(value):
+            if type(value) is not dict:
+                return [": %s is not a %s" % (foundationValidationValue(value), name)]
+            problems = None
+            choices = None
+            for key, item in value.items():
+                element = elements.get(key)
+                if element is None:
+                    problems = (problems or []) + ["." + key + ": not an element of " + name]
+                    continue
+                plain = element[0]
+                if plain is not None:
+                    if type(item) is not plain:
+                        problems = (problems or []) + ["." + key + ": %s is not a valid %s" %
+                                                       (foundationValidationValue(item), element[2][0])]
+                    continue
+                found = None
+                if element[1]:
+                    if type(item) is not list or len(item) == 0:
+                        found = ["." + key + ": %s is not a non-empty array" % foundationValidationValue(item)]
+                    else:
+                        checkItem = element[2]
+                        for each in item:
+                            if checkItem(each) is not None:
+                                found = []
+                                for i, each in enumerate(item):
+                                    for problem in checkItem(each) or []:
+                                        found.append("." + key + "[%d]" % i + problem)
+                                break
+                elif type(item) is list:
+                    found = ["." + key + ": is an array, but takes a single value"]
+                else:
+                    itemProblems = element[2](item)
+                    if itemProblems is not None:
+                        found = ["." + key + problem for problem in itemProblems]
+                if element[3] is not None:
+                    if choices is None:
+                        choices = set()
+                    if element[3] in choices:
+                        found = (found or []) + ["." + key + ": only one %s[x] is allowed" % element[3]]
+                    choices.add(element[3])
+                if found is not None:
+                    problems = (problems or []) + found
+            for element, names in required:
+                for choiceName in names:
+                    if choiceName in value:
+                        break
+                else:
+                    problems = (problems or []) + ["." + element + ": is required"]
+            return problems
+        return check, elements
+
+    checkers = {}
+    structures = []
+    for name, rules in foundationValidationRules.items():
+        if name in foundationValidatedResourceTypes:
+            rules = dict(foundationValidationResourceElements, **rules)
+        else:
+            rules = dict(foundationValidationElementElements, **rules)
+        checkers[name], elements = compileStructure(name, rules)
+        structures.append(elements)
+    resourceCheckers = dict((name, checkers[name]) for name in foundationValidatedResourceTypes)
+
+    def checkResource(value):
+        if type(value) is not dict:
+            return [": %s is not a resource" % foundationValidationValue(value)]
+        check = resourceCheckers.get(value.get('resourceType'))
+        if check is None:
+            return None
+        return check(value)
+    checkers['Resource'] = checkResource
+
+    primitives = {}
+    for elements in structures:
+        for element in elements.values():
+            typeName, codes = element[2]
+            if element[0] is not None:
+                continue
+            if typeName in checkers:
+                element[2] = checkers[typeName]
+            else:
+                key = (typeName, tuple(codes) if codes is not None else None)
+                if key not in primitives:
+                    primitives[key] = compilePrimitive(typeName, codes)
+                element[2] = primitives[key]
+    return checkers
+
+# collects the problems of every entry as they go by, like foundationReferenceIndex. Like it, it leaves out contained
+# resources, which are copies of entries (and spooled in a streamed bundle)
+class foundationResourceValidator:
+    __slots__ = ('check', 'errors')
+
+    def __init__(self):
+        self.check = compileFoundationValidationRules()['Resource']
+        self.errors = []
+
+    def addEntry(self, entry):
+        resource = entry['resource']
+        if 'contained' in resource:
+            resource = dict(resource)
+            del resource['contained']
+        problems = self.check(resource)
+        if problems is not None:
+            source = resource['resourceType'] + "/" + str(resource.get('id'))
+            for problem in problems:
+                self.errors.append(source + problem)
+
+# the resources every report produces before any observation is built
+class foundationFhirReportResources:
+    __slots__ = ('FoundationMedicine', 'organization', 'orderingPhysician', 'patient', 'pathologist', 'diagnosticReport', 'condition', 'documentReference', 'procedureRequest', 'specimen')
 
+    def __init__(self):
+        self.FoundationMedicine = None
+        self.organization = None
+        self.orderingPhysician = None
+        self.patient = None
+        self.pathologist = None
+        self.diagnosticReport = None
+        self.condition = None
+        self.documentReference = None
+        self.procedureRequest = None
+        self.specimen = None
+
+def createFoundationReportResources(DOM, pdfBlobDirectory=None):
     FoundationMedicine = foundationFhirOrganization()
     createFoundationMedicineOrganization(FoundationMedicine.organizationResource)
 
@@ -1367,6 +2756,7 @@ for f in files:
 
     orderingPhysician = foundationFhirPractitioner()
     practitionerAddIdFromFoundation(orderingPhysician.practitionerResource, 'OrderingMDId', DOM)
+    practitionerAddIdentifierFromFoundation(orderingPhysician.practitionerResource, 'OrderingMDId', DOM)
     practitionerAddNameFromFoundation(orderingPhysician.practitionerResource, 'OrderingMD', DOM)
     practitionerAddRoleFromFoundation(orderingPhysician.practitionerResource, 'OrderingMD', organization)
 
@@ -1378,18 +2768,18 @@ for f in files:
     patientAddIdentifierFromFoundation(patient.patientResource, DOM)
 
     pathologist = foundationFhirPractitioner()
-    pathologist.practitionerResource['id'] = patient.patientResource['id'] + "patho1"
+    # the patient's pathologist can change between reports, so the name is part of the id
+    pathologist.practitionerResource['id'] = patient.patientResource['id'] + "-patho-" + foundationNameId(DOM.getFirstText('Pathologist'))
     practitionerAddNameFromFoundation(pathologist.practitionerResource, 'Pathologist', DOM)
     practitionerAddRoleFromFoundation(pathologist.practitionerResource, 'Pathologist', None)
 
     diagnosticReport = foundationFhirDiagnosticReport()
-    # passing in entire diagnosticReport, not just resource, because we record how many observations we have
-    diagnosticReportAddConclusionFromFoundation(diagnosticReport, DOM)
+    diagnosticReportAddConclusionFromFoundation(diagnosticReport.diagnosticReportResource, DOM)
     diagnosticReportAddId(diagnosticReport.diagnosticReportResource, DOM)
     diagnosticReportAddCategoryFromFoundation(diagnosticReport.diagnosticReportResource, DOM)
     diagnosticReportAddEffectiveDateTimeFromFoundation(diagnosticReport.diagnosticReportResource, DOM)
     addPatientSubjectReference(diagnosticReport.diagnosticReportResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(diagnosticReport.diagnosticReportResource)
+    diagnosticReportAddFoundationAsPerformer(diagnosticReport.diagnosticReportResource)
 
     condition = foundationFhirCondition()
     conditionAddId(condition.conditionResource, patient.getPatientId())
@@ -1400,10 +2790,13 @@ for f in files:
 
     documentReference = foundationFhirDocumentReference()
     addPatientSubjectReference(documentReference.documentReferenceResource, patient.getPatientId(), patient.getPatientFullName())
-    addRecordedTimeFromFoundation(documentReference.documentReferenceResource, DOM)
+    addRecordedTimeFromFoundation(documentReference.documentReferenceResource, DOM, 'indexed')
     addFoundationReferenceWithField(documentReference.documentReferenceResource, 'author')
-    addFoundationReferenceWithField(documentReference.documentReferenceResource, 'custodian')
-    documentReferenceAddBase64EncodingOfPDFFromFoundation(documentReference.documentReferenceResource, DOM)
+    addFoundationSingleReferenceWithField(documentReference.documentReferenceResource, 'custodian')
+    if pdfBlobDirectory is None:
+        documentReferenceAddBase64EncodingOfPDFFromFoundation(documentReference.documentReferenceResource, DOM)
+    else:
+        documentReferenceAddPDFAttachmentFromFoundation(documentReference.documentReferenceResource, DOM, pdfBlobDirectory)
     documentReferenceAddClinicalContextFromFoundation(documentReference.documentReferenceResource, patient, diagnosticReport)
 
     procedureRequest = foundationFhirProcedureRequest()
@@ -1412,7 +2805,7 @@ for f in files:
     procedureRequestAddreasonReference(procedureRequest.procedureRequestResource, condition.getConditionId(), condition.getCondition())
     procedureRequestAddRequester(procedureRequest.procedureRequestResource, orderingPhysician, organization)
     addPatientSubjectReference(procedureRequest.procedureRequestResource, patient.getPatientId(), patient.getPatientFullName())
-    addFoundationAsPerformer(procedureRequest.procedureRequestResource)
+    addFoundationSingleReferenceWithField(procedureRequest.procedureRequestResource, 'performer')
 
     specimen = foundationFhirSpecimen()
     specimenAddId(specimen.specimenResource, DOM)
@@ -1427,53 +2820,1130 @@ for f in files:
     specimenAddNoteFromFoundation(specimen.specimenResource, DOM)
     addPatientSubjectReference(specimen.specimenResource, patient.getPatientId(), patient.getPatientFullName())
 
+    report = foundationFhirReportResources()
+    report.FoundationMedicine = FoundationMedicine
+    report.organization = organization
+    report.orderingPhysician = orderingPhysician
+    report.patient = patient
+    report.pathologist = pathologist
+    report.diagnosticReport = diagnosticReport
+    report.condition = condition
+    report.documentReference = documentReference
+    report.procedureRequest = procedureRequest
+    report.specimen = specimen
+    return report
+
+def createFoundationGenomicObservations(report, DOM):
     observationArr = []
-    initObservations(observationArr, diagnosticReport.getObservationsInReportCount())
-    # add report id to observation objects since it is used to make the ID of all clinical resources
-    addReportIdToObservationObj(observationArr, diagnosticReport.getDiagnosticReportId())
-    addPatientSubjectReferenceToObservations(observationArr, patient.getPatientId(), patient.getPatientFullName())
-    # we add id to observations when adding genomic information..
-    # this is so we can link genomic alterations to therapies and clinical trials
-    observationAddGenomicInfoFromFoundation(observationArr, specimen.getSpecimenId(), specimen.getSpecimenType(), DOM)
-    observationAddEffectiveDateTimeFromFoundation(observationArr, diagnosticReport.getReportDate())
-    relateObservations(observationArr)
-
-    sequenceArr = []
-    variantReportObservations = []
-    addVariantReportShortVariantSequencesAndObservations(variantReportObservations, sequenceArr, diagnosticReport, specimen, patient, DOM)
-    addVariantReportCopyNumberAlterationSequencesAndObservations(variantReportObservations, sequenceArr, diagnosticReport, specimen, patient, DOM)
-    addVariantReportRearrangementSequencesAndObservations(variantReportObservations, sequenceArr, diagnosticReport, specimen, patient, DOM)
-    observationArr = observationArr + variantReportObservations
-
+    # observations are created as the genes, therapies and trials are read, and linked to each other by
+    # foundationObservationLinks; the report id is used to make the ID of all clinical resources
+    observationAddGenomicInfoFromFoundation(observationArr, report.specimen.getSpecimenId(), report.specimen.getSpecimenType(),
+                                            report.diagnosticReport.getDiagnosticReportId(), DOM)
+    addPatientSubjectReferenceToObservations(observationArr, report.patient.getPatientId(), report.patient.getPatientFullName())
+    observationAddEffectiveDateTimeFromFoundation(observationArr, report.diagnosticReport.getReportDate())
+    return observationArr
+
+def addFoundationVariantReportResources(report, observationArr, sequenceArr, DOM):
+    import gc
+    # these stages allocate tens of thousands of small, acyclic dicts. the cyclic collector is paused while they run,
+    # otherwise it keeps rescanning the growing set of resources and costs more than building them
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        addVariantReportShortVariantSequencesAndObservations(observationArr, sequenceArr, report.diagnosticReport, report.specimen, report.patient, DOM)
+        addVariantReportCopyNumberAlterationSequencesAndObservations(observationArr, sequenceArr, report.diagnosticReport, report.specimen, report.patient, DOM)
+        addVariantReportRearrangementSequencesAndObservations(observationArr, sequenceArr, report.diagnosticReport, report.specimen, report.patient, DOM)
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+def linkFoundationDiagnosticReport(report, observationArr):
     # go back and link all of the observations to the diagnostic report
-    diagnosticReportReferenceObservations(diagnosticReport.diagnosticReportResource, observationArr)
-    # also add link specimen back to report, and put them all in contained field for easier access
-    addSpecimenReference(diagnosticReport.diagnosticReportResource, specimen.getSpecimenId(), specimen.getSpecimenType())
-    diagnosticReportAddContainedArr(diagnosticReport.diagnosticReportResource, observationArr, specimen)
+    diagnosticReportReferenceObservations(report.diagnosticReport.diagnosticReportResource, observationArr)
+    # also add link specimen back to report
+    addSpecimenReference(report.diagnosticReport.diagnosticReportResource, report.specimen.getSpecimenId(), report.specimen.getSpecimenType())
 
+def createFoundationProvenance(report, observationArr, DOM):
     provenance = foundationFhirProvenance()
-    provenanceAddId(provenance.provenanceResource, diagnosticReport.getDiagnosticReportId())
+    provenanceAddId(provenance.provenanceResource, report.diagnosticReport.getDiagnosticReportId())
     addRecordedTimeFromFoundation(provenance.provenanceResource, DOM)
-    provenanceAddTargetResources(provenance.provenanceResource, diagnosticReport.getDiagnosticReportId(), diagnosticReport.getNameOfDiagnosticReport(), observationArr)
-    provenanceAddSignaturesFromFoundation(provenance.provenanceResource, foundationPractitionerAsserters(), provenance.getRecordedTime(), DOM)
+    provenanceAddTargetResources(provenance.provenanceResource, report.diagnosticReport.getDiagnosticReportId(), report.diagnosticReport.getNameOfDiagnosticReport(), observationArr)
+    provenance.signers = provenanceAddSignaturesFromFoundation(provenance.provenanceResource, foundationPractitionerAsserters(), provenance.getRecordedTime(), DOM)
     practitionerIdsAndNames = getPractitionerNamesAndIdsFromSignatures(provenance.getSignaturesArray())
     provenanceAddAgentFromFoundation(provenance.provenanceResource, practitionerIdsAndNames)
+    return provenance
+
+# bundleType is collection (the default), or transaction or batch to post the bundle to a FHIR server's base URL.
+# With a foundationSharedResourceRegistry, the resources shared with other reports go there instead of the bundle
+def createFoundationFhirBundle(DOM, pdfBlobDirectory=None, metrics=None, bundleType='collection', registry=None):
+    report = createFoundationReportResources(DOM, pdfBlobDirectory)
+    if metrics is not None:
+        metrics.mark('report resources')
+    observationArr = createFoundationGenomicObservations(report, DOM)
+    if metrics is not None:
+        metrics.mark('genomic observations')
 
-    bundle = foundationToFhirBundle()
-    addBundleIdFromFoundation(bundle.bundleResource, diagnosticReport.getDiagnosticReportId())
-    bundle.addEntry(FoundationMedicine.organizationResource)
-    bundle.addEntry(organization.organizationResource)
-    bundle.addEntry(orderingPhysician.practitionerResource)
-    bundle.addEntry(patient.patientResource)
-    bundle.addEntry(pathologist.practitionerResource)
-    bundle.addEntry(diagnosticReport.diagnosticReportResource)
-    bundle.addEntry(condition.conditionResource)
-    bundle.addEntry(documentReference.documentReferenceResource)
-    bundle.addEntry(procedureRequest.procedureRequestResource)
-    bundle.addEntry(specimen.specimenResource)
+    sequenceArr = []
+    variantReportObservations = []
+    addFoundationVariantReportResources(report, variantReportObservations, sequenceArr, DOM)
+    observationArr = observationArr + variantReportObservations
+    if metrics is not None:
+        metrics.mark('variant report')
+
+    linkFoundationDiagnosticReport(report, observationArr)
+    # put the observations and specimen in the contained field for easier access
+    diagnosticReportAddContainedArr(report.diagnosticReport.diagnosticReportResource, observationArr, report.specimen)
+    if metrics is not None:
+        metrics.mark('link diagnostic report')
+    provenance = createFoundationProvenance(report, observationArr, DOM)
+    if metrics is not None:
+        metrics.mark('provenance')
+    bundle = assembleFoundationFhirBundle(report, observationArr, sequenceArr, provenance, bundleType, registry)
+    if metrics is not None:
+        metrics.mark('bundle assembly')
+        metrics.count('observations', len(observationArr))
+        metrics.count('sequences', len(sequenceArr))
+        metrics.countReferences(bundle.bundleResource)
+    return bundle
+
+def assembleFoundationFhirBundle(report, observationArr, sequenceArr, provenance, bundleType='collection',
+                                 registry=None):
+    transaction = None
+    if bundleType != 'collection':
+        transaction = createFoundationTransactionEntries(report, bundleType, registry is not None)
+        if registry is None:
+            for signer in provenance.signers:
+                transaction.register(signer)
+    bundle = foundationToFhirBundle(transaction)
+    addBundleIdFromFoundation(bundle.bundleResource, report.diagnosticReport.getDiagnosticReportId())
+    if registry is None:
+        bundle.addEntry(report.FoundationMedicine.organizationResource)
+        bundle.addEntry(report.organization.organizationResource)
+        bundle.addEntry(report.orderingPhysician.practitionerResource)
+        bundle.addEntry(report.patient.patientResource)
+        bundle.addEntry(report.pathologist.practitionerResource)
+    else:
+        registry.merge(getFoundationSharedResources(report, provenance))
+    bundle.addEntry(report.diagnosticReport.diagnosticReportResource)
+    bundle.addEntry(report.condition.conditionResource)
+    bundle.addEntry(report.documentReference.documentReferenceResource)
+    bundle.addEntry(report.procedureRequest.procedureRequestResource)
+    bundle.addEntry(report.specimen.specimenResource)
     bundle.addEntry(provenance.provenanceResource)
+    if registry is None:
+        for signer in provenance.signers:
+            bundle.addEntry(signer)
     bundle.addSequenceEntries(sequenceArr)
     bundle.addObservationEntries(observationArr)
+    return bundle
+
+# streaming counterpart of createFoundationFhirBundle. Observations and sequences are written as soon as they are
+# built, so the DiagnosticReport and Provenance, which need all of them, come last instead of in the middle
+def writeFoundationFhirBundle(DOM, outfile, pdfBlobDirectory=None, serializer=None, metrics=None, bundleType='collection',
+                              registry=None, references=None, validator=None):
+    report = createFoundationReportResources(DOM, pdfBlobDirectory)
+    if metrics is not None:
+        metrics.mark('report resources')
+    transaction = None
+    if bundleType != 'collection':
+        transaction = createFoundationTransactionEntries(report, bundleType, registry is not None)
+    writer = foundationStreamingBundleWriter(outfile, report.diagnosticReport.getDiagnosticReportId(), serializer, metrics,
+                                             transaction, references, validator)
+    if registry is None:
+        writer.addEntry(report.FoundationMedicine.organizationResource)
+        writer.addEntry(report.organization.organizationResource)
+        writer.addEntry(report.orderingPhysician.practitionerResource)
+        writer.addEntry(report.patient.patientResource)
+        writer.addEntry(report.pathologist.practitionerResource)
+    writer.addEntry(report.condition.conditionResource)
+    writer.addEntry(report.documentReference.documentReferenceResource)
+    writer.addEntry(report.procedureRequest.procedureRequestResource)
+    writer.addEntry(report.specimen.specimenResource)
+
+    contained = foundationSpooledJson()
+    observations = foundationStreamedResources(writer, contained)
+    sequences = foundationStreamedResources(writer)
+    for observation in createFoundationGenomicObservations(report, DOM):
+        observations.append(observation)
+    if metrics is not None:
+        metrics.mark('genomic observations')
+    addFoundationVariantReportResources(report, observations, sequences, DOM)
+    if metrics is not None:
+        metrics.mark('variant report')
+
+    linkFoundationDiagnosticReport(report, observations.written)
+    specimenResource = report.specimen.specimenResource
+    if transaction is not None and transaction.bundleType == 'transaction':
+        specimenResource = transaction.rewrite(specimenResource)
+    observations.addContained(writer.serializer.encode(specimenResource))
+    observations.closeContained()
+    report.diagnosticReport.diagnosticReportResource['contained'] = contained
+    writer.addEntry(report.diagnosticReport.diagnosticReportResource)
+    if metrics is not None:
+        metrics.mark('link diagnostic report')
+    provenance = createFoundationProvenance(report, observations.written, DOM)
+    if registry is None:
+        if transaction is not None:
+            for signer in provenance.signers:
+                transaction.register(signer)
+        writer.addEntry(provenance.provenanceResource)
+        for signer in provenance.signers:
+            writer.addEntry(signer)
+    else:
+        writer.addEntry(provenance.provenanceResource)
+        registry.merge(getFoundationSharedResources(report, provenance))
+    if metrics is not None:
+        metrics.mark('provenance')
+    writer.close()
+    contained.close()
+    if metrics is not None:
+        metrics.count('observations', len(observations.written))
+        metrics.count('sequences', sequences.count)
+
+# report.v2.xml -> report.v2.json, next to the input or mirrored under outputDirectory relative to root
+def foundationOutputFile(f, root=None, outputDirectory=None):
+    if outputDirectory is None:
+        return os.path.splitext(f)[0] + '.json'
+    if root is None:
+        root = os.path.dirname(f)
+    return os.path.join(outputDirectory, os.path.splitext(os.path.relpath(f, root))[0] + '.json')
+
+# streamBundle writes each entry as soon as it is built instead of building the whole bundle first. jsonBackend
+# picks the encoder (orjson, msgspec or json, by default the fastest one installed). metrics is an optional
+# foundationConversionMetrics that gets the time of each stage and the resource counts. bundleType is one of
+# foundationBundleTypes. registry is an optional foundationSharedResourceRegistry that takes the shared resources
+# out of the bundle, references an optional foundationReferenceIndex and validator an optional
+# foundationResourceValidator that get every entry for checking
+def convertFoundationFile(f, outputFile=None, pdfBlobDirectory=None, streamBundle=False, jsonBackend=None, pretty=False,
+                          metrics=None, bundleType='collection', registry=None, references=None, validator=None):
+    DOM = parseFoundationXml(f, spoolPDF=True)
+    if metrics is not None:
+        metrics.mark('parse')
+    serializer = getFoundationJsonSerializer(jsonBackend, pretty)
+    if outputFile is None:
+        outputFile = foundationOutputFile(f)
+    if os.path.dirname(outputFile) != '':
+        os.makedirs(os.path.dirname(outputFile), exist_ok=True)
+    # written next to the output and renamed into place, so nobody reads half a bundle. Not mkstemp, which would
+    # leave the bundle readable by its owner only
+    tempFile = '%s.%d.tmp' % (outputFile, os.getpid())
+    try:
+        with open(tempFile, 'wb') as outfile:
+            if streamBundle:
+                writeFoundationFhirBundle(DOM, outfile, pdfBlobDirectory, serializer, metrics, bundleType, registry,
+                                          references, validator)
+            else:
+                bundle = createFoundationFhirBundle(DOM, pdfBlobDirectory, metrics, bundleType, registry)
+                for entry in bundle.bundleResource['entry']:
+                    if references is not None:
+                        references.addEntry(entry)
+                    if validator is not None:
+                        validator.addEntry(entry)
+                dumpFoundationBundle(bundle.bundleResource, outfile, serializer)
+        os.replace(tempFile, outputFile)
+    except:
+        if os.path.exists(tempFile):
+            os.remove(tempFile)
+        raise
+    if metrics is not None:
+        metrics.mark('serialization')
+    return outputFile
+
+# public API for embedding the converter. Each returns the bundle as a dict, ready for json.dump. With a
+# pdfBlobDirectory the PDF is spooled and goes straight to its blob; without one it is inlined in the dict, so it has
+# to be read into memory anyway
+def convert_file(path, pdfBlobDirectory=None, bundleType='collection'):
+    return createFoundationFhirBundle(parseFoundationXml(path, spoolPDF=pdfBlobDirectory is not None), pdfBlobDirectory,
+                                      bundleType=bundleType).bundleResource
+
+def convert_bytes(data, pdfBlobDirectory=None, bundleType='collection'):
+    return createFoundationFhirBundle(parseFoundationXmlStream(io.BytesIO(data), pdfBlobDirectory is not None),
+                                      pdfBlobDirectory, bundleType=bundleType).bundleResource
+
+# accepts a minidom Document or a foundationTagIndex from parseFoundationXml
+def convert_dom(dom, pdfBlobDirectory=None, bundleType='collection'):
+    if not isinstance(dom, foundationTagIndex):
+        dom = buildFoundationTagIndex(dom)
+    return createFoundationFhirBundle(dom, pdfBlobDirectory, bundleType=bundleType).bundleResource
+
+# the problems the DSTU3 rules of --validate find in a bundle, as 'Observation/id.element: problem' strings
+def validate_bundle(bundle):
+    validator = foundationResourceValidator()
+    for entry in bundle.get('entry', []):
+        validator.addEntry(entry)
+    return validator.errors
+
+# runs in the worker processes, so a bad report is reported in the summary instead of stopping the batch. With
+# collectMetrics the result also carries the stage times and resource counts of the report, and with memoryProfile
+# the memory use of every stage as well. With the sharedResources option the report's shared resources are left
+# out of its bundle and returned in the result, for the batch's foundationSharedResourceRegistry. With
+# checkReferences the result lists the references that point at nothing, and with validate the problems
+# foundationResourceValidator finds
+def convertFoundationFileInWorker(f, outputFile, options, collectMetrics=False, memoryProfile=False,
+                                  checkReferences=False, validate=False):
+    start = time.perf_counter()
+    metrics = None
+    if memoryProfile:
+        metrics = foundationMemoryProfile()
+    elif collectMetrics:
+        metrics = foundationConversionMetrics()
+    registry = None
+    references = None
+    validator = None
+    options = dict(options)
+    if options.pop('sharedResources', False):
+        registry = foundationSharedResourceRegistry()
+    if checkReferences:
+        references = foundationReferenceIndex()
+    if validate:
+        validator = foundationResourceValidator()
+    try:
+        outputFile = convertFoundationFile(f, outputFile, metrics=metrics, registry=registry, references=references,
+                                           validator=validator, **options)
+        result = {
+            'file': f,
+            'outputFile': outputFile,
+            'inputBytes': os.path.getsize(f),
+            'outputBytes': os.path.getsize(outputFile),
+            'seconds': time.perf_counter() - start,
+            'error': None
+        }
+        if registry is not None:
+            result['sharedResources'] = list(registry.resources.values())
+        if references is not None:
+            if registry is not None:
+                for resource in result['sharedResources']:
+                    references.addShared(resource)
+            result['danglingReferences'] = [source + " -> " + reference for source, reference in references.dangling()]
+            if metrics is not None:
+                metrics.count('dangling references', len(result['danglingReferences']))
+        if validator is not None:
+            result['validationErrors'] = validator.errors
+            if metrics is not None:
+                metrics.count('validation errors', len(validator.errors))
+    except Exception as e:
+        result = {
+            'file': f,
+            'outputFile': outputFile,
+            'inputBytes': os.path.getsize(f),
+            'outputBytes': 0,
+            'seconds': time.perf_counter() - start,
+            'error': type(e).__name__ + ": " + str(e)
+        }
+    if metrics is not None:
+        if memoryProfile:
+            metrics.stop()
+        result['metrics'] = metrics.toDict()
+    return result
+
+def summarizeBatchConversion(results, seconds, jobs):
+    converted = [result for result in results if result['error'] is None]
+    inputMegabytes = sum(result['inputBytes'] for result in results) / 1e6
+    outputMegabytes = sum(result['outputBytes'] for result in converted) / 1e6
+    for result in results:
+        if result['error'] is not None:
+            print("Failed to convert " + result['file'] + ": " + result['error'])
+    seconds = max(seconds, 1e-9)
+    print("Converted %d of %d files in %.2f s with %d worker(s): %.1f files/s, %.2f MB/s in (%.1f MB), "
+          "%.2f MB/s out (%.1f MB)" % (len(converted), len(results), seconds, jobs, len(results) / seconds,
+                                       inputMegabytes / seconds, inputMegabytes, outputMegabytes / seconds, outputMegabytes))
+    if len(converted) > 0:
+        slowest = max(converted, key=lambda result: result['seconds'])
+        print("Slowest report: %s (%.2f s)" % (slowest['file'], slowest['seconds']))
+
+# one JSON object per report, appended so successive runs can share a file
+def writeFoundationMetricsJsonLines(results, path):
+    import json
+    with open(path, 'a') as outfile:
+        for result in results:
+            outfile.write(json.dumps(result, sort_keys=True) + '\n')
+
+# totals over the batch in the Prometheus text format, for node_exporter's textfile collector. The file is replaced
+# atomically so the collector never reads half of it
+def writeFoundationMetricsPrometheus(results, path):
+    stages = {}
+    counts = {}
+    for result in results:
+        metrics = result.get('metrics', {'stages': {}, 'counts': {}})
+        for stage in metrics['stages']:
+            stages[stage] = stages.get(stage, 0) + metrics['stages'][stage]
+        for name in metrics['counts']:
+            counts[name] = counts.get(name, 0) + metrics['counts'][name]
+    converted = len([result for result in results if result['error'] is None])
+    lines = [
+        "# HELP foundationtofhir_reports_total Reports processed, by outcome.",
+        "# TYPE foundationtofhir_reports_total counter",
+        'foundationtofhir_reports_total{status="converted"} %d' % converted,
+        'foundationtofhir_reports_total{status="failed"} %d' % (len(results) - converted),
+        "# HELP foundationtofhir_report_seconds_total Wall time spent converting reports.",
+        "# TYPE foundationtofhir_report_seconds_total counter",
+        "foundationtofhir_report_seconds_total %.6f" % sum(result['seconds'] for result in results),
+        "# HELP foundationtofhir_stage_seconds_total Wall time spent in each conversion stage.",
+        "# TYPE foundationtofhir_stage_seconds_total counter"
+    ]
+    for stage in sorted(stages):
+        lines.append('foundationtofhir_stage_seconds_total{stage="%s"} %.6f' % (stage, stages[stage]))
+    lines.append("# HELP foundationtofhir_resources_total Observations, sequences and references written.")
+    lines.append("# TYPE foundationtofhir_resources_total counter")
+    for name in sorted(counts):
+        lines.append('foundationtofhir_resources_total{kind="%s"} %d' % (name, counts[name]))
+    lines.append("# HELP foundationtofhir_bytes_total Bytes read and written.")
+    lines.append("# TYPE foundationtofhir_bytes_total counter")
+    lines.append('foundationtofhir_bytes_total{direction="in"} %d' % sum(result['inputBytes'] for result in results))
+    lines.append('foundationtofhir_bytes_total{direction="out"} %d' % sum(result['outputBytes'] for result in results))
+    # not mkstemp, whose 0600 file a node_exporter running as another user could not read. The collector only reads
+    # *.prom, so it skips the temporary file
+    tempPath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tempPath, 'w') as outfile:
+            outfile.write('\n'.join(lines) + '\n')
+        os.replace(tempPath, path)
+    except:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+
+# the first few danglingReferences or validationErrors of every report that has any
+def printFoundationFindings(results, key, description, limit=5):
+    for result in results:
+        findings = result.get(key, [])
+        if len(findings) == 0:
+            continue
+        print("%d %s in %s:" % (len(findings), description, result['outputFile']))
+        for finding in findings[:limit]:
+            print("  " + finding)
+        if len(findings) > limit:
+            print("  ...")
+
+def printFoundationMemoryProfile(results):
+    for result in results:
+        if 'metrics' not in result or 'memory' not in result['metrics']:
+            continue
+        print("Memory profile of " + result['file'] + ":")
+        memory = result['metrics']['memory']
+        for stage in memory:
+            print("  after %-24s %9.1f MB held, %9.1f MB peak during the stage" %
+                  (stage, memory[stage]['current'] / 1e6, memory[stage]['peak'] / 1e6))
+            for site in memory[stage]['top']:
+                print("      %-40s %+9.1f MB %+9d blocks" % (site['site'], site['bytes'] / 1e6, site['blocks']))
+
+# outputFiles optionally maps input files to their output paths, by default outputs are written next to the inputs.
+# collectMetrics adds the stage times and resource counts of each report to its result, memoryProfile also its
+# memory use per stage, checkReferences its dangling references and validate its validation errors. options are
+# passed on to convertFoundationFile
+def convertFoundationFilesInParallel(files, jobs=None, chunkSize=1, outputFiles=None, collectMetrics=False,
+                                     memoryProfile=False, checkReferences=False, validate=False, **options):
+    from concurrent import futures
+    import itertools
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if outputFiles is None:
+        outputFiles = {}
+    # largest reports first, so a big report picked up last does not hold up the end of the run
+    files = sorted(files, key=os.path.getsize, reverse=True)
+    outputs = [outputFiles.get(f) for f in files]
+    start = time.perf_counter()
+    if jobs == 1:
+        results = [convertFoundationFileInWorker(f, outputs[i], options, collectMetrics, memoryProfile, checkReferences,
+                                                 validate) for i, f in enumerate(files)]
+    else:
+        with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(convertFoundationFileInWorker, files, outputs, itertools.repeat(options),
+                                        itertools.repeat(collectMetrics), itertools.repeat(memoryProfile),
+                                        itertools.repeat(checkReferences), itertools.repeat(validate),
+                                        chunksize=chunkSize))
+    summarizeBatchConversion(results, time.perf_counter() - start, jobs)
+    return results
+
+# the part of a glob before its first wildcard, e.g. /mnt/archive/2017 for /mnt/archive/2017/**/*.xml
+def foundationGlobRoot(pattern):
+    import glob
+    parts = []
+    for part in pattern.split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    root = os.sep.join(parts)
+    if root == '' and pattern.startswith(os.sep):
+        return os.sep
+    return root or os.curdir
+
+# returns (file, root) pairs. Directories are searched for *.xml files (recursively if asked), globs are expanded
+# and plain files are taken as they are. root is what output paths are mirrored relative to: the directory, the part
+# of the glob before its first wildcard, or the file's own directory
+def collectFoundationFiles(inputs, recursive=False):
+    import glob
+    collected = []
+    seen = set()
+
+    def collect(f, root):
+        if f not in seen:
+            seen.add(f)
+            collected.append((f, root))
+
+    for path in inputs:
+        if os.path.isdir(path):
+            if recursive:
+                for directory, directories, names in os.walk(path):
+                    directories.sort()
+                    for name in sorted(names):
+                        if name.endswith('.xml'):
+                            collect(os.path.join(directory, name), path)
+            else:
+                for name in sorted(os.listdir(path)):
+                    if name.endswith('.xml') and os.path.isfile(os.path.join(path, name)):
+                        collect(os.path.join(path, name), path)
+        elif glob.has_magic(path):
+            root = foundationGlobRoot(path)
+            for f in sorted(glob.glob(path, recursive=recursive)):
+                if os.path.isfile(f):
+                    collect(f, root)
+        elif os.path.isfile(path):
+            collect(path, os.path.dirname(path))
+        else:
+            print("No such file or directory: " + path)
+    return collected
+
+# the output paths more than one input would be written to, as {output: [input, ...]}
+def foundationOutputCollisions(outputFiles):
+    inputs = {}
+    for f in outputFiles:
+        inputs.setdefault(os.path.abspath(outputFiles[f]), []).append(f)
+    return dict((output, inputs[output]) for output in inputs if len(inputs[output]) > 1)
+
+# converts a few median sized reports in-process, without writing anything, and extrapolates to the whole batch
+def estimateBatchConversion(files, jobs, samples=3):
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    sizes = sorted((os.path.getsize(f), f) for f in files)
+    totalBytes = sum(size for size, f in sizes)
+    print("%d files, %.1f MB in total, largest %.1f MB" % (len(sizes), totalBytes / 1e6,
+                                                             sizes[-1][0] / 1e6 if len(sizes) > 0 else 0))
+    if len(sizes) == 0:
+        return
+    middle = len(sizes) // 2
+    sample = sizes[max(0, middle - samples // 2):middle - samples // 2 + samples]
+    sampleBytes = 0
+    start = time.perf_counter()
+    with open(os.devnull, 'wb') as sink:
+        for size, f in sample:
+            dumpFoundationBundle(createFoundationFhirBundle(parseFoundationXml(f, spoolPDF=True)).bundleResource, sink)
+            sampleBytes = sampleBytes + size
+    bytesPerSecond = sampleBytes / max(time.perf_counter() - start, 1e-9)
+    print("Measured %.2f MB/s per worker on %d sample report(s); estimated %.1f s with %d worker(s)" %
+          (bytesPerSecond / 1e6, len(sample), totalBytes / bytesPerSecond / jobs, jobs))
+
+foundationConverterVersionCache = None
+
+# identifies the code that produced an output, so editing the converter invalidates earlier conversions
+def foundationConverterVersion():
+    global foundationConverterVersionCache
+    if foundationConverterVersionCache is None:
+        foundationConverterVersionCache = hashFoundationFile(os.path.abspath(__file__))[:16]
+    return foundationConverterVersionCache
+
+def hashFoundationFile(f, chunkSize=1048576):
+    import hashlib
+    sha256 = hashlib.sha256()
+    with open(f, 'rb') as infile:
+        chunk = infile.read(chunkSize)
+        while chunk:
+            sha256.update(chunk)
+            chunk = infile.read(chunkSize)
+    return sha256.hexdigest()
+
+# the manifest is a JSON object mapping absolute input paths to the content hash, converter version, conversion
+# options and output path of their last successful conversion
+def loadConversionManifest(path):
+    import json
+    if not os.path.exists(path):
+        return {}
+    with open(path) as infile:
+        return json.load(infile)
+
+# written next to the manifest and renamed into place. Not mkstemp, which would leave it readable by its owner only
+def saveConversionManifest(manifest, path):
+    import json
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tempPath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tempPath, 'w') as outfile:
+            json.dump(manifest, outfile, indent=1, sort_keys=True)
+        os.replace(tempPath, path)
+    except:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+
+# returns the files that need converting and the current state (stat and hash) of every file. A file whose size
+# and mtime match its manifest entry is not read again; otherwise it is hashed and only converted if the content,
+# converter version, options or output path changed, or the output is gone. Inputs that map to the same output are
+# refused, and an output the manifest records for more than one input is converted again, as one overwrote the other
+def selectChangedFoundationFiles(files, outputFiles, manifest, options):
+    version = foundationConverterVersion()
+    outputs = dict((f, os.path.abspath(outputFiles.get(f) or foundationOutputFile(f))) for f in files)
+    collisions = foundationOutputCollisions(outputs)
+    if len(collisions) > 0:
+        raise ValueError("More than one input maps to " + ", ".join(sorted(collisions)))
+    claims = {}
+    for entry in manifest.values():
+        claims[entry['output']] = claims.get(entry['output'], 0) + 1
+    changed = []
+    states = {}
+    for f in files:
+        stat = os.stat(f)
+        entry = manifest.get(os.path.abspath(f))
+        if entry is not None and entry['size'] == stat.st_size and entry['mtimeNs'] == stat.st_mtime_ns:
+            sha256 = entry['sha256']
+        else:
+            sha256 = hashFoundationFile(f)
+        states[f] = {
+            'sha256': sha256,
+            'size': stat.st_size,
+            'mtimeNs': stat.st_mtime_ns
+        }
+        outputFile = outputs[f]
+        if entry is None or entry['sha256'] != sha256 or entry['converterVersion'] != version or \
+                entry.get('options') != options or entry['output'] != outputFile or claims[outputFile] > 1 or \
+                not os.path.exists(outputFile):
+            changed.append(f)
+        else:
+            # a touched but unchanged file keeps being skipped without rehashing
+            entry['size'] = stat.st_size
+            entry['mtimeNs'] = stat.st_mtime_ns
+    return changed, states
+
+# an output written from two inputs belongs to neither, so neither is recorded. Inputs recorded earlier with the
+# output of a converted one lose their entry, their bundle is gone
+def recordConvertedFoundationFiles(manifest, results, states, options):
+    version = foundationConverterVersion()
+    converted = [result for result in results if result['error'] is None]
+    collisions = foundationOutputCollisions(dict((result['file'], result['outputFile']) for result in converted))
+    owners = {}
+    for f in manifest:
+        owners.setdefault(manifest[f]['output'], []).append(f)
+    for result in converted:
+        output = os.path.abspath(result['outputFile'])
+        for f in owners.get(output, []):
+            manifest.pop(f, None)
+        if output in collisions:
+            continue
+        entry = dict(states[result['file']])
+        entry['converterVersion'] = version
+        entry['options'] = options
+        entry['output'] = output
+        manifest[os.path.abspath(result['file'])] = entry
+
+# idle keep-alive connections to one FHIR server, shared by the upload threads. There is never more than one
+# connection per thread, because a thread takes one for each request and puts it back when the response is read
+class foundationFhirConnectionPool:
+    __slots__ = ('scheme', 'host', 'port', 'path', 'timeout', 'idle', 'created')
+
+    def __init__(self, baseUrl, timeout=60):
+        import queue
+        from urllib.parse import urlsplit
+        url = urlsplit(baseUrl)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise ValueError("Not an http(s) FHIR server URL: " + baseUrl)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.created = 0
+
+    # returns (connection, reused)
+    def acquire(self):
+        import http.client, queue
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            pass
+        self.created = self.created + 1
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout), False
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def release(self, connection):
+        self.idle.put(connection)
+
+    def close(self):
+        import queue
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+# statuses worth another attempt; anything else the server will answer the same way again
+foundationRetriedStatuses = frozenset([408, 429, 500, 502, 503, 504])
+
+# posts one bundle file, retrying connection errors and the statuses above with exponential backoff and jitter (at
+# least Retry-After, when the server sends one). latency is the time of the request that succeeded
+def uploadFoundationBundle(pool, path, resourcePath='Bundle', headers=None, retries=3, backoff=0.5):
+    import http.client, random
+    start = time.perf_counter()
+    result = {
+        'file': path,
+        'status': None,
+        'location': None,
+        'attempts': 0,
+        'latency': None,
+        'seconds': 0.0,
+        'error': None
+    }
+    url = pool.path + '/' + resourcePath
+    try:
+        body = open(path, 'rb')
+    except OSError as e:
+        result['error'] = type(e).__name__ + ": " + str(e)
+        return result
+    requestHeaders = {
+        'Content-Type': "application/fhir+json",
+        'Accept': "application/fhir+json",
+        'Content-Length': str(os.fstat(body.fileno()).st_size)
+    }
+    if headers is not None:
+        requestHeaders.update(headers)
+    with body:
+        while True:
+            connection, reused = pool.acquire()
+            body.seek(0)
+            requestStart = time.perf_counter()
+            retryAfter = None
+            sent = False
+            try:
+                connection.request('POST', url, body, requestHeaders)
+                sent = True
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                # the server closed an idle keep-alive connection before the request went out; that is no reason to
+                # back off. Once it is sent the server may have acted on it, so anything later counts as an attempt
+                if reused and not sent and isinstance(e, ConnectionError):
+                    continue
+                result['error'] = type(e).__name__ + ": " + str(e)
+            else:
+                latency = time.perf_counter() - requestStart
+                if response.will_close:
+                    connection.close()
+                else:
+                    pool.release(connection)
+                result['status'] = response.status
+                if 200 <= response.status < 300:
+                    result['attempts'] = result['attempts'] + 1
+                    result['location'] = response.getheader('Location')
+                    result['latency'] = latency
+                    result['error'] = None
+                    break
+                result['error'] = "HTTP %d: %s" % (response.status, content[:200].decode('utf-8', 'replace'))
+                retryAfter = response.getheader('Retry-After')
+                if response.status not in foundationRetriedStatuses:
+                    result['attempts'] = result['attempts'] + 1
+                    break
+            result['attempts'] = result['attempts'] + 1
+            if result['attempts'] > retries:
+                break
+            delay = backoff * 2 ** (result['attempts'] - 1) * random.uniform(0.5, 1.5)
+            if retryAfter is not None and retryAfter.isdigit():
+                delay = max(delay, int(retryAfter))
+            time.sleep(delay)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+# nearest-rank percentiles of a list of seconds
+def foundationLatencyPercentiles(latencies, percentiles=(50, 90, 99)):
+    import math
+    ordered = sorted(latencies)
+    if len(ordered) == 0:
+        return {}
+    summary = {}
+    for percentile in percentiles:
+        rank = int(math.ceil(percentile / 100.0 * len(ordered)))
+        summary['p%d' % percentile] = ordered[max(rank, 1) - 1]
+    summary['max'] = ordered[-1]
+    return summary
+
+def summarizeFoundationUpload(results, seconds, connections):
+    uploaded = [result for result in results if result['error'] is None]
+    for result in results:
+        if result['error'] is not None:
+            print("Failed to upload " + result['file'] + " after %d attempt(s): " % result['attempts'] + result['error'])
+    retried = sum(result['attempts'] - 1 for result in results if result['attempts'] > 1)
+    print("Uploaded %d of %d bundles in %.2f s over %d connection(s), %d retries" %
+          (len(uploaded), len(results), seconds, connections, retried))
+    latencies = foundationLatencyPercentiles([result['latency'] for result in uploaded])
+    if len(latencies) > 0:
+        print("Latency: " + ", ".join("%s %.1f ms" % (name, latencies[name] * 1000) for name in latencies))
+
+# posts bundle files to a FHIR server from concurrency threads over keep-alive connections. Collection bundles are
+# stored as Bundle resources; transaction and batch bundles go to the base URL (resourcePath ''). At most maxInFlight
+# bundles are queued or being sent at a time (by default twice the concurrency), so a long list of files does not
+# turn into a long queue of open files
+def uploadFoundationBundles(files, baseUrl, concurrency=4, maxInFlight=None, retries=3, backoff=0.5, timeout=60,
+                            headers=None, resourcePath='Bundle'):
+    from concurrent import futures
+    import threading
+    pool = foundationFhirConnectionPool(baseUrl, timeout)
+    slots = threading.BoundedSemaphore(maxInFlight or 2 * concurrency)
+    pending = []
+    start = time.perf_counter()
+    try:
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for f in files:
+                slots.acquire()
+                future = executor.submit(uploadFoundationBundle, pool, f, resourcePath, headers, retries, backoff)
+                future.add_done_callback(lambda future: slots.release())
+                pending.append(future)
+    finally:
+        pool.close()
+    results = [future.result() for future in pending]
+    summarizeFoundationUpload(results, time.perf_counter() - start, pool.created)
+    return results
+
+# rename is atomic within a file system. Across file systems the file is copied next to its destination first and
+# then renamed, so the destination never holds half a report
+def moveFoundationFileAtomically(f, directory):
+    import errno, shutil
+    destination = os.path.join(directory, os.path.basename(f))
+    try:
+        os.replace(f, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tempPath = '%s.%d.tmp' % (destination, os.getpid())
+        shutil.copy2(f, tempPath)
+        os.replace(tempPath, destination)
+        os.remove(f)
+    return destination
+
+# Ctrl-C reaches the workers too; the watcher lets the conversions in flight finish before it stops
+def ignoreFoundationWorkerInterrupt():
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# --watch. Polls an inbox directory and converts reports as they arrive. The directory is only listed again when its
+# mtime changes or files in it are still being written, and a report is picked up once its size and mtime stayed the
+# same over two polls, so half-copied files are left alone. At most maxInFlight reports are handed to the workers at
+# a time; the rest wait in the inbox. Bundles are written atomically, then the report is moved to done or failed. A
+# report that cannot be moved stays in the inbox and is skipped until its size or mtime changes
+class foundationInboxWatcher:
+    __slots__ = ('inbox', 'outputDirectory', 'doneDirectory', 'failedDirectory', 'jobs', 'maxInFlight', 'pollInterval',
+                 'metricsPath', 'checkReferences', 'validate', 'options', 'directoryMtime', 'candidates', 'unmovable', 'inFlight',
+                 'executor')
+
+    def __init__(self, inbox, outputDirectory=None, doneDirectory=None, failedDirectory=None, jobs=None,
+                 pollInterval=1.0, maxInFlight=None, metricsPath=None, checkReferences=False, validate=False, **options):
+        self.inbox = inbox
+        self.outputDirectory = outputDirectory or os.path.join(inbox, 'fhir')
+        self.doneDirectory = doneDirectory or os.path.join(inbox, 'done')
+        self.failedDirectory = failedDirectory or os.path.join(inbox, 'failed')
+        self.jobs = jobs or os.cpu_count() or 1
+        # a report queued behind each running one keeps the workers busy between polls
+        self.maxInFlight = maxInFlight or 2 * self.jobs
+        self.pollInterval = pollInterval
+        self.metricsPath = metricsPath
+        self.checkReferences = checkReferences
+        self.validate = validate
+        self.options = options
+        self.directoryMtime = None
+        # path -> (size, mtime) at the last poll of every report not yet handed to the workers
+        self.candidates = {}
+        # path -> (size, mtime) of every report converted but not moved out of the inbox
+        self.unmovable = {}
+        self.inFlight = set()
+        self.executor = None
+
+    # returns the reports that are ready, oldest first
+    def scan(self):
+        mtime = os.stat(self.inbox).st_mtime_ns
+        # a directory changed within the last two seconds is listed anyway, in case the file system's mtime is coarser
+        # than the time between two arrivals
+        if (mtime == self.directoryMtime and len(self.candidates) == 0 and len(self.unmovable) == 0 and
+                time.time_ns() - mtime > 2000000000):
+            return []
+        self.directoryMtime = mtime
+        candidates = {}
+        unmovable = {}
+        ready = []
+        with os.scandir(self.inbox) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.name.lower().endswith('.xml') or entry.path in self.inFlight:
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if self.unmovable.get(entry.path) == signature:
+                    unmovable[entry.path] = signature
+                    continue
+                if self.candidates.get(entry.path) == signature:
+                    ready.append(entry.path)
+                candidates[entry.path] = signature
+        self.candidates = candidates
+        self.unmovable = unmovable
+        return sorted(ready, key=lambda f: candidates[f][1])
+
+    async def convert(self, f):
+        import asyncio
+        from concurrent import futures
+        from concurrent.futures.process import BrokenProcessPool
+        outputFile = os.path.join(self.outputDirectory, os.path.splitext(os.path.basename(f))[0] + '.json')
+        executor = self.executor
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                executor, convertFoundationFileInWorker, f, outputFile, self.options, self.metricsPath is not None, False,
+                self.checkReferences, self.validate)
+        except Exception as e:
+            # the report is failed like one the worker could not convert, so it is moved to failed and not left in
+            # inFlight for good
+            if isinstance(e, BrokenProcessPool):
+                error = "BrokenProcessPool: the worker process died"
+            else:
+                error = type(e).__name__ + ": " + str(e)
+            try:
+                inputBytes = os.path.getsize(f)
+            except OSError:
+                inputBytes = 0
+            result = {
+                'file': f,
+                'outputFile': outputFile,
+                'inputBytes': inputBytes,
+                'outputBytes': 0,
+                'seconds': 0.0,
+                'error': error
+            }
+            # a worker died (usually OOM-killed). Every report it had is failed and the pool is replaced once
+            if isinstance(e, BrokenProcessPool) and self.executor is executor:
+                self.executor = futures.ProcessPoolExecutor(max_workers=self.jobs,
+                                                            initializer=ignoreFoundationWorkerInterrupt)
+                executor.shutdown(wait=False)
+        try:
+            if result['error'] is None:
+                moveFoundationFileAtomically(f, self.doneDirectory)
+                print("Converted %s in %.2f s" % (f, result['seconds']))
+                printFoundationFindings([result], 'danglingReferences', "dangling reference(s)")
+                printFoundationFindings([result], 'validationErrors', "validation error(s)")
+            else:
+                failed = moveFoundationFileAtomically(f, self.failedDirectory)
+                with open(failed + '.error', 'w') as outfile:
+                    outfile.write(result['error'] + '\n')
+                print("Failed %s: %s" % (f, result['error']))
+        except OSError as e:
+            try:
+                stat = os.stat(f)
+                self.unmovable[f] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+            print("Could not move %s: %s (skipped until it changes)" % (f, e))
+        finally:
+            self.inFlight.discard(f)
+        if self.metricsPath is not None:
+            writeFoundationMetricsJsonLines([result], self.metricsPath)
+        return result
+
+    # runs until stop is set, then waits for the conversions in flight
+    async def run(self, stop=None):
+        import asyncio
+        from concurrent import futures
+        if stop is None:
+            stop = asyncio.Event()
+        for directory in (self.outputDirectory, self.doneDirectory, self.failedDirectory):
+            os.makedirs(directory, exist_ok=True)
+        self.executor = futures.ProcessPoolExecutor(max_workers=self.jobs, initializer=ignoreFoundationWorkerInterrupt)
+        tasks = set()
+        try:
+            while not stop.is_set():
+                for f in self.scan()[:self.maxInFlight - len(self.inFlight)]:
+                    self.inFlight.add(f)
+                    del self.candidates[f]
+                    task = asyncio.ensure_future(self.convert(f))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                try:
+                    await asyncio.wait_for(stop.wait(), self.pollInterval)
+                except asyncio.TimeoutError:
+                    pass
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+        finally:
+            self.executor.shutdown()
+
+# stops the watcher on SIGINT or SIGTERM
+async def watchFoundationInbox(watcher):
+    import asyncio, signal
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    print("Watching %s for reports" % watcher.inbox)
+    await watcher.run(stop)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert FoundationOne XML reports into FHIR bundles.")
+    parser.add_argument('inputs', nargs='*', default=['.'],
+                        help="XML files, directories or glob patterns (default: the current directory)")
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help="search directories recursively and let ** in globs match subdirectories")
+    parser.add_argument('-o', '--output-dir',
+                        help="write bundles here, mirroring the input directory layout (default: next to the inputs)")
+    parser.add_argument('-j', '--jobs', type=int, help="worker processes (default: every core)")
+    parser.add_argument('--chunk-size', type=int, default=1, help="files handed to a worker at a time")
+    parser.add_argument('--pdf-blob-dir',
+                        help="store report PDFs here once, keyed by SHA-256, instead of inlining them as base64")
+    parser.add_argument('--stream-bundle', action='store_true',
+                        help="write each bundle entry as soon as it is built instead of building the whole bundle "
+                             "first (DiagnosticReport and Provenance are then written last)")
+    parser.add_argument('--json-backend', choices=foundationJsonBackends,
+                        help="JSON encoder (default: the fastest one installed)")
+    parser.add_argument('--pretty', action='store_true', help="indent the JSON instead of writing it compact")
+    parser.add_argument('--bundle-type', choices=foundationBundleTypes, default='collection',
+                        help="transaction bundles create the organizations, practitioners and patient only when the "
+                             "server does not have them yet; batch bundles PUT every resource to its own id")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only report the input size and an estimate of the conversion time")
+    parser.add_argument('--manifest',
+                        help="manifest used to skip unchanged reports (default: .foundationtofhir-manifest.json in the "
+                             "output directory, none without one)")
+    parser.add_argument('--force', action='store_true', help="convert every report, even unchanged ones")
+    parser.add_argument('--metrics',
+                        help="record stage times, resource counts and bytes of every report in this file")
+    parser.add_argument('--metrics-format', choices=['jsonl', 'prometheus'], default='jsonl',
+                        help="JSON lines, one per report (appended), or a Prometheus textfile with batch totals")
+    parser.add_argument('--memory-profile', action='store_true',
+                        help="trace allocations and print the memory held, the peak and the top allocation sites of "
+                             "every stage of every report (slow)")
+    parser.add_argument('--check-references', action='store_true',
+                        help="check that every reference in a bundle points at a resource in it (or in "
+                             "--shared-resources) and list the ones that do not")
+    parser.add_argument('--validate', action='store_true',
+                        help="check the resources of every bundle against the DSTU3 element names, types and "
+                             "cardinalities, offline, and list the problems")
+    parser.add_argument('--shared-resources', metavar='FILE',
+                        help="write the organizations, practitioners and patients once into this bundle, merged with "
+                             "the one an earlier run left there, and only refer to them from the report bundles")
+    parser.add_argument('--upload', metavar='URL',
+                        help="post the bundles converted in this run to the FHIR server at this base URL")
+    parser.add_argument('--upload-concurrency', type=int, default=4, help="parallel uploads (and connections)")
+    parser.add_argument('--upload-max-in-flight', type=int,
+                        help="bundles queued or being sent at a time (default: twice the concurrency)")
+    parser.add_argument('--upload-retries', type=int, default=3,
+                        help="retries of a bundle after connection errors or 408, 429 and 5xx responses")
+    parser.add_argument('--upload-header', action='append', default=[], metavar='NAME:VALUE',
+                        help="extra request header, e.g. 'Authorization: Bearer ...' (repeatable)")
+    parser.add_argument('--watch', metavar='INBOX',
+                        help="keep running and convert reports as they are dropped into INBOX, writing bundles to "
+                             "--output-dir (default: INBOX/fhir)")
+    parser.add_argument('--done-dir', help="where --watch moves converted reports (default: INBOX/done)")
+    parser.add_argument('--failed-dir',
+                        help="where --watch moves reports that failed, with the error next to them (default: "
+                             "INBOX/failed)")
+    parser.add_argument('--poll-interval', type=float, default=1.0, help="seconds between two polls of the inbox")
+    args = parser.parse_args(argv)
+    if args.watch is not None and args.metrics is not None and args.metrics_format != 'jsonl':
+        parser.error("--watch writes --metrics as JSON lines only")
+    if args.watch is not None and args.upload is not None:
+        parser.error("--upload converts a batch and then uploads it, it cannot be combined with --watch")
+    if args.watch is not None and args.shared_resources is not None:
+        parser.error("--shared-resources is written at the end of a batch, it cannot be combined with --watch")
+    uploadHeaders = {}
+    for header in args.upload_header:
+        if ':' not in header:
+            parser.error("--upload-header must look like NAME:VALUE, not " + header)
+        name, value = header.split(':', 1)
+        uploadHeaders[name.strip()] = value.strip()
+    manifestPath = args.manifest
+    if manifestPath is None and args.output_dir is not None:
+        manifestPath = os.path.join(args.output_dir, '.foundationtofhir-manifest.json')
+
+    options = {
+        'pdfBlobDirectory': args.pdf_blob_dir,
+        'streamBundle': args.stream_bundle,
+        'jsonBackend': args.json_backend,
+        'pretty': args.pretty,
+        'bundleType': args.bundle_type,
+        'sharedResources': args.shared_resources is not None
+    }
+    if args.watch is not None:
+        import asyncio
+        watcher = foundationInboxWatcher(args.watch, args.output_dir, args.done_dir, args.failed_dir, args.jobs,
+                                         args.poll_interval, metricsPath=args.metrics,
+                                         checkReferences=args.check_references, validate=args.validate, **options)
+        asyncio.run(watchFoundationInbox(watcher))
+        return 0
+    collected = collectFoundationFiles(args.inputs, args.recursive)
+    files = [f for f, root in collected]
+    outputFiles = {}
+    for f, root in collected:
+        outputFiles[f] = foundationOutputFile(f, root, args.output_dir)
+    # one bundle would silently overwrite the other
+    collisions = foundationOutputCollisions(outputFiles)
+    if len(collisions) > 0:
+        for output in sorted(collisions):
+            print("%s would be written from %s" % (output, " and ".join(collisions[output])))
+        print("Not converting: %d output(s) would be written from more than one input" % len(collisions))
+        return 1
+    if args.dry_run:
+        estimateBatchConversion(files, args.jobs)
+        return 0
+    if manifestPath is not None:
+        manifest = loadConversionManifest(manifestPath)
+        changed, states = selectChangedFoundationFiles(files, outputFiles, manifest, options)
+        if not args.force:
+            print("Skipping %d unchanged of %d files" % (len(files) - len(changed), len(files)))
+            files = changed
+    results = convertFoundationFilesInParallel(files, args.jobs, args.chunk_size, outputFiles, args.metrics is not None,
+                                               args.memory_profile, args.check_references, args.validate, **options)
+    if args.memory_profile:
+        printFoundationMemoryProfile(results)
+    printFoundationFindings(results, 'danglingReferences', "dangling reference(s)")
+    printFoundationFindings(results, 'validationErrors', "validation error(s)")
+    if args.shared_resources is not None:
+        registry = foundationSharedResourceRegistry()
+        registry.load(args.shared_resources, args.bundle_type)
+        # in input order, so when two reports disagree about a resource the outcome does not depend on file sizes
+        for result in sorted(results, key=lambda result: result['file']):
+            registry.merge(result.pop('sharedResources', []), result['file'])
+        registry.write(args.shared_resources, args.bundle_type, getFoundationJsonSerializer(args.json_backend, args.pretty))
+        for key, previous, source in registry.conflicts:
+            print("Warning: %s differs between %s and %s, kept the one from %s" % (key, previous, source, source))
+        print("Wrote %d shared resources to %s (%d new, %d changed)" %
+              (len(registry.resources), args.shared_resources, registry.added, registry.replaced))
+    uploads = []
+    if args.upload is not None:
+        uploadArgs = (args.upload, args.upload_concurrency, args.upload_max_in_flight, args.upload_retries)
+        resourcePath = 'Bundle' if args.bundle_type == 'collection' else ''
+        # the report bundles refer to the shared resources, so those have to be on the server first
+        if args.shared_resources is not None:
+            uploads = uploadFoundationBundles([args.shared_resources], *uploadArgs, headers=uploadHeaders,
+                                              resourcePath=resourcePath)
+        if all(upload['error'] is None for upload in uploads):
+            uploads = uploads + uploadFoundationBundles([result['outputFile'] for result in results
+                                                         if result['error'] is None], *uploadArgs,
+                                                        headers=uploadHeaders, resourcePath=resourcePath)
+    if args.metrics is not None:
+        if args.metrics_format == 'prometheus':
+            writeFoundationMetricsPrometheus(results, args.metrics)
+        else:
+            writeFoundationMetricsJsonLines(results, args.metrics)
+    if manifestPath is not None:
+        recordConvertedFoundationFiles(manifest, results, states, options)
+        saveConversionManifest(manifest, manifestPath)
+    if any(result['error'] is not None for result in results + uploads):
+        return 1
+    return 0
 
-    with open(f.split('.')[0]+'.json', 'w') as outfile:
-        json.dump(bundle.bundleResource, outfile)
\ No newline at end of file
+########################################################################################################################
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
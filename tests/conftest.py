@@ -0,0 +1,25 @@
+import os, sys
+
+import pytest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+import foundationtofhir
+from generate_report import writeFoundationReport
+
+# a synthetic report small enough to convert in every test that needs one, with every kind of cds-effect
+@pytest.fixture(scope='session')
+def reportPath(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('reports').joinpath('report.xml'))
+    writeFoundationReport(path, genes=5, therapies=6, trials=6, shortVariants=16, copyNumberAlterations=3,
+                          rearrangements=2, pdfBytes=1000, references=10)
+    return path
+
+@pytest.fixture
+def bundle(reportPath):
+    return foundationtofhir.convert_file(reportPath)
+
+def bundleResources(bundle, resourceType):
+    return [entry['resource'] for entry in bundle['entry'] if entry['resource']['resourceType'] == resourceType]
@@ -0,0 +1,72 @@
+import pytest
+
+import foundationtofhir
+from conftest import bundleResources
+from generate_report import cdsEffects
+
+@pytest.mark.parametrize('cdsEffect, expected', [
+    # the forms benchmarks/generate_report.py writes
+    ('123A>G', ("substitution", '123', '123', 'A', 'G')),
+    ('123C>T', ("substitution", '123', '123', 'C', 'T')),
+    ('123_124insT', ("insertion", '123', '124', '_', 'T')),
+    ('123_124delCA', ("deletion", '123', '124', 'CA', '_')),
+    ('123_124del15', ("deletion", '123', '124', '', '_')),
+    ('123dupC', ("duplication", '123', '123', '_', 'C')),
+    ('123_124delinsTT', ("deletion-insertion", '123', '124', '', 'TT')),
+    ('123-1G>A', ("substitution", '123-1', '123-1', 'G', 'A')),
+    # intronic, UTR and other forms seen in real reports
+    ('344+2T>C', ("substitution", '344+2', '344+2', 'T', 'C')),
+    ('*12C>T', ("substitution", '*12', '*12', 'C', 'T')),
+    ('-14_-13delGC', ("deletion", '-14', '-13', 'GC', '_')),
+    ('c.35G>A', ("substitution", '35', '35', 'G', 'A')),
+    ('2573_2574TG>GT', ("substitution", '2573', '2574', 'TG', 'GT')),
+    ('1234delA', ("deletion", '1234', '1234', 'A', '_')),
+    ('1234del', ("deletion", '1234', '1234', '', '_')),
+    ('45_46ins3', ("insertion", '45', '46', '_', '')),
+    ('5266dup', ("duplication", '5266', '5266', '_', '')),
+    ('100_102inv', ("inversion", '100', '102', '', '')),
+    ('p.V600E', ("unknown", '', '', '', '')),
+    ('', ("unknown", '', '', '', '')),
+])
+def test_parseFoundationCdsEffect(cdsEffect, expected):
+    assert foundationtofhir.parseFoundationCdsEffect(cdsEffect) == expected
+
+def test_generator_covers_every_parsed_type():
+    types = {foundationtofhir.parseFoundationCdsEffect(pattern.replace('%d', '10')).type for pattern, _ in cdsEffects}
+    assert types == {"substitution", "insertion", "deletion", "duplication", "deletion-insertion"}
+
+@pytest.mark.parametrize('value, number, expected', [
+    ('42', int, 42),
+    ('0.37', float, 0.37),
+    ('', int, ''),
+    ('n/a', float, 'n/a'),
+])
+def test_foundationNumber(value, number, expected):
+    result = foundationtofhir.foundationNumber(value, number)
+    assert result == expected and type(result) is type(expected)
+
+def test_short_variants_use_parsed_alleles_and_numbers(bundle):
+    observations = {observation['id']: observation for observation in bundleResources(bundle, 'Observation')}
+    sequences = [sequence for sequence in bundleResources(bundle, 'Sequence') if '-short-variant-' in sequence['id']]
+    assert len(sequences) == 16
+    for sequence in sequences:
+        observation = observations[sequence['id'][:-len("-seq")]]
+        extensions = {extension['url'].rsplit('-', 1)[1]: extension for extension in observation['extension']}
+        cdsEffect = extensions['geneticsDNASequenceVariantName']['valueCodeableConcept']['text']
+        variant = foundationtofhir.parseFoundationCdsEffect(cdsEffect)
+        assert sequence['variant'][0]['referenceAllele'] == variant.referenceAllele
+        assert sequence['variant'][0]['observedAllele'] == variant.observedAllele
+        assert extensions['geneticsDNASequenceVariantType']['valueCodeableConcept']['text'] == variant.type
+        assert type(sequence['variant'][0]['start']) is int
+        assert sequence['variant'][0]['start'] == sequence['variant'][0]['end']
+        assert type(sequence['readCoverage']) is int
+        assert type(extensions['geneticsAllelicFrequency']['valueDecimal']) is float
+
+def test_structural_variants_have_numeric_spans(bundle):
+    sequences = [sequence for sequence in bundleResources(bundle, 'Sequence') if 'structureVariant' in sequence]
+    assert len(sequences) == 3 + 2 * 2
+    for sequence in sequences:
+        structureVariant = sequence['structureVariant'][0]
+        assert structureVariant['length'] == structureVariant['outer']['end'] - structureVariant['outer']['start'] > 0
+        if '-copy-number-alt-' in sequence['id']:
+            assert type(structureVariant['reportedaCGHRatio']) is float
@@ -0,0 +1,59 @@
+import os, shutil
+
+import pytest
+
+import foundationtofhir
+
+@pytest.fixture
+def archive(tmp_path, reportPath):
+    # reports with the same name in different directories
+    for directory in ('2017/a', '2017/b', '2017/b/c'):
+        os.makedirs(str(tmp_path / 'archive' / directory))
+        shutil.copy(reportPath, str(tmp_path / 'archive' / directory / 'r.xml'))
+    shutil.copy(reportPath, str(tmp_path / 'archive' / '2017' / 'top.xml'))
+    return str(tmp_path / 'archive')
+
+def outputs(directory):
+    found = []
+    for root, directories, names in os.walk(directory):
+        for name in names:
+            if name.endswith('.json') and not name.startswith('.'):
+                found.append(os.path.relpath(os.path.join(root, name), directory))
+    return sorted(found)
+
+@pytest.mark.parametrize('pattern, root', [
+    ('/mnt/archive/2017/**/*.xml', '/mnt/archive/2017'),
+    ('/mnt/archive/20??/a/*.xml', '/mnt/archive'),
+    ('archive/*.xml', 'archive'),
+    ('*.xml', os.curdir),
+    ('/*.xml', os.sep),
+])
+def test_foundationGlobRoot(pattern, root):
+    assert foundationtofhir.foundationGlobRoot(pattern) == root
+
+def test_directory_is_mirrored(archive, tmp_path):
+    out = str(tmp_path / 'out')
+    assert foundationtofhir.main([archive, '-r', '-o', out, '-j', '1']) == 0
+    assert outputs(out) == ['2017/a/r.json', '2017/b/c/r.json', '2017/b/r.json', '2017/top.json']
+
+def test_directory_without_recursion(archive, tmp_path):
+    out = str(tmp_path / 'out')
+    assert foundationtofhir.main([os.path.join(archive, '2017', 'b'), '-o', out, '-j', '1']) == 0
+    assert outputs(out) == ['r.json']
+
+def test_glob_is_mirrored_below_its_prefix(archive, tmp_path):
+    out = str(tmp_path / 'out')
+    assert foundationtofhir.main([os.path.join(archive, '2017', '**', '*.xml'), '-r', '-o', out, '-j', '1']) == 0
+    assert outputs(out) == ['a/r.json', 'b/c/r.json', 'b/r.json', 'top.json']
+
+def test_outputs_next_to_the_inputs_without_output_dir(archive):
+    assert foundationtofhir.main([os.path.join(archive, '2017', '*', 'r.xml'), '-j', '1']) == 0
+    assert outputs(archive) == ['2017/a/r.json', '2017/b/r.json']
+
+def test_inputs_with_the_same_output_are_rejected(archive, tmp_path, capsys):
+    out = str(tmp_path / 'out')
+    a = os.path.join(archive, '2017', 'a', 'r.xml')
+    b = os.path.join(archive, '2017', 'b', 'r.xml')
+    assert foundationtofhir.main([a, b, '-o', out, '-j', '1']) == 1
+    assert outputs(out) == []
+    assert "%s would be written from %s and %s" % (os.path.join(out, 'r.json'), a, b) in capsys.readouterr().out
@@ -0,0 +1,79 @@
+import json, os, shutil, stat
+
+import pytest
+
+import foundationtofhir
+
+@pytest.fixture
+def inbox(tmp_path, reportPath):
+    os.makedirs(str(tmp_path / 'in'))
+    shutil.copy(reportPath, str(tmp_path / 'in' / 'r.xml'))
+    return str(tmp_path / 'in')
+
+def run(capsys, *args):
+    assert foundationtofhir.main(list(args) + ['-j', '1']) == 0
+    return capsys.readouterr().out
+
+def test_unchanged_reports_are_skipped(inbox, tmp_path, capsys):
+    out = str(tmp_path / 'out')
+    assert "Skipping 0 unchanged of 1 files" in run(capsys, inbox, '-o', out)
+    assert "Skipping 1 unchanged of 1 files" in run(capsys, inbox, '-o', out)
+    # touched, but the same content
+    os.utime(os.path.join(inbox, 'r.xml'), (0, 0))
+    assert "Skipping 1 unchanged of 1 files" in run(capsys, inbox, '-o', out)
+
+@pytest.mark.parametrize('change', ['options', 'content', 'output'])
+def test_changed_reports_are_converted_again(inbox, tmp_path, capsys, change):
+    out = str(tmp_path / 'out')
+    run(capsys, inbox, '-o', out)
+    args = [inbox, '-o', out]
+    if change == 'options':
+        args.append('--pretty')
+    elif change == 'content':
+        with open(os.path.join(inbox, 'r.xml'), 'a') as f:
+            f.write('\n')
+    else:
+        os.remove(os.path.join(out, 'r.json'))
+    assert "Skipping 0 unchanged of 1 files" in run(capsys, *args)
+    assert os.path.exists(os.path.join(out, 'r.json'))
+
+def test_manifest_honours_umask(inbox, tmp_path, capsys):
+    out = str(tmp_path / 'out')
+    umask = os.umask(0o022)
+    try:
+        run(capsys, inbox, '-o', out)
+    finally:
+        os.umask(umask)
+    manifest = os.path.join(out, '.foundationtofhir-manifest.json')
+    assert stat.S_IMODE(os.stat(manifest).st_mode) == 0o644
+    assert sorted(os.listdir(out)) == ['.foundationtofhir-manifest.json', 'r.json']
+
+def test_inputs_with_the_same_output_are_refused(inbox, tmp_path):
+    a = os.path.join(inbox, 'r.xml')
+    b = str(tmp_path / 'r.xml')
+    shutil.copy(a, b)
+    output = str(tmp_path / 'out' / 'r.json')
+    with pytest.raises(ValueError):
+        foundationtofhir.selectChangedFoundationFiles([a, b], {a: output, b: output}, {}, {})
+
+def test_output_written_from_two_inputs_is_not_recorded(inbox, tmp_path):
+    a = os.path.join(inbox, 'r.xml')
+    b = str(tmp_path / 'r.xml')
+    shutil.copy(a, b)
+    output = str(tmp_path / 'r.json')
+    with open(output, 'w') as f:
+        f.write('{}')
+    states = {a: {'sha256': "x", 'size': 1, 'mtimeNs': 1}, b: {'sha256': "y", 'size': 1, 'mtimeNs': 1}}
+    results = [{'file': a, 'outputFile': output, 'error': None}, {'file': b, 'outputFile': output, 'error': None}]
+    manifest = {}
+    foundationtofhir.recordConvertedFoundationFiles(manifest, results, states, {})
+    assert manifest == {}
+    # recording one input drops an earlier input recorded with the same output
+    foundationtofhir.recordConvertedFoundationFiles(manifest, results[1:], states, {})
+    changed, states = foundationtofhir.selectChangedFoundationFiles([a], {a: output}, manifest, {})
+    foundationtofhir.recordConvertedFoundationFiles(manifest, results[:1], states, {})
+    assert list(manifest) == [os.path.abspath(a)]
+    assert foundationtofhir.selectChangedFoundationFiles([a], {a: output}, manifest, {})[0] == []
+    # a manifest written before colliding inputs were refused claims the output for both; it is converted again
+    manifest[os.path.abspath(b)] = dict(manifest[os.path.abspath(a)])
+    assert foundationtofhir.selectChangedFoundationFiles([a], {a: output}, manifest, {})[0] == [a]
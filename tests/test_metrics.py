@@ -0,0 +1,42 @@
+import dis, os, stat
+
+import foundationtofhir
+
+def test_prometheus_textfile_honours_umask(tmp_path):
+    path = str(tmp_path / 'foundationtofhir.prom')
+    results = [
+        {'error': None, 'seconds': 1.5, 'inputBytes': 100, 'outputBytes': 300,
+         'metrics': {'stages': {'parse': 0.5}, 'counts': {'observations': 7}}},
+        {'error': "broken", 'seconds': 0.25, 'inputBytes': 10, 'outputBytes': 0}
+    ]
+    umask = os.umask(0o022)
+    try:
+        foundationtofhir.writeFoundationMetricsPrometheus(results, path)
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert os.listdir(str(tmp_path)) == ['foundationtofhir.prom']
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert 'foundationtofhir_reports_total{status="converted"} 1' in lines
+    assert 'foundationtofhir_reports_total{status="failed"} 1' in lines
+    assert 'foundationtofhir_stage_seconds_total{stage="parse"} 0.500000' in lines
+    assert 'foundationtofhir_resources_total{kind="observations"} 7' in lines
+    assert 'foundationtofhir_bytes_total{direction="in"} 110' in lines
+
+def test_memory_profile_leaves_out_its_own_allocations():
+    profile = foundationtofhir.foundationMemoryProfile(topSites=1000)
+    try:
+        kept = []
+        for stage in range(5):
+            kept.append(bytearray(10000))
+            profile.mark('stage %d' % stage)
+    finally:
+        profile.stop()
+    ownLines = set()
+    for method in (foundationtofhir.foundationConversionMetrics.mark, foundationtofhir.foundationMemoryProfile.mark):
+        ownLines.update(lineno for offset, lineno in dis.findlinestarts(method.__code__))
+    sites = [site['site'] for stage in profile.memory.values() for site in stage['top']]
+    assert any(site.startswith('test_metrics.py:') for site in sites)
+    assert [site for site in sites if site.startswith('foundationtofhir.py:') and
+            int(site.split(':')[1]) in ownLines] == []
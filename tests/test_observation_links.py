@@ -0,0 +1,89 @@
+import collections, json
+from xml.dom import minidom
+
+import foundationtofhir
+from conftest import bundleResources
+
+def geneTherapies(reportPath):
+    genes = collections.OrderedDict()
+    for gene in minidom.parse(reportPath).getElementsByTagName('Genes')[0].getElementsByTagName('Gene'):
+        genes[gene.getElementsByTagName('Name')[0].firstChild.nodeValue] = [
+            therapy.getElementsByTagName('Name')[0].firstChild.nodeValue for therapy in gene.getElementsByTagName('Therapy')]
+    return genes
+
+def relatedTargets(observation, linkType=None):
+    return [related['target']['reference'][len("Observation/"):] for related in observation.get('related', [])
+            if related.get('type') == linkType]
+
+def observationsByKind(bundle):
+    genes = {}
+    therapies = {}
+    trials = {}
+    for observation in bundleResources(bundle, 'Observation'):
+        if '-gene-alt-' in observation['id']:
+            genes[observation['extension'][0]['valueCodeableConcept']['text']] = observation
+        elif '-therapy-' in observation['id']:
+            therapies[observation['valueString'].split(" is a therapy")[0]] = observation
+        elif '-trial-' in observation['id']:
+            trials[observation['valueString'].split("The title of the trial is ")[1].split(". ")[0]] = observation
+    return genes, therapies, trials
+
+def test_one_observation_per_therapy(reportPath, bundle):
+    expected = geneTherapies(reportPath)
+    genes, therapies, _ = observationsByKind(bundle)
+    assert list(genes) == list(expected)
+    assert set(therapies) == {therapy for names in expected.values() for therapy in names}
+    ids = [observation['id'] for observation in bundleResources(bundle, 'Observation')]
+    assert len(ids) == len(set(ids))
+
+def test_therapies_link_to_every_gene_that_suggests_them(reportPath, bundle):
+    expected = geneTherapies(reportPath)
+    genes, therapies, _ = observationsByKind(bundle)
+    for gene, names in expected.items():
+        assert set(names) <= {therapy for therapy in therapies
+                              if therapies[therapy]['id'] in relatedTargets(genes[gene])}
+    for therapy, observation in therapies.items():
+        suggestedBy = [gene for gene, names in expected.items() if therapy in names]
+        assert len(suggestedBy) > 0
+        assert relatedTargets(observation, "derived-from") == [genes[gene]['id'] for gene in suggestedBy]
+
+def test_repeated_trial_links_every_gene(bundle):
+    genes, _, trials = observationsByKind(bundle)
+    # the generator repeats Synthetic Trial 1 for GENE1 and GENE2
+    assert len(trials) == 4
+    assert relatedTargets(trials['Synthetic Trial 1'], "derived-from") == [genes['GENE1']['id'], genes['GENE2']['id']]
+    for gene in ('GENE1', 'GENE2'):
+        assert trials['Synthetic Trial 1']['id'] in relatedTargets(genes[gene])
+
+def test_related_references_resolve(bundle):
+    ids = {observation['id'] for observation in bundleResources(bundle, 'Observation')}
+    for observation in bundleResources(bundle, 'Observation'):
+        for related in observation.get('related', []):
+            assert related['target']['reference'][len("Observation/"):] in ids
+
+def test_trial_for_gene_without_alteration_is_kept_unlinked():
+    trials = minidom.parseString(
+        '<Trials><Trial><Gene>NOPE</Gene><Title>Lonely Trial</Title><StudyPhase>Phase 1</StudyPhase>'
+        '<Target>ALK</Target><Locations>Boston, MA</Locations><NCTID>NCT00000001</NCTID><Note>None.</Note></Trial>'
+        '</Trials>')
+    observations = []
+    links = foundationtofhir.foundationObservationLinks()
+    foundationtofhir.extractRelatedClinicalTrials(observations, trials, links, 'ORD-1')
+    links.relate()
+    assert [observation.getObservationId() for observation in observations] == ['ORD-1-trial-1']
+    assert 'related' not in observations[0].observationResource
+
+def test_related_artifacts_are_not_shared(reportPath):
+    bundle = foundationtofhir.convert_file(reportPath)
+    artifacts = {}
+    for observation in bundleResources(bundle, 'Observation'):
+        for extension in observation.get('extension', []):
+            if extension['url'].endswith('relatedPubMedArtifact'):
+                artifacts.setdefault(extension['valueCodeableConcept']['text'], []).append(extension)
+    cited, = [extensions for extensions in artifacts.values() if len(extensions) > 1][:1]
+    assert len(set(id(extension) for extension in cited)) == len(cited)
+    assert len(set(id(extension['valueCodeableConcept']) for extension in cited)) == len(cited)
+    # editing one bundle does not change the next one
+    cited[0]['valueCodeableConcept']['text'] = "edited"
+    again = foundationtofhir.convert_file(reportPath)
+    assert "edited" not in json.dumps(again)
@@ -0,0 +1,46 @@
+import foundationtofhir
+
+def nodeText(node):
+    if node.childNodes.length == 0:
+        return None
+    return node.childNodes[0].nodeValue
+
+# the streaming parser drops namespace prefixes (rr:ResultsReport), which no builder asks for
+def localName(tagName):
+    return tagName.rpartition(':')[2]
+
+def insideUnusedSubtree(node):
+    while node is not None and node.nodeType == node.ELEMENT_NODE:
+        if localName(node.tagName) in foundationtofhir.foundationUnusedTags:
+            return True
+        node = node.parentNode
+    return False
+
+def test_stream_index_matches_minidom(reportPath):
+    stream = foundationtofhir.parseFoundationXml(reportPath, backend='stream', spoolPDF=False)
+    dom = foundationtofhir.parseFoundationXml(reportPath, backend='minidom')
+    assert stream.documentElement.tagName == localName(dom.documentElement.tagName)
+    domTagNames = dict((localName(tagName), tagName) for tagName in dom.nodes)
+    # only the subtrees no builder reads are left out
+    assert set(stream.nodes) <= set(domTagNames)
+    assert set(stream.nodes).isdisjoint(foundationtofhir.foundationUnusedTags)
+    assert foundationtofhir.foundationUnusedTags & set(domTagNames)
+    for tagName in stream.nodes:
+        streamNodes = stream.getElementsByTagName(tagName)
+        domNodes = [node for node in dom.getElementsByTagName(domTagNames[tagName]) if not insideUnusedSubtree(node)]
+        assert streamNodes.length == len(domNodes), tagName
+        for streamNode, domNode in zip(streamNodes, domNodes):
+            # namespace declarations are not attributes to xml.etree
+            attributes = dict((name, value) for name, value in domNode.attributes.items()
+                              if not name.startswith('xmlns'))
+            assert dict((name, streamNode.getAttribute(name)) for name in streamNode.element.attrib) == attributes
+            if domNode.childNodes.length > 0 and domNode.childNodes[0].nodeType == domNode.TEXT_NODE:
+                assert nodeText(streamNode) == nodeText(domNode)
+        if dom.getElementsByTagName(domTagNames[tagName])[0] is domNodes[0]:
+            assert stream.getFirstText(tagName) == dom.getFirstText(domTagNames[tagName])
+    assert stream.getElementsByTagName('NoSuchTag').length == dom.getElementsByTagName('NoSuchTag').length == 0
+
+def test_stream_and_minidom_bundles_are_the_same(reportPath):
+    stream = foundationtofhir.parseFoundationXml(reportPath, backend='stream', spoolPDF=False)
+    dom = foundationtofhir.parseFoundationXml(reportPath, backend='minidom')
+    assert foundationtofhir.convert_dom(stream) == foundationtofhir.convert_dom(dom)
@@ -0,0 +1,76 @@
+import base64, hashlib, io, json, os, stat
+
+import foundationtofhir
+from conftest import bundleResources
+
+def test_spooled_pdf_is_written_like_an_inlined_one(reportPath, tmp_path):
+    DOM = foundationtofhir.parseFoundationXml(reportPath, spoolPDF=True)
+    assert isinstance(DOM.getFirstText('ReportPDF'), foundationtofhir.foundationSpooledText)
+    outputFile = foundationtofhir.convertFoundationFile(reportPath, str(tmp_path / 'report.json'))
+    with open(outputFile, encoding='utf-8') as f:
+        written = json.load(f)
+    inlined = foundationtofhir.convert_file(reportPath)
+    documentReference, = bundleResources(written, 'DocumentReference')
+    assert len(documentReference['content'][0]['attachment']['data']) > 1000
+    assert bundleResources(written, 'DocumentReference') == bundleResources(inlined, 'DocumentReference')
+
+def test_spooled_text_is_written_as_a_json_string():
+    text = 'JVBERi0x\n"é€\\' * 3
+    spooled = foundationtofhir.foundationSpooledText()
+    spooled.write(text[:10])
+    spooled.write(text[10:])
+    outfile = io.BytesIO()
+    # chunks end in the middle of the multi-byte characters
+    spooled.writeJsonTo(outfile, chunkSize=1)
+    spooled.close()
+    assert outfile.getvalue() == json.dumps(text).encode('ascii')
+
+def storedFiles(blobDirectory):
+    return sorted(str(path.relative_to(blobDirectory)) for path in blobDirectory.rglob('*') if path.is_file())
+
+def test_stored_pdf_is_keyed_by_its_sha256(tmp_path):
+    data = bytes(range(256)) * 300
+    encoded = base64.b64encode(data).decode('ascii')
+    # wrapped at 76 columns, like the base64 in reports
+    pdf = '\n'.join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+    blobDirectory = tmp_path / 'blobs'
+    umask = os.umask(0o022)
+    try:
+        attachment = foundationtofhir.storeFoundationPDF(pdf, str(blobDirectory))
+    finally:
+        os.umask(umask)
+    digest = hashlib.sha256(data).hexdigest()
+    blobPath = blobDirectory / digest[:2] / (digest + '.pdf')
+    assert attachment == {
+        'contentType': "application/pdf",
+        'url': "file://" + os.path.abspath(str(blobPath)),
+        'size': len(data),
+        'hash': base64.b64encode(hashlib.sha1(data).digest()).decode('ascii')
+    }
+    assert blobPath.read_bytes() == data
+    assert stat.S_IMODE(os.stat(str(blobPath)).st_mode) == 0o644
+    assert storedFiles(blobDirectory) == [os.path.join(digest[:2], digest + '.pdf')]
+
+def test_same_pdf_is_stored_once(tmp_path):
+    blobDirectory = tmp_path / 'blobs'
+    pdf = base64.b64encode(b'%PDF-1.4 report').decode('ascii')
+    spooled = foundationtofhir.foundationSpooledText()
+    spooled.write(pdf)
+    attachments = [foundationtofhir.storeFoundationPDF(pdf, str(blobDirectory)),
+                   foundationtofhir.storeFoundationPDF(spooled, str(blobDirectory))]
+    spooled.close()
+    assert attachments[0] == attachments[1]
+    # no temporary file is left behind
+    assert len(storedFiles(blobDirectory)) == 1
+    other = foundationtofhir.storeFoundationPDF(base64.b64encode(b'%PDF-1.4 amended').decode('ascii'),
+                                                str(blobDirectory))
+    assert other['url'] != attachments[0]['url']
+    assert len(storedFiles(blobDirectory)) == 2
+
+def test_reports_refer_to_the_stored_pdf(reportPath, tmp_path):
+    blobDirectory = tmp_path / 'blobs'
+    bundles = [foundationtofhir.convert_file(reportPath, str(blobDirectory)) for i in range(2)]
+    attachments = [bundleResources(bundle, 'DocumentReference')[0]['content'][0]['attachment'] for bundle in bundles]
+    assert attachments[0] == attachments[1]
+    assert 'data' not in attachments[0] and attachments[0]['url'].startswith("file://")
+    assert len(storedFiles(blobDirectory)) == 1
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+import foundationtofhir
+
+def test_dangling_references():
+    references = foundationtofhir.foundationReferenceIndex()
+    references.addEntry({'resource': {'resourceType': "Patient", 'id': "p"}})
+    references.addEntry({'resource': {
+        'resourceType': "DiagnosticReport", 'id': "r",
+        'contained': [{'resourceType': "Specimen", 'id': "s", 'subject': {'reference': "Patient/gone"}}],
+        'subject': {'reference': "Patient/p"},
+        'specimen': [{'reference': "#s"}, {'reference': "#t"}],
+        'result': [{'reference': "Observation/o"}],
+        'performer': [{'reference': "https://example.org/fhir/Organization/x"}]
+    }})
+    # references inside contained resources are left to the resource that contains them
+    assert sorted(references.dangling()) == [("DiagnosticReport/r", "#t"), ("DiagnosticReport/r", "Observation/o")]
+    references.addEntry({'fullUrl': "urn:uuid:1", 'resource': {'resourceType': "Observation", 'id': "o",
+                                                              'related': [{'target': {'reference': "urn:uuid:1"}}]}})
+    assert references.dangling() == [("DiagnosticReport/r", "#t")]
+
+def test_shared_resources_are_targets():
+    patient = {'resourceType': "Patient", 'id': "555-10000FM", 'birthDate': "1950-01-01",
+               'identifier': [{'system': "http://foundationmedicine.com/compbio/resultsreport/MedFacilID/555/MRN",
+                               'value': "10000"}]}
+    conditional = "Patient?" + foundationtofhir.foundationIfNoneExist(patient)
+    references = foundationtofhir.foundationReferenceIndex()
+    references.addEntry({'resource': {'resourceType': "Condition", 'id': "c",
+                                      'subject': {'reference': "Patient/555-10000FM"},
+                                      'asserter': {'reference': conditional}}})
+    assert len(references.dangling()) == 2
+    references.addShared(patient)
+    assert references.dangling() == []
+
+@pytest.mark.parametrize('bundleType', foundationtofhir.foundationBundleTypes)
+@pytest.mark.parametrize('sharedResources', [False, True])
+def test_converted_bundles_have_no_dangling_references(reportPath, tmp_path, bundleType, sharedResources):
+    outputFile = str(tmp_path / 'report.json')
+    result = foundationtofhir.convertFoundationFileInWorker(
+        reportPath, outputFile, {'bundleType': bundleType, 'sharedResources': sharedResources}, checkReferences=True)
+    assert result['error'] is None
+    assert result['danglingReferences'] == []
+    with open(outputFile, encoding='utf-8') as f:
+        text = f.read()
+    # the references the index had to resolve are there to be checked
+    if bundleType == 'transaction' and sharedResources:
+        assert '"reference":"Patient?identifier=' in text
+    if not sharedResources:
+        assert '"reference":"Patient/' in text or '"reference":"urn:uuid:' in text
@@ -0,0 +1,72 @@
+import json, os
+
+import foundationtofhir
+from conftest import bundleResources
+
+def patient(name):
+    return {'resourceType': "Patient", 'id': "555-10000FM", 'name': [{'text': name}]}
+
+def test_changed_resource_is_kept_and_recorded():
+    registry = foundationtofhir.foundationSharedResourceRegistry()
+    registry.merge([patient("Jane Doe")], 'a.xml')
+    registry.merge([patient("Jane Doe")], 'b.xml')
+    assert registry.conflicts == []
+    registry.merge([patient("Jane Smith")], 'c.xml')
+    assert registry.resources['Patient/555-10000FM'] == patient("Jane Smith")
+    assert registry.conflicts == [('Patient/555-10000FM', 'a.xml', 'c.xml')]
+    assert (registry.added, registry.replaced) == (1, 1)
+
+def copyReport(reportPath, path, replacements):
+    with open(reportPath, encoding='utf-8') as f:
+        text = f.read()
+    for old, new in replacements:
+        assert old in text
+        text = text.replace(old, new)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def test_same_mrn_at_two_facilities_stays_two_patients(reportPath, tmp_path, capsys):
+    inbox = tmp_path / 'reports'
+    inbox.mkdir()
+    copyReport(reportPath, str(inbox / 'a.xml'), [])
+    copyReport(reportPath, str(inbox / 'b.xml'), [('<MedFacilID>555<', '<MedFacilID>777<'),
+                                                  ('<OrderingMDId>99<', '<OrderingMDId>98<'),
+                                                  ('<Pathologist>Alan Jones<', '<Pathologist>Ann Jones<')])
+    # the same patient at the first facility, renamed by an amended report
+    copyReport(reportPath, str(inbox / 'c.xml'), [('<FullName>Doe, Jane<', '<FullName>Smith, Jane<'),
+                                                  ('<LastName>Doe<', '<LastName>Smith<')])
+    shared = str(tmp_path / 'shared.json')
+    foundationtofhir.main([str(inbox), '-o', str(tmp_path / 'fhir'), '-j', '1', '--shared-resources', shared])
+    with open(shared) as f:
+        bundle = json.load(f)
+    patients = dict((resource['id'], resource) for resource in bundleResources(bundle, 'Patient'))
+    assert sorted(patients) == ['555-10000FM', '777-10000FM']
+    assert patients['555-10000FM']['name'][0]['family'] == "Smith"
+    assert patients['777-10000FM']['name'][0]['family'] == "Doe"
+    practitioners = [resource['id'] for resource in bundleResources(bundle, 'Practitioner')]
+    assert '555-10000FM-patho-Alan-Jones' in practitioners and '777-10000FM-patho-Ann-Jones' in practitioners
+    assert 'Jeffrey-S-Ross-FM' in practitioners
+    output = capsys.readouterr().out
+    assert "Warning: Patient/555-10000FM differs between %s and %s, kept the one from %s" % (
+        os.path.join(str(inbox), 'a.xml'), os.path.join(str(inbox), 'c.xml'), os.path.join(str(inbox), 'c.xml')) in output
+    assert output.count("Warning:") == 1
+
+def test_patient_without_facility_id_stays_apart(reportPath, tmp_path, capsys):
+    inbox = tmp_path / 'reports'
+    inbox.mkdir()
+    copyReport(reportPath, str(inbox / 'a.xml'), [])
+    copyReport(reportPath, str(inbox / 'b.xml'), [('<MedFacilID>555</MedFacilID>', '<MedFacilID/>'),
+                                                  ('<OrderingMDId>99<', '<OrderingMDId>98<'),
+                                                  ('<FullName>Doe, Jane<', '<FullName>Smith, Jane<'),
+                                                  ('<LastName>Doe<', '<LastName>Smith<')])
+    shared = str(tmp_path / 'shared.json')
+    assert foundationtofhir.main([str(inbox), '-o', str(tmp_path / 'fhir'), '-j', '1', '--shared-resources', shared]) == 0
+    with open(shared) as f:
+        bundle = json.load(f)
+    patients = dict((resource['id'], resource) for resource in bundleResources(bundle, 'Patient'))
+    assert sorted(patients) == ['10000FM', '555-10000FM']
+    assert patients['555-10000FM']['name'][0]['family'] == "Doe"
+    assert patients['10000FM']['name'][0]['family'] == "Smith"
+    organizations = [resource['id'] for resource in bundleResources(bundle, 'Organization')]
+    assert len(organizations) == 3 and '555FM' in organizations
+    assert "Warning:" not in capsys.readouterr().out
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+import foundationtofhir
+
+@pytest.mark.parametrize('bundleType', foundationtofhir.foundationBundleTypes)
+def test_pretty_streamed_bundle_is_indented_like_a_built_one(reportPath, tmp_path, bundleType):
+    written = {}
+    for pretty in (False, True):
+        outputFile = foundationtofhir.convertFoundationFile(reportPath, str(tmp_path / ('%s.json' % pretty)),
+                                                            streamBundle=True, jsonBackend='json', pretty=pretty,
+                                                            bundleType=bundleType)
+        with open(outputFile, 'rb') as f:
+            written[pretty] = f.read()
+    assert written[True] == json.dumps(json.loads(written[False]), ensure_ascii=False, indent=2).encode('utf-8')
+
+def entryKey(entry):
+    return entry['resource']['resourceType'] + "/" + entry['resource']['id']
+
+# the same report converted built and streamed
+def convertBothWays(reportPath, tmp_path, **options):
+    bundles = []
+    for streamBundle in (False, True):
+        outputFile = foundationtofhir.convertFoundationFile(reportPath, str(tmp_path / ('%s.json' % streamBundle)),
+                                                            streamBundle=streamBundle, **options)
+        with open(outputFile, encoding='utf-8') as f:
+            bundles.append(json.load(f))
+    return bundles
+
+# the streamed bundle has the built one's entries in its order, except that the DiagnosticReport and the Provenance
+# with its signers come last, and observations and sequences are written as they are built instead of by type
+def assertSameEntries(built, streamed):
+    assert dict((key, built[key]) for key in built if key != 'entry') == \
+        dict((key, streamed[key]) for key in streamed if key != 'entry')
+    builtKeys = [entryKey(entry) for entry in built['entry']]
+    streamedKeys = [entryKey(entry) for entry in streamed['entry']]
+    assert sorted(builtKeys) == sorted(streamedKeys) and len(set(builtKeys)) == len(builtKeys)
+    assert dict(zip(builtKeys, built['entry'])) == dict(zip(streamedKeys, streamed['entry']))
+    last = streamedKeys[[key.split('/')[0] for key in streamedKeys].index('DiagnosticReport'):]
+    assert last[1].startswith('Provenance/') and all(key.startswith('Practitioner/') for key in last[2:])
+    for resourceTypes in (('Observation',), ('Sequence',), ('Organization', 'Practitioner', 'Patient', 'Condition',
+                                                            'DocumentReference', 'ProcedureRequest', 'Specimen')):
+        assert [key for key in builtKeys if key.split('/')[0] in resourceTypes and key not in last] == \
+            [key for key in streamedKeys if key.split('/')[0] in resourceTypes and key not in last]
+
+@pytest.mark.parametrize('bundleType', foundationtofhir.foundationBundleTypes)
+def test_streamed_bundle_has_the_built_entries(reportPath, tmp_path, bundleType):
+    built, streamed = convertBothWays(reportPath, tmp_path, bundleType=bundleType)
+    assertSameEntries(built, streamed)
+
+def test_streamed_transaction_rewrites_the_contained_copies(reportPath, tmp_path):
+    built, streamed = convertBothWays(reportPath, tmp_path, bundleType='transaction')
+    for bundle in (built, streamed):
+        entries = dict((entryKey(entry), entry) for entry in bundle['entry'])
+        patientUrl, = [entry['fullUrl'] for entry in bundle['entry'] if entry['resource']['resourceType'] == 'Patient']
+        report, = [entry['resource'] for key, entry in entries.items() if key.startswith('DiagnosticReport/')]
+        assert len(report['contained']) > 1
+        for contained in report['contained']:
+            # the same copy as the entry, with its references rewritten too
+            assert contained == entries[contained['resourceType'] + "/" + contained['id']]['resource']
+            assert contained['subject']['reference'] == patientUrl
+    assertSameEntries(built, streamed)
+
+def test_streamed_bundle_leaves_out_the_shared_resources(reportPath, tmp_path):
+    registries = [foundationtofhir.foundationSharedResourceRegistry() for streamBundle in (False, True)]
+    bundles = []
+    for streamBundle, registry in zip((False, True), registries):
+        outputFile = foundationtofhir.convertFoundationFile(reportPath, str(tmp_path / ('%s.json' % streamBundle)),
+                                                            streamBundle=streamBundle, bundleType='transaction',
+                                                            registry=registry)
+        with open(outputFile, encoding='utf-8') as f:
+            bundles.append(json.load(f))
+    built, streamed = bundles
+    assertSameEntries(built, streamed)
+    shared = set(registries[0].resources)
+    assert len(shared) > 0 and shared == set(registries[1].resources)
+    assert shared.isdisjoint(entryKey(entry) for entry in streamed['entry'])
+    assert registries[0].resources == registries[1].resources
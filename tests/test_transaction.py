@@ -0,0 +1,56 @@
+import pytest
+
+import foundationtofhir
+from conftest import bundleResources
+
+facility = {'resourceType': "Organization", 'id': "555FM",
+            'identifier': [{'system': "http://foundationmedicine.com/compbio/resultsreport/MedFacilID", 'value': "555"}]}
+
+@pytest.mark.parametrize('resource, expected', [
+    (facility, "identifier=http://foundationmedicine.com/compbio/resultsreport/MedFacilID|555"),
+    ({'resourceType': "Patient", 'id': "12345FM", 'birthDate': "1950-01-01",
+      'identifier': [{'system': "http://foundationmedicine.com/compbio/resultsreport/MedFacilID/555/MRN", 'value': "12 34"}]},
+     "identifier=http://foundationmedicine.com/compbio/resultsreport/MedFacilID/555/MRN|12%2034&birthdate=1950-01-01"),
+    # a bare value could match another facility's identifier
+    ({'resourceType': "Organization", 'id': "555FM", 'identifier': [{'value': "555"}]}, None),
+    ({'resourceType': "Patient", 'id': "12345FM", 'identifier': [{'value': "12345"}]}, None),
+    ({'resourceType': "Practitioner", 'id': "99FM", 'identifier': [{'system': "urn:x", 'value': ""}]}, None),
+    ({'resourceType': "Practitioner", 'id': "Ross-FM"}, None),
+    (dict(facility, resourceType="Observation"), None),
+])
+def test_foundationIfNoneExist(resource, expected):
+    assert foundationtofhir.foundationIfNoneExist(resource) == expected
+
+def test_shared_resources_are_created_by_identifier_system(reportPath):
+    bundle = foundationtofhir.convert_file(reportPath, bundleType='transaction')
+    requests = dict((entry['resource']['id'], entry['request']) for entry in bundle['entry'])
+    for resourceType in ('Organization', 'Practitioner', 'Patient'):
+        for resource in bundleResources(bundle, resourceType):
+            identifiers = resource.get('identifier')
+            if identifiers is None:
+                assert requests[resource['id']] == {'method': "PUT", 'url': resourceType + "/" + resource['id']}
+            else:
+                assert requests[resource['id']]['method'] == "POST"
+                assert requests[resource['id']]['ifNoneExist'].startswith(
+                    "identifier=" + identifiers[0]['system'] + "|" + identifiers[0]['value'])
+    facilityIds = [resource['identifier'][0]['system'] for resource in bundleResources(bundle, 'Organization')]
+    assert "http://foundationmedicine.com/compbio/resultsreport/MedFacilID" in facilityIds
+
+def test_report_without_facility_id(reportPath, tmp_path):
+    path = str(tmp_path / 'report.xml')
+    with open(reportPath) as f:
+        text = f.read()
+    with open(path, 'w') as f:
+        f.write(text.replace('<MedFacilID>555</MedFacilID>', '<MedFacilID/>'))
+    bundle = foundationtofhir.convert_file(path, bundleType='transaction')
+    assert foundationtofhir.validate_bundle(bundle) == []
+    requests = dict((entry['resource']['id'], entry['request']) for entry in bundle['entry'])
+    patient, = bundleResources(bundle, 'Patient')
+    assert patient['id'] == "10000FM"
+    assert 'system' not in patient['identifier'][0]
+    assert requests["10000FM"] == {'method': "PUT", 'url': "Patient/10000FM"}
+    # the facility keeps an id of its own instead of taking Foundation Medicine's
+    organizationIds = [resource['id'] for resource in bundleResources(bundle, 'Organization')]
+    assert len(set(organizationIds)) == len(organizationIds)
+    facility, = [resource for resource in bundleResources(bundle, 'Organization') if 'identifier' not in resource]
+    assert requests[facility['id']] == {'method': "PUT", 'url': "Organization/" + facility['id']}
@@ -0,0 +1,78 @@
+import http.client
+
+import pytest
+
+import foundationtofhir
+
+class fakeResponse:
+    status = 201
+    will_close = False
+
+    def read(self):
+        return b''
+
+    def getheader(self, name):
+        return "Bundle/1" if name == 'Location' else None
+
+# fails the way it is told to: 'stale' when sending, 'dropped' after the request went out, None not at all
+class fakeConnection:
+    def __init__(self, failure, requests):
+        self.failure = failure
+        self.requests = requests
+
+    def request(self, method, url, body, headers):
+        if self.failure == 'stale':
+            raise BrokenPipeError(32, "Broken pipe")
+        self.requests.append(url)
+
+    def getresponse(self):
+        if self.failure == 'dropped':
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        return fakeResponse()
+
+    def close(self):
+        pass
+
+# hands out idle connections first, then new ones, like foundationFhirConnectionPool
+class fakePool:
+    path = '/fhir'
+
+    def __init__(self, idle, new):
+        self.requests = []
+        self.idle = [fakeConnection(failure, self.requests) for failure in idle]
+        self.new = [fakeConnection(failure, self.requests) for failure in new]
+
+    def acquire(self):
+        if len(self.idle) > 0:
+            return self.idle.pop(0), True
+        return self.new.pop(0), False
+
+    def release(self, connection):
+        pass
+
+@pytest.fixture
+def bundlePath(tmp_path):
+    path = tmp_path / 'bundle.json'
+    path.write_text('{"resourceType": "Bundle"}')
+    return str(path)
+
+def test_stale_idle_connections_are_retried_for_free(bundlePath):
+    pool = fakePool(['stale', 'stale'], [None])
+    result = foundationtofhir.uploadFoundationBundle(pool, bundlePath, retries=0, backoff=0)
+    assert result['error'] is None
+    assert result['attempts'] == 1
+    assert pool.requests == ['/fhir/Bundle']
+
+def test_failure_after_sending_counts_as_an_attempt(bundlePath):
+    pool = fakePool(['dropped'], [None])
+    result = foundationtofhir.uploadFoundationBundle(pool, bundlePath, retries=1, backoff=0)
+    assert result['error'] is None
+    assert result['attempts'] == 2
+    assert pool.requests == ['/fhir/Bundle', '/fhir/Bundle']
+
+def test_failure_after_sending_is_not_retried_past_retries(bundlePath):
+    pool = fakePool(['dropped'], [None])
+    result = foundationtofhir.uploadFoundationBundle(pool, bundlePath, retries=0, backoff=0)
+    assert result['error'] == "RemoteDisconnected: Remote end closed connection without response"
+    assert result['attempts'] == 1
+    assert pool.requests == ['/fhir/Bundle']
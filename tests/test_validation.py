@@ -0,0 +1,78 @@
+import pytest
+
+import foundationtofhir
+
+def observation(**elements):
+    resource = {'resourceType': "Observation", 'id': "obs-1", 'status': "final"}
+    resource.update(elements)
+    return resource
+
+def problems(resource):
+    return foundationtofhir.validate_bundle({'entry': [{'resource': resource}]})
+
+def test_converted_report_is_valid(bundle):
+    assert foundationtofhir.validate_bundle(bundle) == []
+
+def test_valid_observation():
+    assert problems(observation(
+        effectiveDateTime="2017-01-10T12:00:00", valueString="text", specimen={'reference': "Specimen/1"},
+        performer=[{'reference': "Organization/1"}], related=[{'type': "derived-from", 'target': {'reference': "Observation/2"}}],
+        extension=[{'url': "http://example.org", 'valueDecimal': 0.5}])) == []
+
+@pytest.mark.parametrize('resource, expected', [
+    # element names
+    (observation(colour="red"), ["Observation/obs-1.colour: not an element of Observation"]),
+    (observation(code={'txt': "x"}), ["Observation/obs-1.code.txt: not an element of CodeableConcept"]),
+    # JSON types
+    (observation(comment=5), ["Observation/obs-1.comment: 5 is not a valid string"]),
+    ({'resourceType': "Sequence", 'id': "seq-1", 'readCoverage': "12"},
+     ["Sequence/seq-1.readCoverage: '12' is not a valid integer"]),
+    ({'resourceType': "Sequence", 'id': "seq-1", 'variant': [{'start': 1}, {'start': "2"}]},
+     ["Sequence/seq-1.variant[1].start: '2' is not a valid integer"]),
+    (observation(extension=[{'url': "http://example.org", 'valueDecimal': "0.5"}]),
+     ["Observation/obs-1.extension[0].valueDecimal: '0.5' is not a valid decimal"]),
+    (observation(effectiveDateTime="2017-13-01"), ["Observation/obs-1.effectiveDateTime: '2017-13-01' is not a valid dateTime"]),
+    (observation(id="has space"), ["Observation/has space.id: 'has space' is not a valid id"]),
+    # single values and arrays
+    (observation(specimen=[{'reference': "Specimen/1"}]),
+     ["Observation/obs-1.specimen: is an array, but takes a single value"]),
+    (observation(performer={'reference': "Organization/1"}),
+     ["Observation/obs-1.performer: {'reference': 'Organization/1'} is not a non-empty array"]),
+    (observation(related=[]), ["Observation/obs-1.related: [] is not a non-empty array"]),
+    # required elements and choices
+    ({'resourceType': "Observation", 'id': "obs-1"}, ["Observation/obs-1.status: is required"]),
+    (observation(related=[{'type': "derived-from"}]), ["Observation/obs-1.related[0].target: is required"]),
+    (observation(effectiveDateTime="2017", effectivePeriod={'start': "2017"}),
+     ["Observation/obs-1.effectivePeriod: only one effective[x] is allowed"]),
+    # status codes
+    (observation(status="done"), ["Observation/obs-1.status: 'done' is not one of "
+                                  "amended|cancelled|corrected|entered-in-error|final|preliminary|registered|unknown"]),
+    (observation(related=[{'type': "child", 'target': {'reference': "Observation/2"}}]),
+     ["Observation/obs-1.related[0].type: 'child' is not one of "
+      "derived-from|has-member|interfered-by|qualified-by|replaces|sequel-to"]),
+])
+def test_rules(resource, expected):
+    assert problems(resource) == expected
+
+def test_every_problem_is_listed():
+    assert problems(observation(status=None, comment=5, colour="red")) == [
+        "Observation/obs-1.status: None is not one of "
+        "amended|cancelled|corrected|entered-in-error|final|preliminary|registered|unknown",
+        "Observation/obs-1.comment: 5 is not a valid string",
+        "Observation/obs-1.colour: not an element of Observation"
+    ]
+
+def test_long_values_are_shortened():
+    assert problems(observation(comment=["x" * 100])) == [
+        "Observation/obs-1.comment: ['" + "x" * 35 + "... is not a valid string"]
+
+def test_resource_types_without_rules_and_contained_resources_are_skipped():
+    assert problems({'resourceType': "Patient", 'id': "1", 'colour': "red"}) == []
+    assert problems(observation(contained=[{'resourceType': "Observation", 'colour': "red"}])) == []
+
+def test_every_resource_wrapper_names_its_resource_type(bundle):
+    import inspect
+    wrappers = [cls for name, cls in inspect.getmembers(foundationtofhir, inspect.isclass)
+                if name.startswith('foundationFhir') and any(slot.endswith('Resource') for slot in cls.__slots__)]
+    resourceTypes = set(entry['resource']['resourceType'] for entry in bundle['entry'])
+    assert set(getattr(cls, 'resourceType', None) for cls in wrappers) == resourceTypes
@@ -0,0 +1,57 @@
+import asyncio, os, shutil
+from concurrent import futures
+
+import foundationtofhir
+
+def watcherWithReport(tmp_path, reportPath):
+    inbox = str(tmp_path)
+    watcher = foundationtofhir.foundationInboxWatcher(inbox)
+    for directory in (watcher.outputDirectory, watcher.doneDirectory, watcher.failedDirectory):
+        os.makedirs(directory)
+    f = os.path.join(inbox, 'report.xml')
+    shutil.copy(reportPath, f)
+    watcher.inFlight.add(f)
+    # threads instead of processes, so the worker function can be replaced
+    watcher.executor = futures.ThreadPoolExecutor(max_workers=1)
+    return watcher, f
+
+def test_converted_report_is_moved_to_done(tmp_path, reportPath):
+    watcher, f = watcherWithReport(tmp_path, reportPath)
+    result = asyncio.run(watcher.convert(f))
+    watcher.executor.shutdown()
+    assert result['error'] is None
+    assert os.listdir(watcher.doneDirectory) == ['report.xml']
+    assert os.listdir(watcher.outputDirectory) == ['report.json']
+    assert len(watcher.inFlight) == 0
+
+def test_unexpected_error_fails_the_report(tmp_path, reportPath, monkeypatch):
+    def convertFoundationFileInWorker(*args):
+        raise RuntimeError("cannot pickle the result")
+    monkeypatch.setattr(foundationtofhir, 'convertFoundationFileInWorker', convertFoundationFileInWorker)
+    watcher, f = watcherWithReport(tmp_path, reportPath)
+    executor = watcher.executor
+    result = asyncio.run(watcher.convert(f))
+    executor.shutdown()
+    assert result['error'] == "RuntimeError: cannot pickle the result"
+    assert sorted(os.listdir(watcher.failedDirectory)) == ['report.xml', 'report.xml.error']
+    with open(os.path.join(watcher.failedDirectory, 'report.xml.error')) as errorFile:
+        assert errorFile.read() == "RuntimeError: cannot pickle the result\n"
+    assert len(watcher.inFlight) == 0
+    # only a dead worker replaces the pool
+    assert watcher.executor is executor
+
+def test_report_that_cannot_be_moved_is_not_converted_again(tmp_path, reportPath, monkeypatch):
+    def moveFoundationFileAtomically(f, directory):
+        raise PermissionError(13, "Permission denied")
+    monkeypatch.setattr(foundationtofhir, 'moveFoundationFileAtomically', moveFoundationFileAtomically)
+    watcher, f = watcherWithReport(tmp_path, reportPath)
+    result = asyncio.run(watcher.convert(f))
+    watcher.executor.shutdown()
+    assert result['error'] is None
+    assert os.path.exists(f) and len(watcher.inFlight) == 0
+    assert watcher.scan() == [] and watcher.scan() == []
+    # a report copied over it is converted again
+    stat = os.stat(f)
+    os.utime(f, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert watcher.scan() == []
+    assert watcher.scan() == [f]